@@ -294,6 +294,89 @@ If you see 'abort: Connection refused' when you run
 fn-fmsread or fn-fmsnotify, check fms_host and
 fms_port in the config file.
 
+TRACING:
+To see where the time goes in fn-push, fn-pull etc. set
+a trace file in your hgrc:
+
+[infocalypse]
+tracefile = ~/infocalypse_trace.jsonl
+
+Every request is appended to it as a JSON line.
+
+hg fn-trace [--last]
+
+prints percentiles for queueing delay, time to the first
+reply, total time, bytes, retries and state dwell times.
+
+hg fn-info --cost-model
+
+fetches the graph and shows how big the CHKs are and what
+the cheapest updates from a new clone and from recent
+versions cost with each of the edge cost functions.
+
+BUNDLE STORE:
+fn-push and fn-reinsert make an hg bundle for every update
+they insert. To keep bundles between runs so that they don't
+have to be made again, set a size limit in MB in your hgrc:
+
+[infocalypse]
+bundlestore = 256
+
+The bundles are kept in the bundles directory under tmp_dir.
+The least recently used ones are removed first.
+
+BUNDLE WORKERS:
+By default bundles are made one at a time, just before they
+are inserted. To make them in other processes while earlier
+ones are being inserted, set the number of processes:
+
+[infocalypse]
+bundleworkers = 2
+
+BINARY GRAPH:
+fn-create and fn-push insert the update graph as text by
+default. The binary format is smaller and faster to parse,
+but older versions of infocalypse can't read it, so only
+turn it on if everyone pulling from your repo has upgraded:
+
+[infocalypse]
+binarygraph = True
+
+PIPELINED RETRIES:
+By default fn-pull waits for every request in a round to
+finish before it retries the ones which failed. To retry
+failed requests while slow ones are still running, each
+after a backoff that doubles with every retry, set:
+
+[infocalypse]
+pipelinedretries = True
+
+POLLED SOCKET:
+infocalypse waits on its FCP connections with select(). If
+that doesn't work on your platform, you can make it poll
+them once a second instead:
+
+[infocalypse]
+polledsocket = True
+
+PACK TOP KEY:
+By default fn-create and fn-push put the latest updates into
+the top key. To choose the updates which save the most
+simulated pull time and fill the top key up to its size
+limit instead, set:
+
+[infocalypse]
+packtopkey = True
+
+COST MODEL:
+fn-pull picks the updates with the fewest blocks to fetch. To
+pick them with one of the other edge cost functions fn-info
+--cost-model reports, set its name, blocks, latency or
+redundancy:
+
+[infocalypse]
+costmodel = latency
+
 MORE DOCUMENTATION:
 See doc/infocalypse_howto.html in the directory this
 extension was installed into.
@@ -454,9 +537,17 @@ cmdtable = {
                     b"[options]"),
 
     b"fn-info": (fncommands.infocalypse_info,
-                 [(b'', b'uri', b'', b'request URI'),],
+                 [(b'', b'uri', b'', b'request URI'),
+                  (b'', b'cost-model', None, b'fetch the graph and show '
+                   b'what updates cost'),],
                 b"[options]"),
 
+    b"fn-trace": (fncommands.infocalypse_trace,
+                  [(b'', b'file', b'', b'trace file, defaults to the '
+                    b'tracefile option in [infocalypse]'),
+                   (b'', b'last', None, b'only summarize the last run'),],
+                  b"[options]"),
+
 
     b"fn-fmsread": (fncommands.infocalypse_fmsread,
                    [(b'', b'uri', b'', b'request URI'),
@@ -561,6 +652,7 @@ try:
     commands.norepo += ' fn-setupwot'
     commands.norepo += ' fn-setupfreemail'
     commands.norepo += ' fn-updaterepolist'
+    commands.norepo += ' fn-trace'
 except AttributeError as e: # Mercurial 3.8 API change
     for i in cmdtable:
         cmdtable[i][0].norepo = False
@@ -574,6 +666,7 @@ except AttributeError as e: # Mercurial 3.8 API change
     fncommands.infocalypse_genkey.norepo = True
     fncommands.infocalypse_archive.norepo = True
     fncommands.infocalypse_update_repo_list.norepo = True
+    fncommands.infocalypse_trace.norepo = True
 
 
 ## Wrap core commands for use with freenet keys.
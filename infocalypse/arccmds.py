@@ -55,7 +55,7 @@ def arc_cleanup(update_sm, top_key_state=None):
 
     # Previous cleanup code.
     if not update_sm.runner is None:
-        update_sm.runner.connection.close()
+        update_sm.runner.close()
 
     if not update_sm.ctx.bundle_cache is None:
         update_sm.ctx.bundle_cache.remove_files() # Unreachable???
@@ -29,6 +29,7 @@ from .fcpconnection import make_id, SUCCESS_MSGS, sha1_hexdigest
 from .fcpclient import get_version, get_usk_hash, get_usk_for_usk_version, \
      is_usk
 from .fcpmessage import GET_DEF, PUT_FILE_DEF
+from .requestqueue import PRIORITY_REDUNDANT
 
 from .statemachine import StateMachine, State, DecisionState, \
      RetryingRequestList, CandidateRequest
@@ -40,8 +41,8 @@ from .archivetop import top_key_tuple_to_bytes, default_out
 from .chk import clear_control_bytes
 from .graph import FREENET_BLOCK_LEN, MAX_METADATA_HACK_LEN
 
-TMP_DIR = "__TMP__"
-BLOCK_DIR = "__TMP_BLOCKS__"
+TMP_DIR = b"__TMP__"
+BLOCK_DIR = b"__TMP_BLOCKS__"
 
 ARC_MIME_TYPE = 'application/archive-block'
 ARC_MIME_TYPE_FMT = ARC_MIME_TYPE + ';%i'
@@ -329,6 +330,9 @@ class InsertingRedundantBlocks(RetryingRequestList):
         request = CandidateRequest(self.parent)
         request.tag = str(candidate) # Hmmm
         request.candidate = candidate
+        if candidate[1] != 0:
+            # Padded redundant copy of the block.
+            request.priority = PRIORITY_REDUNDANT
         request.in_params.fcp_params = self.parent.params.copy()
 
         request.in_params.definition = PUT_FILE_DEF
@@ -781,6 +785,9 @@ class RequestingRedundantBlocks(RetryingRequestList):
         request = CandidateRequest(self.parent)
         request.tag = str(candidate) # Hmmm
         request.candidate = candidate
+        if candidate[1] != 0:
+            # Redundant copy of the block.
+            request.priority = PRIORITY_REDUNDANT
         request.in_params.fcp_params = self.parent.params.copy()
 
         request.in_params.definition = GET_DEF
@@ -24,9 +24,14 @@ import os
 import shutil
 import random
 
-from mercurial import commands
+from collections import OrderedDict
+from hashlib import sha1
 
-from .fcpconnection import sha1_hexdigest
+from binascii import unhexlify
+
+from mercurial import changegroup, commands, discovery, util
+
+from .fcpconnection import IDataSource, READ_BLOCK, sha1_hexdigest
 
 from .graph import FIRST_INDEX, FREENET_BLOCK_LEN, MAX_REDUNDANT_LENGTH
 from .graphutil import get_rollup_bounds
@@ -59,6 +64,363 @@ class BundleException(Exception):
     def __init__(self, msg):
         Exception.__init__(self, msg)
 
+# Default size bound for a BundleStore in bytes.
+STORE_MAX_BYTES = 256 * 1024 * 1024
+
+# Name of the BundleStore index file.
+STORE_INDEX = b'index'
+
+# Rewrite the index when it has more than COMPACT_RATIO lines
+# per entry, plus COMPACT_MIN.
+COMPACT_RATIO = 4
+COMPACT_MIN = 64
+
+COPY_CHUNK_LEN = 64 * 1024
+
+def bundle_key(parents, heads, salt):
+    """ Returns the BundleStore key for the bundle made from the
+        parent and head revs.
+
+        salt should change whenever the same revs could give a
+        different bundle, e.g. with another version of Mercurial. """
+    return sha1_hexdigest(b' '.join(sorted(parents)) + b'|'
+                          + b' '.join(sorted(heads)) + b'|' + salt)
+
+def copy_file(in_name, out_name):
+    """ INTERNAL: Copy a file, returning the SHA1 hexdigest of its
+        contents. Doesn't copy if out_name is None. """
+    digest = sha1()
+    in_file = open(in_name, 'rb')
+    out_file = None
+    try:
+        if not out_name is None:
+            out_file = open(out_name, 'wb')
+        while True:
+            chunk = in_file.read(COPY_CHUNK_LEN)
+            if not chunk:
+                break
+            digest.update(chunk)
+            if not out_file is None:
+                out_file.write(chunk)
+    finally:
+        in_file.close()
+        if not out_file is None:
+            out_file.close()
+    return digest.hexdigest().encode('utf-8')
+
+class BundleStore:
+    """ A persistent, size bounded store of hg bundle files.
+
+        Bundles are looked up by a bundle_key() made from the parent
+        and head revs they were made from, so later pushes and
+        reinserts can reuse them instead of running hg bundle again.
+        The CHKs each bundle was inserted under are kept too.
+
+        Files are named by the SHA1 of their contents, which is
+        checked whenever a bundle is copied out of the store. The
+        least recently used bundles are removed when the files take
+        up more than max_bytes.
+
+        The index is an append only log of text lines, rewritten when
+        it gets too long.
+    """
+    def __init__(self, base_dir, max_bytes=STORE_MAX_BYTES):
+        self.base_dir = os.path.abspath(base_dir)
+        self.max_bytes = max_bytes
+        # key -> [digest, length, {ordinal -> chk}], least recently
+        # used first.
+        self.entries = OrderedDict()
+        # digest -> number of entries for the file
+        self.refs = {}
+        self.total_bytes = 0
+        self.log_lines = 0
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(self.base_dir):
+            os.makedirs(self.base_dir)
+        self.load()
+
+    def index_path(self):
+        """ INTERNAL: The full path to the index file. """
+        return os.path.join(self.base_dir, STORE_INDEX)
+
+    def file_path(self, digest):
+        """ INTERNAL: The full path to the file with digest. """
+        return os.path.join(self.base_dir, digest + b'.hg')
+
+    def load(self):
+        """ INTERNAL: Read the index and remove files it doesn't
+            reference. """
+        index_name = self.index_path()
+        if os.path.exists(index_name):
+            in_file = open(index_name, 'rb')
+            try:
+                for line in in_file:
+                    self.log_lines += 1
+                    try:
+                        self.apply(line.split())
+                    except (IndexError, KeyError, ValueError):
+                        # i.e. A truncated last line after a crash.
+                        pass
+            finally:
+                in_file.close()
+
+        for name in os.listdir(self.base_dir):
+            if name.endswith(b'.hg') and not name[:-3] in self.refs:
+                os.remove(os.path.join(self.base_dir, name))
+            elif name.endswith(b'.tmp'):
+                os.remove(os.path.join(self.base_dir, name))
+        self.compact()
+
+    def apply(self, fields):
+        """ INTERNAL: Update the entries for an index line. """
+        key = fields[1]
+        if fields[0] == b'put':
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = [fields[2], int(fields[3]), {}]
+            self.add_ref(fields[2], int(fields[3]))
+        elif fields[0] == b'use':
+            self.entries.move_to_end(key)
+        elif fields[0] == b'chk':
+            self.entries[key][2][int(fields[2])] = fields[3]
+        elif fields[0] == b'drop':
+            self.remove(key)
+        else:
+            raise ValueError("Unknown index line: %s" % fields[0])
+
+    def add_ref(self, digest, length):
+        """ INTERNAL: Count an entry for a file. """
+        count = self.refs.get(digest, 0)
+        if count == 0:
+            self.total_bytes += length
+        self.refs[digest] = count + 1
+
+    def remove(self, key, delete_file=False):
+        """ INTERNAL: Remove an entry, deleting its file if no other
+            entry uses it and delete_file is set. """
+        digest, length = self.entries.pop(key)[:2]
+        self.refs[digest] -= 1
+        if self.refs[digest] > 0:
+            return
+        del self.refs[digest]
+        self.total_bytes -= length
+        if delete_file and os.path.exists(self.file_path(digest)):
+            os.remove(self.file_path(digest))
+
+    def log(self, fields):
+        """ INTERNAL: Append a line to the index. """
+        # REDFLAG: Lines from concurrent runs sharing a store can
+        #          interleave. Each line is written with one call.
+        out_file = open(self.index_path(), 'ab')
+        try:
+            out_file.write(b' '.join(fields) + b'\n')
+        finally:
+            out_file.close()
+        self.log_lines += 1
+        if self.log_lines > COMPACT_RATIO * len(self.entries) + COMPACT_MIN:
+            self.compact()
+
+    def compact(self):
+        """ INTERNAL: Rewrite the index with one line per entry and
+            CHK. """
+        lines = []
+        for key, entry in self.entries.items():
+            lines.append(b'put %s %s %i\n' % (key, entry[0], entry[1]))
+            for ordinal in sorted(entry[2]):
+                lines.append(b'chk %s %i %s\n' % (key, ordinal,
+                                                   entry[2][ordinal]))
+        tmp_name = self.index_path() + b'.tmp'
+        out_file = open(tmp_name, 'wb')
+        try:
+            out_file.write(b''.join(lines))
+        finally:
+            out_file.close()
+        # Don't leave a half written file behind.
+        os.replace(tmp_name, self.index_path())
+        self.log_lines = len(lines)
+
+    def drop(self, key):
+        """ Remove the bundle for key from the store. """
+        if key in self.entries:
+            self.remove(key, True)
+            self.log((b'drop', key))
+
+    def lookup(self, key):
+        """ Returns a (file_name, length, {ordinal -> chk}) tuple for
+            key or None if it isn't stored.
+
+            Only the length of the file is checked. """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        file_name = self.file_path(entry[0])
+        if (not os.path.exists(file_name) or
+            os.path.getsize(file_name) != entry[1]):
+            self.drop(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        if key != next(reversed(self.entries)):
+            self.entries.move_to_end(key)
+            self.log((b'use', key))
+        return (file_name, entry[1], entry[2])
+
+    def copy_bundle(self, key, out_file=None):
+        """ Copy the bundle for key to out_file and return its length,
+            or None if it isn't stored or its contents are wrong.
+
+            Only returns the length if out_file is None. """
+        found = self.lookup(key)
+        if found is None:
+            return None
+        if out_file is None:
+            return found[1]
+        raised = True
+        try:
+            digest = copy_file(found[0], out_file)
+            raised = False
+        finally:
+            if raised and os.path.exists(out_file):
+                os.remove(out_file)
+        if digest != self.entries[key][0]:
+            os.remove(out_file)
+            self.hits -= 1
+            self.misses += 1
+            self.drop(key)
+            return None
+        return found[1]
+
+    def add(self, key, in_file):
+        """ Store a copy of the bundle file in_file under key. """
+        tmp_name = self.file_path(b'_add') + b'.tmp'
+        try:
+            digest = copy_file(in_file, tmp_name)
+            entry = self.entries.get(key)
+            if not entry is None and entry[0] == digest:
+                return
+            if not digest in self.refs:
+                os.replace(tmp_name, self.file_path(digest))
+        finally:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+        if not entry is None:
+            self.remove(key, True)
+        length = os.path.getsize(self.file_path(digest))
+        self.entries[key] = [digest, length, {}]
+        self.add_ref(digest, length)
+        self.log((b'put', key, digest, b'%i' % length))
+        self.evict()
+
+    def set_chk(self, key, ordinal, chk):
+        """ Remember the CHK the bundle for key was inserted under. """
+        entry = self.entries.get(key)
+        if entry is None or entry[2].get(ordinal) == chk:
+            return
+        entry[2][ordinal] = chk
+        self.log((b'chk', key, b'%i' % ordinal, chk))
+
+    def evict(self):
+        """ INTERNAL: Drop least recently used bundles until the store
+            fits in max_bytes. """
+        while self.total_bytes > self.max_bytes and len(self.entries) > 0:
+            self.drop(next(iter(self.entries)))
+
+class BundleDataSource(IDataSource):
+    """ IDataSource which sends a bundle file followed by pad bytes,
+        without copying the file to add them.
+
+        The length and SHA1 of the data are worked out as it's sent.
+    """
+    def __init__(self, file_name, pad=b''):
+        IDataSource.__init__(self)
+        self.file_name = file_name
+        self.pad = pad
+        self.file = None
+        self.length = None
+        self.sent = 0
+        self.digest = None
+
+    def initialize(self):
+        """ IDataSource implementation. """
+        # Can be sent again if the request is retried.
+        self.file = open(self.file_name, 'rb')
+        self.length = os.fstat(self.file.fileno()).st_size + len(self.pad)
+        self.sent = 0
+        self.digest = sha1()
+
+    def data_length(self):
+        """ IDataSource implementation. """
+        return self.length
+
+    def release(self):
+        """ IDataSource implementation. """
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def read(self):
+        """ IDataSource implementation. """
+        assert self.file
+        data = self.file.read(READ_BLOCK)
+        if not data and self.sent == self.length - len(self.pad):
+            data = self.pad[:self.length - self.sent]
+        if self.sent + len(data) > self.length or (not data and
+                                                   self.sent < self.length):
+            # Don't send something other than DataLength said.
+            raise BundleException("Bundle file changed while sending: %s"
+                                  % self.file_name)
+        self.sent += len(data)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        """ Returns the SHA1 hexdigest of the data sent so far. """
+        return self.digest.hexdigest().encode('utf-8')
+
+# The number of bundles BundleCache.make_redundant_bundle() makes
+# to find out how many earlier changes fit, after the first one.
+MAX_ROLLUP_TRIES = 2
+
+def changegroup_length(repo, parents, heads):
+    """ Returns the length of the uncompressed changegroup with the
+        changes from parents to heads.
+
+        This is much cheaper than making the compressed bundle. """
+    outgoing = discovery.outgoing(repo, [unhexlify(rev) for rev in parents],
+                                  [unhexlify(rev) for rev in heads])
+    length = 0
+    for chunk in changegroup.makestream(repo, outgoing, b'02', b'bundle'):
+        length += len(chunk)
+    return length
+
+class BundleSizeEstimator:
+    """ Predicts the length of an hg bundle from the changegroup_length()
+        of the changes in it.
+
+        Bundle lengths are a straight line through the last two
+        (changegroup length, bundle length) points added. With only
+        one point the line goes through the origin. Since bigger
+        changegroups compress better, that overestimates.
+    """
+    def __init__(self):
+        self.points = []
+
+    def add(self, changes_len, bundle_len):
+        """ Add the length of a bundle that was made. """
+        self.points.append((changes_len, bundle_len))
+
+    def predict(self, changes_len):
+        """ Returns the predicted length of a bundle. """
+        assert len(self.points) > 0
+        x_1, y_1 = self.points[-1]
+        if len(self.points) > 1:
+            x_0, y_0 = self.points[-2]
+            if x_0 != x_1 and (y_1 - y_0) * (x_1 - x_0) > 0:
+                return y_1 + (changes_len - x_1) * (y_1 - y_0) / (x_1 - x_0)
+        return changes_len * y_1 / max(x_1, 1)
+
 class BundleCache:
     """ Class to create hg bundle files and cache information about
         their sizes. """
@@ -71,6 +433,14 @@ class BundleCache:
         self.base_dir = os.path.abspath(base_dir)
         assert is_writable(self.base_dir)
         self.enabled = True
+        # Optional BundleStore which keeps bundles between runs.
+        self.store = None
+        # Bundles from other Mercurial versions may differ.
+        self.salt = b'hg ' + util.version()
+        # index_pair -> BundleStore key
+        self.store_keys = {}
+        # index table entry -> changegroup_length()
+        self.changes_lengths = {}
 
     def get_bundle_path(self, index_pair):
         """ INTERNAL: Get the full path to a bundle file for the given edge. """
@@ -120,6 +490,42 @@ class BundleCache:
             if raised and os.path.exists(out_file):
                 os.remove(out_file)
 
+    def get_bundle_file(self, graph, version_table, index_pair):
+        """ Returns a (length, file_name) tuple for a file with the hg
+            bundle for the edge in graph, making it if required.
+
+            The file is in the cache, so it isn't copied. It's there
+            until remove_files() is called. Don't modify it. """
+        self.graph = graph
+        full_path = self.get_bundle_path(index_pair)
+        if not os.path.exists(full_path):
+            self.make_bundle(graph, version_table, index_pair, full_path)
+        return (os.path.getsize(full_path), full_path)
+
+    def outermost(self, revs):
+        """ INTERNAL: Returns the revs which aren't ancestors of other
+            revs in revs. """
+        numbers = [self.repo[rev].rev() for rev in revs]
+        changelog = self.repo.changelog
+        ret = []
+        for rev, number in zip(revs, numbers):
+            for other in numbers:
+                if other != number and changelog.isancestorrev(number, other):
+                    break
+            else:
+                ret.append(rev)
+        return ret
+
+    def store_key(self, parents, heads):
+        """ INTERNAL: Returns the BundleStore key for a bundle.
+
+            Revs which are ancestors of other revs in the same list
+            don't change the bundle, e.g. the extra heads
+            get_rollup_bounds() returns while graph.update() is
+            adding an index, so they are left out. """
+        return bundle_key(self.outermost(parents), self.outermost(heads),
+                          self.salt)
+
     def make_bundle(self, graph, version_table, index_pair, out_file=None):
         """ Create an hg bundle file corresponding to the edge in graph. """
         #print "INDEX_PAIR:", index_pair
@@ -141,6 +547,16 @@ class BundleCache:
                                                index_pair[1],
                                                version_table)
 
+            if not self.store is None:
+                key = self.store_key(parents, heads)
+                self.store_keys[index_pair] = key
+                file_field = None
+                if not delete_out_file:
+                    file_field = out_file
+                length = self.store.copy_bundle(key, file_field)
+                if not length is None:
+                    return (length, file_field, index_pair)
+
             # Hmmm... ok to suppress mercurial noise here.
             self.ui_.pushbuffer()
             try:
@@ -152,16 +568,36 @@ class BundleCache:
             finally:
                 self.ui_.popbuffer()
 
-            if self.enabled:
-                self.update_cache(index_pair, out_file)
+            if not self.store is None:
+                self.store.add(key, out_file)
+            length = os.path.getsize(out_file)
             file_field = None
             if not delete_out_file:
                 file_field = out_file
-            return (os.path.getsize(out_file), file_field, index_pair)
+            if not self.enabled or out_file == self.get_bundle_path(index_pair):
+                pass
+            elif delete_out_file:
+                # Move it into the cache instead of copying it.
+                os.replace(out_file, self.get_bundle_path(index_pair))
+            else:
+                self.update_cache(index_pair, out_file)
+            return (length, file_field, index_pair)
         finally:
             if delete_out_file and os.path.exists(out_file):
                 os.remove(out_file)
 
+    def changes_length(self, graph, version_table, index):
+        """ INTERNAL: Returns the changegroup_length() of the changes
+            in an index. """
+        entry = graph.index_table[index]
+        length = self.changes_lengths.get(entry)
+        if length is None:
+            parents, heads = get_rollup_bounds(graph, self.repo, index, index,
+                                               version_table)
+            length = changegroup_length(self.repo, parents, heads)
+            self.changes_lengths[entry] = length
+        return length
+
     # INTENT: Freenet stores data in 32K blocks.  If we can stuff
     # extra changes into the bundle file under the block boundry
     # we get extra redundancy for free.
@@ -169,7 +605,11 @@ class BundleCache:
                               out_file=None):
         """ Make an hg bundle file including the changes in the edge and
             other earlier changes if it is possible to fit them under
-            the 32K block size boundry. """
+            the 32K block size boundry.
+
+            The lengths of bundles with earlier changes are predicted
+            with a BundleSizeEstimator, so at most MAX_ROLLUP_TRIES
+            more bundles are made after the one for the edge. """
         self.graph = graph
         #print "make_redundant_bundle -- called for index: ", last_index
 
@@ -177,56 +617,69 @@ class BundleCache:
             #print "make_redundant_bundle -- cache hit: ", last_index
             return self.redundant_table[last_index]
 
-        size_boundry = None
-        prev_length = None
-        earliest_index = last_index - 1
-        while earliest_index >= FIRST_INDEX:
-            pair = (earliest_index, last_index)
-            #print "PAIR:", pair
-            bundle = self.make_bundle(graph,
-                                      version_table,
-                                      pair,
-                                      out_file)
+        bundle = self.make_bundle(graph, version_table,
+                                  (last_index - 1, last_index))
+        assert bundle[0] > 0 # hmmmm
 
-            #print "make_redundant_bundle -- looping: ", earliest_index, \
-            #      last_index, bundle[0]
-            assert bundle[0] > 0 # hmmmm
-
-            if size_boundry is None:
-                size_boundry = ((bundle[0] / FREENET_BLOCK_LEN)
-                                * FREENET_BLOCK_LEN)
-                prev_length = bundle[0]
-                if (bundle[0] % FREENET_BLOCK_LEN) == 0:
-                    # REDFLAG: test this code path
-                    self.redundant_table[bundle[2]] = bundle
-                    return bundle # Falls exactly on a 32k boundry
-                else:
-                    size_boundry += FREENET_BLOCK_LEN
-
-                # Purely to bound the effort spent creating bundles.
-                if bundle[0] > MAX_REDUNDANT_LENGTH:
-                    #print "make_redundant_bundle -- to big for redundancy"
-                    self.redundant_table[bundle[2]] = bundle
-                    return bundle
+        # Purely to bound the effort spent creating bundles.
+        if (bundle[0] % FREENET_BLOCK_LEN != 0 and # Falls on a 32k boundry
+            bundle[0] <= MAX_REDUNDANT_LENGTH):
+            bundle = self.roll_up(graph, version_table, bundle)
 
-            if bundle[0] > size_boundry:
-                earliest_index += 1 # Can only happen after first pass???
-                #print "make_redundant_bundle -- breaking"
-                break
-
-            earliest_index -= 1
-            prev_length = bundle[0]
-
-        bundle =  (prev_length, out_file,
-                   (max(FIRST_INDEX, earliest_index), last_index))
-        #           ^--- possible to fix loop so this is not required?
+        if not out_file is None:
+            bundle = self.make_bundle(graph, version_table, bundle[2],
+                                      out_file)
 
         #print "make_redundant_bundle -- return: ", bundle
-        self.redundant_table[bundle[2]] = bundle
+        self.redundant_table[last_index] = bundle
         return bundle
 
+    def roll_up(self, graph, version_table, first):
+        """ INTERNAL: Returns the bundle which adds the most earlier
+            indices to the first bundle while staying in the same
+            number of 32K blocks. """
+        last_index = first[2][1]
+        size_boundry = (first[0] // FREENET_BLOCK_LEN + 1) * FREENET_BLOCK_LEN
+        estimator = BundleSizeEstimator()
+        best = first
+        best_changes = self.changes_length(graph, version_table, last_index)
+        estimator.add(best_changes, first[0])
+        # Bundles starting at too_big or earlier don't fit.
+        too_big = FIRST_INDEX - 1
+        for dummy in range(MAX_ROLLUP_TRIES):
+            start, changes = best[2][0], best_changes
+            while start - 1 > too_big:
+                # (start - 1, last_index) adds the changes in start.
+                more = changes + self.changes_length(graph, version_table,
+                                                     start)
+                if estimator.predict(more) > size_boundry:
+                    break
+                start -= 1
+                changes = more
+            if start == best[2][0]:
+                break
+            bundle = self.make_bundle(graph, version_table,
+                                      (start, last_index))
+            #print "roll_up -- predicted: ", estimator.predict(changes), \
+            #      " got: ", bundle[0]
+            estimator.add(changes, bundle[0])
+            if bundle[0] > size_boundry:
+                too_big = start
+            else:
+                best, best_changes = bundle, changes
+        return best
+
+    def set_chk(self, index_pair, ordinal, chk):
+        """ Remember the CHK the bundle for an edge was inserted under
+            in the store. """
+        key = self.store_keys.get(index_pair)
+        if not self.store is None and not key is None:
+            self.store.set_chk(key, ordinal, chk)
+
     def remove_files(self):
-        """ Remove cached files. """
+        """ Remove cached files.
+
+            Doesn't touch the files in the store. """
         for name in os.listdir(self.base_dir):
             # Only remove files that we created in case cache_dir
             # is set to something like ~/.
@@ -0,0 +1,182 @@
+""" Build hg bundles in worker processes ahead of the inserts which
+    need them.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+import multiprocessing
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from mercurial import commands, hg, ui
+
+from .graphutil import get_rollup_bounds
+
+# Default bound on the bytes of bundles being built or waiting to be
+# inserted.
+PREBUILD_MAX_BYTES = 64 * 1024 * 1024
+
+# The repository a worker process makes bundles from.
+WORKER_STATE = {}
+
+def init_worker(repo_root):
+    """ INTERNAL: Open the repository in a new worker process. """
+    ui_ = ui.ui.load()
+    ui_.setconfig(b'ui', b'quiet', b'true')
+    WORKER_STATE['ui'] = ui_
+    WORKER_STATE['repo'] = hg.repository(ui_, repo_root)
+
+def build_bundle(parents, heads, out_file):
+    """ INTERNAL: Make a bundle file in a worker process.
+
+        Returns the number of seconds it took. """
+    started = time.time()
+    # Starts with the out_file name so BundleCache.remove_files()
+    # removes it if the worker is killed.
+    tmp_file = out_file + b'.part'
+    ui_ = WORKER_STATE['ui']
+    ui_.pushbuffer()
+    try:
+        commands.bundle(ui_, WORKER_STATE['repo'], tmp_file,
+                        base=parents, rev=heads)
+    finally:
+        ui_.popbuffer()
+    # So no one ever sees a partly written bundle.
+    os.replace(tmp_file, out_file)
+    return time.time() - started
+
+class BundlePool:
+    """ Builds the hg bundle files for a BundleCache in worker
+        processes, so making bundles overlaps inserting them.
+
+        Bundles are started in the order the edges are given until
+        max_bytes of bundles are being built or built and not yet
+        taken for an insert. Workers are forked from this process.
+    """
+    def __init__(self, cache, workers, max_bytes=PREBUILD_MAX_BYTES):
+        self.cache = cache
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.executor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('fork'),
+            initializer=init_worker, initargs=(cache.repo.root, ))
+        # index_pair -> (future, length, BundleStore key)
+        self.building = {}
+        # index_pair -> length, for built bundles not taken yet.
+        self.waiting = {}
+        self.started = time.time()
+        self.busy_secs = 0.0
+        self.built = 0
+        self.failed = 0
+
+    def pending_bytes(self):
+        """ INTERNAL: The bytes of bundles building or waiting. """
+        return (sum([entry[1] for entry in self.building.values()]) +
+                sum(self.waiting.values()))
+
+    def poll(self):
+        """ Collect the bundles the workers finished. """
+        for index_pair in [pair for pair, entry in self.building.items()
+                           if entry[0].done()]:
+            future, length, key = self.building.pop(index_pair)
+            try:
+                self.busy_secs += future.result()
+            except Exception: #pylint: disable-msg=W0703
+                # The bundle is made in this process when it's needed.
+                self.failed += 1
+                continue
+            self.built += 1
+            self.waiting[index_pair] = length
+            if not key is None:
+                self.cache.store.add(key, self.cache.get_bundle_path(
+                    index_pair))
+
+    def prebuild(self, graph, version_table, edges):
+        """ Start building the bundles for edges in order, until
+            max_bytes are building or waiting. """
+        self.cache.graph = graph
+        for edge in edges:
+            index_pair = edge[:2]
+            if index_pair in self.building or index_pair in self.waiting:
+                continue
+            out_file = self.cache.get_bundle_path(index_pair)
+            if os.path.exists(out_file):
+                continue
+            length = graph.get_length(edge)
+            if (len(self.building) >= self.workers or
+                (self.pending_bytes() + length > self.max_bytes and
+                 len(self.building) + len(self.waiting) > 0)):
+                break
+            parents, heads = get_rollup_bounds(graph, self.cache.repo,
+                                               index_pair[0] + 1, # INCLUSIVE
+                                               index_pair[1],
+                                               version_table)
+            key = None
+            if not self.cache.store is None:
+                key = self.cache.store_key(parents, heads)
+                self.cache.store_keys[index_pair] = key
+                if not self.cache.store.copy_bundle(key, out_file) is None:
+                    continue
+            self.building[index_pair] = (
+                self.executor.submit(build_bundle, list(parents), list(heads),
+                                     out_file), length, key)
+
+    def next_ready(self, graph, version_table, edges):
+        """ Returns the first edge in edges whose bundle is already
+            made, the first edge if its bundle isn't being built, or
+            None if the caller should wait for the workers.
+
+            Starts building the bundles for the next edges too. """
+        self.poll()
+        self.prebuild(graph, version_table, edges)
+        if not edges:
+            return None
+        for edge in edges:
+            if (edge[:2] in self.waiting or
+                (not edge[:2] in self.building and
+                 os.path.exists(self.cache.get_bundle_path(edge[:2])))):
+                self.waiting.pop(edge[:2], None)
+                return edge
+        if edges[0][:2] in self.building:
+            return None
+        # A worker failed to make it.
+        return edges[0]
+
+    def utilization(self):
+        """ Returns the fraction of the time since the pool was made
+            that the workers were building bundles. """
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.busy_secs / (elapsed * self.workers)
+
+    def close(self):
+        """ Stop the workers, dropping bundles which aren't started. """
+        self.executor.shutdown(True, cancel_futures=True)
+        self.building = {}
+        self.waiting = {}
+
+def make_bundle_pool(cache, workers, max_bytes=PREBUILD_MAX_BYTES):
+    """ Returns a BundlePool for cache or None if workers is 0 or
+        worker processes can't be forked on this platform. """
+    if workers < 1 or not 'fork' in multiprocessing.get_all_start_methods():
+        return None
+    return BundlePool(cache, workers, max_bytes)
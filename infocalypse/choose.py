@@ -19,13 +19,17 @@
     Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
 """
 
+import bisect
 import random
 import functools
 
 from .graph import MAX_PATH_LEN, block_cost, print_list, canonical_path_itr, \
-     build_version_table
+     build_version_table, PathSolver, FIRST_INDEX, PENDING_INSERT, \
+     PENDING_INSERT1, UpdateGraphException, get_heads
 
 from .graphutil import get_rollup_bounds
+from .topkey import top_key_update_len
+from .costmodel import CostModel, CHK_FAILURE_PROBABILITY
 # This is the maximum allowed ratio of allowed path block cost
 # to minimum full update block cost.
 # It is used in low_block_cost_edges() to determine when a
@@ -123,23 +127,26 @@ def contained_edge_count(edges, index, max_count=None):
 # This code is intended to make sure that we try fetching the
 # first 33k update  before the rollup CHK even though it means
 # fetching more keys.
-def low_block_cost_edges(graph, known_edges, from_index, allowed):
-    """ INTERNAL:  Returns the best update edges that aren't too big. """
+def low_block_cost_edges(graph, known_edges, from_index, allowed,
+                         cost_model=None):
+    """ INTERNAL:  Returns the best update edges that aren't too big.
+
+        The costs come from cost_model, a block cost CostModel
+        by default. """
+    if cost_model is None:
+        cost_model = CostModel(graph)
     # MAX_PATH_LEN - 1.  If it takes more steps you should be using
     # a canonical path.
-    paths = graph.enumerate_update_paths(from_index + 1,
-                                         graph.latest_index, MAX_PATH_LEN - 1)
-    if len(paths) == 0:
+    solver = cost_model.solver(from_index + 1, graph.latest_index)
+    # Only the cheapest path starting with each step matters, so
+    # there's no need to look at every path.
+    with_cost = solver.first_step_costs(MAX_PATH_LEN - 1)
+    if len(with_cost) == 0:
         return []
 
     first = []
 
-    with_cost = []
-    for path in paths:
-        total = 0
-        for step in path:
-            total += block_cost(graph.insert_length(step))
-        with_cost.append((total, path))
+    # Same order as sorting all the paths by cost would give.
     with_cost.sort()
     #for item in with_cost:
     #    print "COST: ", item[0], item
@@ -149,7 +156,7 @@ def low_block_cost_edges(graph, known_edges, from_index, allowed):
     #print "get_update_edges -- min block cost: ", \
     #   with_cost[0][0], allowed_cost
     # First steps of the paths with a cost <= allowed_cost
-    first_steps = [[value[1][0], ] for value in with_cost if value[0]
+    first_steps = [[value[1], ] for value in with_cost if value[0]
                    <= allowed_cost]
     #print "FIRST_STEPS: ", first_steps
     first_steps.sort(key=functools.cmp_to_key(graph.cmp_recency))
@@ -214,9 +221,12 @@ def canonical_path_edges(graph, known_edges, from_index, allowed):
 
 # Returns (first_choice_steps, second_choice_steps)
 def get_update_edges(graph, from_index, redundancy, shuffle_redundancy=False,
-                     known_edges=None):
+                     known_edges=None, cost_model=None):
     """ Gets edges not already in known edges which could be used to
-        update (pull). """
+        update (pull).
+
+        cost_model is the CostModel for low_block_cost_edges(). Reusing
+        one for the same graph saves working out the costs again. """
 
     if known_edges is None:
         known_edges = set([])
@@ -235,7 +245,7 @@ def get_update_edges(graph, from_index, redundancy, shuffle_redundancy=False,
     # 0) First get some low block cost paths.
     # Hmmm... make allowed cheap edges a parameter
     first = low_block_cost_edges(graph, known_edges, from_index,
-                                 min(2, allowed))
+                                 min(2, allowed), cost_model)
 
     allowed -= len(first)
     second = []
@@ -288,49 +298,255 @@ def dump_update_edges(first, second, all_edges):
     print_list("second choice:", second)
     print("---")
 
-def get_top_key_updates(graph, repo, version_table=None):
-    """ Returns the update tuples needed to build the top key."""
+# How many indices behind the latest index clients are when they pull.
+# Half as many clients pull from each PULL_HALF_LIFE indices further back.
+PULL_HALF_LIFE = 4
+# Fraction of pulls which are new clones.
+CLONE_WEIGHT = 0.1
+
+def pull_weights(graph, half_life=PULL_HALF_LIFE, clone_weight=CLONE_WEIGHT):
+    """ Returns an index -> fraction of pulls map for clients which
+        have all the changes up to index.
+
+        FIRST_INDEX is for new clones. Clients more than 16 half lives
+        behind are ignored. """
+    latest = graph.latest_index
+    weights = {}
+    for index in range(max(FIRST_INDEX + 1, latest - 16 * half_life),
+                       latest):
+        weights[index] = 0.5 ** ((latest - 1 - index) / float(half_life))
+    if len(weights) == 0:
+        clone_weight = 1.0
+    total = sum(weights.values())
+    for index in weights:
+        weights[index] *= (1.0 - clone_weight) / total
+    if latest > FIRST_INDEX:
+        weights[FIRST_INDEX] = clone_weight
+    return weights
+
+def graph_pull_steps(graph, indices, max_len=MAX_PATH_LEN + 2):
+    """ Returns an index -> bundle fetch count map for clients which
+        pull using the graph, for each index in indices.
+
+        Clients fetch one edge of the shortest update path at a time.
+        max_len is returned for clients without a path of max_len or
+        fewer edges. """
+    solver = PathSolver(graph, FIRST_INDEX + 1, graph.latest_index)
+    ret = {}
+    for index in indices:
+        ret[index] = max_len
+        for steps in range(1, max_len + 1):
+            if solver.has_path(index + 1, steps):
+                ret[index] = steps
+                break
+    return ret
+
+def top_key_pull_steps(latest_index, top_key_edges, failure):
+    """ INTERNAL: Returns a function which returns the
+        (bundle fetch count, probability of success) for the shortest
+        chain of top_key_edges from an index to latest_index, or None
+        if there's no chain.
+
+        top_key_edges is a list of (start, end, chk_count) tuples. """
+    memo = {}
+    def steps(index):
+        """ INTERNAL: Best chain from index. """
+        if index >= latest_index:
+            return (0, 1.0)
+        if index in memo:
+            return memo[index]
+        best = None
+        for start, end, chk_count in top_key_edges:
+            if not start <= index < end:
+                continue
+            rest = steps(end)
+            if rest is None:
+                continue
+            chain = (rest[0] + 1, rest[1] * (1.0 - failure ** chk_count))
+            if best is None or (chain[0], -chain[1]) < (best[0], -best[1]):
+                best = chain
+        memo[index] = best
+        return best
+    return steps
+
+def simulate_pulls(graph, top_key_edges, weights=None,
+                   failure=CHK_FAILURE_PROBABILITY):
+    """ Replays pulls from the indices in weights and returns the
+        weighted average (FCP round trips, round trips saved) per pull.
+
+        top_key_edges is a list of (start, end, chk_count) tuples for
+        the updates in the top key.
+
+        Every pull fetches the top key first. Clients which can chain
+        top key updates to the latest index fetch those one after
+        the other. The rest, and clients whose top key fetches fail,
+        fetch the graph and then each edge of their update path.
+        Round trips saved are counted against a top key without any
+        updates. """
+    if weights is None:
+        weights = pull_weights(graph)
+    graph_steps = graph_pull_steps(graph, weights)
+    chain_steps = top_key_pull_steps(graph.latest_index, top_key_edges,
+                                     failure)
+    round_trips = 0.0
+    saved = 0.0
+    for index, weight in weights.items():
+        # Top key, graph, bundles.
+        without = 2 + graph_steps[index]
+        expected = without
+        chain = chain_steps(index)
+        if not chain is None and 1 + chain[0] < without:
+            expected = (chain[1] * (1 + chain[0])
+                        + (1.0 - chain[1]) * without)
+        round_trips += weight * expected
+        saved += weight * (without - expected)
+    return (round_trips, saved)
+
+def top_key_chks(graph, pair):
+    """ Returns the CHKs of an edge which can go in the top key. """
+    return [chk for chk in graph.edge_table[pair][1:]
+            if not chk in (PENDING_INSERT, PENDING_INSERT1)]
+
+def top_key_edge_len(graph, pair, chk_count, head_count=None):
+    """ Returns an estimate of the length of the top key update
+        for an edge.
+
+        The parents are estimated from the first index in the
+        edge and the heads from the last one, unless head_count
+        is set. """
+    parent_count = len(graph.index_table[pair[0] + 1][0])
+    if head_count is None:
+        head_count = len(graph.index_table[pair[1]][1])
+    return top_key_update_len(parent_count, head_count, chk_count)
+
+def pack_top_key_edges(graph, max_len, weights=None, head_count=None,
+                       failure=CHK_FAILURE_PROBABILITY):
+    """ Choose the edges and how many of their CHKs to put in a top
+        key with max_len bytes for updates.
+
+        This is a bounded knapsack problem. Each CHK of an edge is an
+        item with the length it adds to the top key, and the value
+        is the expected number of FCP round trips saved, as counted
+        by simulate_pulls(). The first update must end at the latest
+        index and carries all head_count heads.
+
+        Candidates are the edges on the canonical path and those
+        which clients in weights can pull from.
+
+        Returns (expected round trips saved, [(start, end, chk_count),
+        ...]) with the most recent update first, or (0.0, []) if no
+        edge to the latest index fits. """
+    latest = graph.latest_index
+    if weights is None:
+        weights = pull_weights(graph)
+    if head_count is None:
+        head_count = len(get_heads(graph))
+    graph_steps = graph_pull_steps(graph, weights)
+    clients = sorted(weights)
+
+    pairs = set([])
+    try:
+        for edge in graph.canonical_path(latest, MAX_PATH_LEN):
+            pairs.add(edge[:2])
+    except UpdateGraphException:
+        pass
+    for index in clients:
+        for edge in graph.contain(index + 1):
+            pairs.add(edge[:2])
+    candidates = []
+    for pair in sorted(pairs, reverse=True):
+        chk_count = len(top_key_chks(graph, pair))
+        if chk_count > 0:
+            lengths = [top_key_edge_len(graph, pair, count + 1,
+                                        (None, head_count)[pair[1] == latest])
+                       for count in range(chk_count)]
+            candidates.append((pair, lengths))
+
+    # (reached, remaining, depth) -> (value, chain)
+    memo = {}
+    def best(reached, remaining, depth):
+        """ INTERNAL: Best chain for the clients before reached, when
+            the ones from reached on pull with depth updates. """
+        key = (reached, remaining, depth)
+        if key in memo:
+            return memo[key]
+        ret = (0.0, ())
+        for pair, lengths in candidates:
+            if not pair[0] < reached <= pair[1]:
+                continue
+            served = 0.0
+            for index in clients[bisect.bisect_left(clients, pair[0]):
+                                 bisect.bisect_left(clients, reached)]:
+                served += weights[index] * max(0, graph_steps[index]
+                                               - depth)
+            for count, length in enumerate(lengths):
+                if length > remaining:
+                    break
+                value, chain = best(pair[0], remaining - length, depth + 1)
+                value = (1.0 - failure ** (count + 1)) * (served + value)
+                if value > ret[0] or (depth == 0 and len(ret[1]) == 0):
+                    ret = (value, ((pair[0], pair[1], count + 1),) + chain)
+        memo[key] = ret
+        return ret
+
+    value, chain = best(latest, max_len, 0)
+    return (value, list(chain))
+
+def get_top_key_updates(graph, repo, version_table=None, max_len=None):
+    """ Returns the update tuples needed to build the top key.
+
+        If max_len is set, pack_top_key_edges() chooses the edges
+        and CHKs for at most max_len bytes of updates. Otherwise
+        the graph.get_top_key_edges() edges are used with all their
+        CHKs. """
 
     graph.rep_invariant()
 
-    edges = graph.get_top_key_edges()
+    if version_table is None:
+        version_table = build_version_table(graph, repo)
+
+    # Stuff additional remote heads into first update.
+    result = get_rollup_bounds(graph,
+                               repo,
+                               0,
+                               graph.latest_index,
+                               version_table)
 
     coalesced_edges = []
-    ordinals = {}
-    for edge in edges:
-        assert edge[2] >= 0 and edge[2] < 2
-        assert edge[2] == 0 or (edge[0], edge[1], 0) in edges
-        ordinal = ordinals.get(edge[:2])
-        if ordinal is None:
-            ordinal = 0
-            coalesced_edges.append(edge[:2])
-        ordinals[edge[:2]] = max(ordinal,  edge[2])
+    if not max_len is None:
+        for start, end, chk_count in pack_top_key_edges(graph, max_len, None,
+                                                        len(result[1]))[1]:
+            coalesced_edges.append(((start, end),
+                                    tuple(top_key_chks(graph, (start, end))
+                                          [:chk_count])))
+
+    if len(coalesced_edges) == 0:
+        edges = graph.get_top_key_edges()
+
+        ordinals = {}
+        for edge in edges:
+            assert edge[2] >= 0 and edge[2] < 2
+            assert edge[2] == 0 or (edge[0], edge[1], 0) in edges
+            ordinal = ordinals.get(edge[:2])
+            if ordinal is None:
+                ordinal = 0
+                coalesced_edges.append((edge[:2], graph.edge_table[edge[:2]]
+                                        [1:]))
+            ordinals[edge[:2]] = max(ordinal,  edge[2])
 
-    if version_table is None:
-        version_table = build_version_table(graph, repo)
     ret = []
-    for edge in coalesced_edges:
+    for edge, chks in coalesced_edges:
         parents, latest = get_rollup_bounds(graph, repo,
                                              edge[0] + 1, edge[1],
                                              version_table)
 
         length = graph.get_length(edge)
-        assert len(graph.edge_table[edge][1:]) > 0
+        assert len(chks) > 0
 
         #(length, parent_rev, latest_rev, (CHK, ...))
-        update = (length, parents, latest,
-                  graph.edge_table[edge][1:],
-                  True, True)
+        update = (length, parents, latest, chks, True, True)
         ret.append(update)
 
-
-    # Stuff additional remote heads into first update.
-    result = get_rollup_bounds(graph,
-                               repo,
-                               0,
-                               graph.latest_index,
-                               version_table)
-
     for head in ret[0][2]:
         if not head in result[1]:
             print("Expected head not in all_heads!", head[:12])
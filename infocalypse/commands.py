@@ -10,6 +10,7 @@ execute_setup = infcmds.execute_setup
 execute_copy = infcmds.execute_copy
 execute_reinsert = infcmds.execute_reinsert
 execute_info = infcmds.execute_info
+execute_trace = infcmds.execute_trace
 
 
 
@@ -355,9 +356,26 @@ def infocalypse_info(ui_, repo, **opts):
             return
 
     params['REQUEST_URI'] = request_uri
+    params['COST_MODEL_REPORT'] = bool(opts['cost_model'])
     execute_info(ui_, repo, params, stored_cfg)
 
 
+def infocalypse_trace(ui_, **opts):
+    """ Print percentiles from a request trace file.
+
+    Set tracefile in the [infocalypse] section of your hgrc to
+    trace the FCP requests made by the other fn-* commands.
+    """
+    params = {}
+    trace_file = ui_.config(b'infocalypse', b'tracefile', None)
+    if opts['file']:
+        trace_file = opts['file']
+    if trace_file:
+        params['TRACE_FILE'] = os.path.expanduser(trace_file.decode('utf-8'))
+    params['TRACE_LAST_RUN'] = bool(opts['last'])
+    execute_trace(ui_, params)
+
+
 def parse_trust_args(params, opts):
     """ INTERNAL: Helper function to parse  --hash and --fmsid. """
     if not opts.get('hash', []):
@@ -641,7 +659,7 @@ def do_archive_create(ui_, opts, params, stored_cfg):
         raise error.Abort(b"Please set the insert URI with --uri.")
 
     params['INSERT_URI'] = insert_uri
-    params['FROM_DIR'] = os.getcwd()
+    params['FROM_DIR'] = os.getcwdb()
     execute_arc_create(ui_, params, stored_cfg)
 
 
@@ -657,7 +675,7 @@ def do_archive_push(ui_, opts, params, stored_cfg):
             raise error.Abort(b"No Insert URI.")
 
     params['INSERT_URI'] = insert_uri
-    params['FROM_DIR'] = os.getcwd()
+    params['FROM_DIR'] = os.getcwdb()
 
     execute_arc_push(ui_, params, stored_cfg)
 
@@ -675,7 +693,7 @@ def do_archive_pull(ui_, opts, params, stored_cfg):
             raise error.Abort(b"No request URI.")
 
     params['REQUEST_URI'] = request_uri
-    params['TO_DIR'] = os.getcwd()
+    params['TO_DIR'] = os.getcwdb()
     execute_arc_pull(ui_,  params, stored_cfg)
 
 ILLEGAL_FOR_REINSERT = ('uri', 'aggressive', 'nosearch')
@@ -697,7 +715,7 @@ def do_archive_reinsert(ui_, opts, params, stored_cfg):
     insert_uri = stored_cfg.get_dir_insert_uri(params['ARCHIVE_CACHE_DIR'])
     params['REQUEST_URI'] = request_uri
     params['INSERT_URI'] = insert_uri
-    params['FROM_DIR'] = os.getcwd()  # hmmm not used.
+    params['FROM_DIR'] = os.getcwdb()  # hmmm not used.
     params['REINSERT_LEVEL'] = 3
     execute_arc_reinsert(ui_, params, stored_cfg)
 
@@ -705,7 +723,7 @@ ARCHIVE_SUBCMDS = {'create': do_archive_create,
                    'push': do_archive_push,
                    'pull': do_archive_pull,
                    'reinsert': do_archive_reinsert}
-ARCHIVE_CACHE_DIR = '.ARCHIVE_CACHE'
+ARCHIVE_CACHE_DIR = b'.ARCHIVE_CACHE'
 
 
 def infocalypse_archive(ui_, **opts):
@@ -720,7 +738,8 @@ def infocalypse_archive(ui_, **opts):
         subcmd = "pull"
 
     params, stored_cfg = get_config_info(ui_, opts)
-    params['ARCHIVE_CACHE_DIR'] = os.path.join(os.getcwd(), ARCHIVE_CACHE_DIR)
+    params['ARCHIVE_CACHE_DIR'] = os.path.join(os.getcwdb(),
+                                               ARCHIVE_CACHE_DIR)
 
     if not subcmd in ARCHIVE_SUBCMDS:
         raise error.Abort(("Unhandled subcommand: " + subcmd).encode("utf-8"))
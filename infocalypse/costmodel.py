@@ -0,0 +1,206 @@
+""" Cached costs for planning update paths through an UpdateGraph.
+
+    CostModel remembers the cost of each edge and the cheapest
+    path costs PathSolver works out, so planning the next fetch
+    after each bundle arrives doesn't start from scratch. The cost
+    of fetching an edge is pluggable, so planners can trade the
+    number of fetches against the number of bytes fetched.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+from .graph import FIRST_INDEX, MAX_PATH_LEN, PathSolver, block_cost
+
+# Probability that fetching a single CHK fails.
+CHK_FAILURE_PROBABILITY = 0.1
+
+# What starting a fetch costs in 32K blocks, for latency_edge_cost().
+FETCH_COST_BLOCKS = 4
+
+def block_edge_cost(graph, edge):
+    """ The number of 32K blocks fetched for an edge. """
+    return block_cost(graph.insert_length(edge))
+
+def latency_edge_cost(fetch_cost=FETCH_COST_BLOCKS):
+    """ Returns an edge cost function which charges fetch_cost blocks
+        for each fetch on top of the blocks fetched, so that fewer,
+        bigger fetches win. """
+    def cost(graph, edge):
+        """ INTERNAL: The edge cost function. """
+        return fetch_cost + block_edge_cost(graph, edge)
+    return cost
+
+def redundancy_edge_cost(failure=CHK_FAILURE_PROBABILITY):
+    """ Returns an edge cost function for the expected number of blocks
+        fetched when a fetch fails with probability failure and is
+        retried until one of the edge's CHKs works. Edges with
+        redundant CHKs are cheaper. """
+    def cost(graph, edge):
+        """ INTERNAL: The edge cost function. """
+        chk_count = len(graph.edge_table[edge[:2]]) - 1
+        return block_edge_cost(graph, edge) / (1.0 - failure ** chk_count)
+    return cost
+
+# name -> function which makes an edge cost function.
+COST_FUNCS = {'blocks':lambda: block_edge_cost,
+              'latency':latency_edge_cost,
+              'redundancy':redundancy_edge_cost}
+
+class CostModel:
+    """ Caches edge costs and cheapest path costs for an UpdateGraph.
+
+        edge_cost(graph, edge_triple) returns the cost of fetching an
+        edge, block_edge_cost() by default.
+
+        Edge costs are cached along with the edge table entry they
+        were worked out from, so only new and changed edges are
+        costed again. The PathSolvers returned by solver() share
+        their memos for each to_index until the edge table changes.
+    """
+    def __init__(self, graph, edge_cost=None):
+        if edge_cost is None:
+            edge_cost = block_edge_cost
+        self.graph = graph
+        self.edge_cost = edge_cost
+        # edge triple -> (edge table entry, cost)
+        self.edge_costs = {}
+        # to_index -> PathSolver
+        self.solvers = {}
+        # block count -> number of CHKs, or None
+        self.histogram = None
+        # (edge table, version) that solvers and histogram are for.
+        self.table_version = None
+        self.hits = 0
+        self.misses = 0
+
+    def cost(self, edge):
+        """ Returns the cost of fetching an edge. """
+        entry = self.graph.edge_table.get(edge[:2])
+        cached = self.edge_costs.get(edge)
+        if not cached is None and cached[0] is entry:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        value = self.edge_cost(self.graph, edge)
+        self.edge_costs[edge] = (entry, value)
+        return value
+
+    def path_cost(self, path):
+        """ Returns the sum of the costs of the edges in path. """
+        value = 0
+        for edge in path:
+            value += self.cost(edge)
+        return value
+
+    def check_version(self):
+        """ INTERNAL: Drop the path costs if the edge table changed. """
+        table = self.graph.edge_table
+        version = (table, getattr(table, 'version', None))
+        if version[1] is None or version != self.table_version:
+            self.solvers = {}
+            self.histogram = None
+            self.table_version = version
+
+    def solver(self, from_index, to_index=None):
+        """ Returns a PathSolver using this model's costs which shares
+            memos with the earlier ones for to_index. """
+        if to_index is None:
+            to_index = self.graph.latest_index
+        self.check_version()
+        solver = self.solvers.get(to_index)
+        if solver is None:
+            solver = PathSolver(self.graph, from_index, to_index, self.cost)
+            self.solvers[to_index] = solver
+            return solver
+        return solver.for_start(from_index)
+
+    def block_histogram(self):
+        """ Returns a block count -> number of CHKs dictionary for
+            the edges in the graph. """
+        self.check_version()
+        if self.histogram is None:
+            self.histogram = {}
+            for pair, edge_info in self.graph.edge_table.items():
+                for ordinal in range(len(edge_info) - 1):
+                    blocks = block_edge_cost(self.graph, pair + (ordinal, ))
+                    self.histogram[blocks] = self.histogram.get(blocks, 0) + 1
+        return self.histogram
+
+def make_cost_model(graph, name=None):
+    """ Returns a CostModel using the COST_FUNCS edge cost function
+        called name, or block_edge_cost() if name is None. """
+    if name is None:
+        return CostModel(graph)
+    if not name in COST_FUNCS:
+        raise ValueError("Unknown cost model: %s" % name)
+    return CostModel(graph, COST_FUNCS[name]())
+
+def histogram_buckets(histogram):
+    """ INTERNAL: Returns a list of (low, high, count) tuples for
+        power of two ranges of block counts. """
+    buckets = []
+    low = 1
+    remaining = sum(histogram.values())
+    while remaining > 0:
+        high = low * 2 - 1
+        count = sum([value for blocks, value in histogram.items()
+                     if low <= blocks <= high])
+        buckets.append((low, high, count))
+        remaining -= count
+        low = high + 1
+    return buckets
+
+def cost_model_report(graph, max_len=MAX_PATH_LEN):
+    """ Returns a list of text lines describing the CHK sizes in a
+        graph and the cheapest update paths for each cost function. """
+    model = CostModel(graph)
+    histogram = model.block_histogram()
+    lines = ["Edges: %i, CHKs: %i, latest index: %i" %
+             (len(graph.edge_table), sum(histogram.values()),
+              graph.latest_index),
+             "CHK sizes in 32K blocks:"]
+    for low, high, count in histogram_buckets(histogram):
+        label = str(low)
+        if high > low:
+            label = '%i-%i' % (low, high)
+        lines.append("   %-12s %6i" % (label, count))
+
+    lines.append("Cheapest update path from:")
+    lines.append('   %-10s' % '' + ''.join(['%14s' % name for name in
+                                            sorted(COST_FUNCS)]))
+    # FIRST_INDEX is a new clone.
+    starts = [index for index in (FIRST_INDEX, graph.latest_index - 16,
+                                  graph.latest_index - 4,
+                                  graph.latest_index - 1)
+              if FIRST_INDEX <= index < graph.latest_index]
+    models = [make_cost_model(graph, name) for name in sorted(COST_FUNCS)]
+    for index in sorted(set(starts)):
+        cells = []
+        for model in models:
+            solver = model.solver(index + 1)
+            cost_and_path = next(solver.cheapest_paths(max_len), None)
+            if cost_and_path is None:
+                cells.append('%14s' % 'no path')
+                continue
+            cells.append('%14s' % ('%.1f/%i' % (cost_and_path[0],
+                                                len(cost_and_path[1]))))
+        lines.append('   %-10s' % ('new clone', 'index %i' % index)
+                     [index != FIRST_INDEX] + ''.join(cells))
+    lines.append("(cost/number of fetches, costs in 32K blocks)")
+    return lines
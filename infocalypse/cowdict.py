@@ -0,0 +1,148 @@
+""" A dictionary which can be copied in constant time.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+from collections.abc import MutableMapping
+
+# Number of dicts the entries are spread over. A write after a copy()
+# copies about 1/BUCKETS of the entries.
+BUCKETS = 64
+
+class CowDict(MutableMapping):
+    """ A dictionary with a copy-on-write copy() method.
+
+        The entries are spread over BUCKETS smaller dicts by key
+        hash. copy() shares the buckets between both copies, and
+        the first write to a shared bucket copies just that bucket.
+
+        Iterates in insertion order like dict does.
+    """
+    def __init__(self, *args, **kwargs):
+        # key -> (insertion ordinal, value)
+        self.buckets = [{} for dummy in range(BUCKETS)]
+        # True for the buckets only this instance references.
+        self.owned = [True] * BUCKETS
+        self.length = 0
+        self.sequence = 0
+        # Cached list of keys in insertion order, or None.
+        self.order = None
+        # False if order is shared with a copy.
+        self.owns_order = True
+        self.update(*args, **kwargs)
+
+    def writable(self, key):
+        """ INTERNAL: Returns the bucket for key, copying it first if
+            it's shared. """
+        index = hash(key) % BUCKETS
+        if not self.owned[index]:
+            self.buckets[index] = dict(self.buckets[index])
+            self.owned[index] = True
+        return self.buckets[index]
+
+    def __getitem__(self, key):
+        return self.buckets[hash(key) % BUCKETS][key][1]
+
+    def __contains__(self, key):
+        return key in self.buckets[hash(key) % BUCKETS]
+
+    def get(self, key, default=None):
+        """ Implementation of dict method. """
+        entry = self.buckets[hash(key) % BUCKETS].get(key)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def __setitem__(self, key, value):
+        bucket = self.writable(key)
+        entry = bucket.get(key)
+        if entry is None:
+            bucket[key] = (self.sequence, value)
+            self.sequence += 1
+            self.length += 1
+            if not self.order is None:
+                if not self.owns_order:
+                    self.order = list(self.order)
+                    self.owns_order = True
+                self.order.append(key)
+        else:
+            bucket[key] = (entry[0], value)
+
+    def __delitem__(self, key):
+        del self.writable(key)[key]
+        self.length -= 1
+        self.order = None
+
+    def ordered_keys(self):
+        """ INTERNAL: Returns the list of keys in insertion order.
+
+            Cached until a key is deleted. Don't modify it. """
+        if self.order is None:
+            entries = []
+            for bucket in self.buckets:
+                entries += [(entry[0], key) for key, entry in bucket.items()]
+            # Ordinals are unique so keys are never compared.
+            entries.sort()
+            self.order = [entry[1] for entry in entries]
+            self.owns_order = True
+        return self.order
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        """ Implementation of dict method. Returns a list. """
+        return list(self.ordered_keys())
+
+    def values(self):
+        """ Implementation of dict method. Returns a list. """
+        return [self[key] for key in self.ordered_keys()]
+
+    def items(self):
+        """ Implementation of dict method. Returns a list. """
+        return [(key, self[key]) for key in self.ordered_keys()]
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
+
+    def ordinal(self, key):
+        """ Returns a number which orders key by when it was inserted. """
+        return self.buckets[hash(key) % BUCKETS][key][0]
+
+    def clear(self):
+        """ Implementation of dict method. """
+        self.buckets = [{} for dummy in range(BUCKETS)]
+        self.owned = [True] * BUCKETS
+        self.length = 0
+        self.order = None
+
+    def copy(self):
+        """ Returns a copy which shares all buckets with this one. """
+        copied = self.__class__.__new__(self.__class__)
+        copied.__dict__.update(self.__dict__)
+        copied.buckets = list(self.buckets)
+        # Both have to copy before writing now.
+        self.owned = [False] * BUCKETS
+        copied.owned = [False] * BUCKETS
+        self.owns_order = False
+        copied.owns_order = False
+        return copied
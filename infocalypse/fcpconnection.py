@@ -24,7 +24,9 @@
     socket.  The intent is that client code can plug in a
     framework appropriate implementation. i.e. for Twisted,
     asyncore, Tkinter, pyQt, pyGtk, etc.  A platform agnostic
-    implementation, PolledSocket is supplied.
+    implementation, PolledSocket is supplied.  SelectorSocket is
+    a PolledSocket which can block in IAsyncSocket.wait() until
+    there's socket activity instead of sleeping.
 
     FCPConnection uses an IAsyncSocket delegate to run the
     FCP 2.0 protocol over a single socket connection to an FCP server.
@@ -53,7 +55,8 @@
 """
 # REDFLAG: get pylint to acknowledge inherited doc strings from ABCs?
 
-import os, os.path, random, select, socket, time
+import os, os.path, random, select, selectors, socket, tempfile, time
+from collections import deque
 
 try:
     from hashlib import sha1
@@ -67,13 +70,14 @@ except ImportError:
         """ Return the SHA1 hexdigest of bytes using the sha module. """
         return sha.new(bytes).hexdigest().encode("utf-8")
 
-from .fcpmessage import make_request, FCPParser, HELLO_DEF, REMOVE_REQUEST_DEF
+from .fcpmessage import make_request, StreamingFCPParser, HELLO_DEF, \
+     REMOVE_REQUEST_DEF
 
 FCP_VERSION = b'2.0' # Expected version value sent in ClientHello
 
 RECV_BLOCK = 4096 # socket recv
-SEND_BLOCK = 4096 # socket send
-READ_BLOCK = 16 * 1024  # disk read
+SEND_BLOCK = 64 * 1024 # socket send
+READ_BLOCK = 64 * 1024  # disk read
 
 MAX_SOCKET_READ = 33 * 1024 # approx. max bytes read during IAsyncSocket.poll()
 
@@ -117,6 +121,8 @@ class IAsyncSocket:
         self.closed_callback = lambda :None
         # Socket wants data to write. This can be None.
         self.writable_callback = None
+        # Bytes were written to the socket. Called after every write.
+        self.sent_callback = lambda count:None
 
     def write_bytes(self, bytes):
         """ Write bytes to the socket. """
@@ -132,10 +138,19 @@ class IAsyncSocket:
             on the socket.
 
             e.g. run gui framework message pump, explictly poll, etc.
-            MUST call recv_callback, writable_callback
+            MUST call recv_callback, writable_callback, sent_callback
         """
         pass
 
+    def wait(self, timeout_secs):
+        """ Block until there might be new activity on the socket
+            or timeout_secs have elapsed.
+
+            Call poll() afterwards to handle the activity. The default
+            implementation just sleeps.
+        """
+        time.sleep(timeout_secs)
+
 class NonBlockingSocket(IAsyncSocket):
     """ Base class used for IAsyncSocket implementations based on
         non-blocking BSD style sockets.
@@ -143,14 +158,22 @@ class NonBlockingSocket(IAsyncSocket):
     def __init__(self, connected_socket):
         """ REQUIRES: connected_socket is non-blocking and fully connected. """
         IAsyncSocket.__init__(self)
-        self.buffer = b""
+        # Queue of memoryviews waiting to be written. Queued data is
+        # never copied. Partial sends just advance self.offset into
+        # the first chunk.
+        self.buffer = deque()
+        self.offset = 0
         self.socket = connected_socket
 
     def write_bytes(self, bytes):
         """ IAsyncSocket implementation. """
         assert bytes
-        self.buffer += bytes
-        #print "write_bytes: ", self.buffer
+        self.buffer.append(memoryview(bytes))
+        #print "write_bytes: ", bytes
+
+    def buffered_bytes(self):
+        """ Return the number of bytes queued but not yet written. """
+        return sum([len(chunk) for chunk in self.buffer]) - self.offset
 
     def close(self):
         """ IAsyncSocket implementation. """
@@ -173,13 +196,15 @@ class NonBlockingSocket(IAsyncSocket):
             # pylint: disable-msg=E1102
             self.writable_callback()
         if self.buffer:
-            chunk = self.buffer[:SEND_BLOCK]
-            sent = self.socket.send(chunk)
-            #print "WRITING:", self.buffer[:sent]
+            chunk = self.buffer[0]
+            sent = self.socket.send(chunk[self.offset:self.offset + SEND_BLOCK])
+            #print "WRITING:", chunk[self.offset:self.offset + sent]
             assert sent >= 0
-            #print "TO_WIRE:"
-            #print repr(self.buffer[:sent])
-            self.buffer = self.buffer[sent:]
+            self.offset += sent
+            self.sent_callback(sent)
+            if self.offset >= len(chunk):
+                self.buffer.popleft()
+                self.offset = 0
             return True
         assert not self.writable_callback # Hmmmm... This is a client error.
         return False
@@ -261,6 +286,59 @@ class PolledSocket(NonBlockingSocket):
         #print "PolledSocket.poll -- exited"
         return ret
 
+class SelectorSocket(PolledSocket):
+    """ PolledSocket which blocks in wait() until the socket is readable,
+        writable (if there's something to write) or the timeout expires,
+        instead of sleeping for a fixed time. """
+
+    def __init__(self, host, port):
+        PolledSocket.__init__(self, host, port)
+        self.selector = None
+        self.events = 0
+
+    def wait(self, timeout_secs):
+        """ IAsyncSocket implementation. """
+        if not self.socket:
+            return
+        events = selectors.EVENT_READ
+        if self.buffer or self.writable_callback:
+            events |= selectors.EVENT_WRITE
+
+        if self.selector is None:
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.socket, events)
+        elif events != self.events:
+            self.selector.modify(self.socket, events)
+        self.events = events
+
+        self.selector.select(max(timeout_secs, 0))
+
+    def close(self):
+        """ IAsyncSocket implementation. """
+        if self.selector:
+            self.selector.close()
+            self.selector = None
+        PolledSocket.close(self)
+
+def wait_for_sockets(async_sockets, timeout_secs):
+    """ Block until any of the NonBlockingSocket instances in
+        async_sockets has activity or timeout_secs have elapsed.
+
+        This is IAsyncSocket.wait() for more than one socket.
+    """
+    selector = selectors.DefaultSelector()
+    try:
+        for async_socket in async_sockets:
+            if not async_socket.socket:
+                continue
+            events = selectors.EVENT_READ
+            if async_socket.buffer or async_socket.writable_callback:
+                events |= selectors.EVENT_WRITE
+            selector.register(async_socket.socket, events)
+        selector.select(max(timeout_secs, 0))
+    finally:
+        selector.close()
+
 #-----------------------------------------------------------#
 # Message level FCP protocol handling.
 #-----------------------------------------------------------#
@@ -450,7 +528,7 @@ class FCPConnection:
         """
         self.running_clients = {}
         # Delegate handles parsing FCP protocol off the wire.
-        self.parser = FCPParser()
+        self.parser = StreamingFCPParser()
         self.parser.msg_callback = self.msg_handler
         self.parser.context_callback = self.get_context
 
@@ -461,11 +539,25 @@ class FCPConnection:
             self.state_callback = lambda x, y: None
         self.socket.recv_callback = self.parser.parse_bytes
         self.socket.closed_callback = self.closed_handler
+        self.socket.sent_callback = self.sent_handler
+        # [client, byte_count] for each write to the socket, in order,
+        # so that sent bytes can be charged to the request which wrote
+        # them. client is None for writes which aren't for a request.
+        self.written = deque()
 
         self.node_hello = None
 
         # Only used for uploads.
         self.data_source = None
+        self.data_client = None
+
+        # Optional MemoryBudget for trailing data held in memory.
+        # See DataSink.
+        self.memory_budget = None
+
+        # Optional tracing.RequestTracer which is told about the
+        # bytes sent and messages received for each request.
+        self.tracer = None
 
         # Tell the client code that we are trying to connect.
         self.state_callback(self, CONNECTING)
@@ -473,13 +565,14 @@ class FCPConnection:
         # Send a ClientHello
         params = {b'Name':b'FCPConnection[%s]' % make_id(),
                   b'ExpectedVersion': FCP_VERSION}
-        self.socket.write_bytes(make_request(HELLO_DEF, params))
+        self.write_bytes(None, make_request(HELLO_DEF, params))
         if wait_for_connect:
             # Wait for the reply
             while not self.is_connected():
                 if not self.socket.poll():
                     raise IOError("Socket closed")
-                time.sleep(POLL_TIME_SECS)
+                if not self.is_connected():
+                    self.socket.wait(POLL_TIME_SECS)
 
     def is_connected(self):
         """ Returns True if the instance is fully connected to the
@@ -538,6 +631,7 @@ class FCPConnection:
         write_string = False
         if client.in_params.send_data:
             assert not self.data_source
+            self.data_client = client
             if data_source:
                 data_source.initialize()
                 if set_data_length:
@@ -558,17 +652,19 @@ class FCPConnection:
                                                                 send_data)
                 write_string = True
         # print(client.in_params.__dict__)
-        self.socket.write_bytes(make_request(client.in_params.definition,
-                                             client.in_params.fcp_params,
-                                             client.in_params.default_fcp_params))
+        self.write_bytes(client, make_request(client.in_params.definition,
+                                              client.in_params.fcp_params,
+                                              client.in_params.
+                                              default_fcp_params))
 
         if write_string:
-            self.socket.write_bytes(client.in_params.send_data)
+            self.write_bytes(client, client.in_params.send_data)
 
         assert not client.context
         client.context = RequestContext(client.in_params.allowed_redirects,
                                         identifier,
                                         client.in_params.fcp_params.get(b'URI'))
+        client.context.data_sink.budget = self.memory_budget
         if not client.in_params.send_data:
             client.context.file_name = client.in_params.file_name
 
@@ -597,14 +693,15 @@ class FCPConnection:
                   identifier)
         params = {b'Identifier': identifier,
                   b'Global': (b"true" if is_global else b"false")}
-        self.socket.write_bytes(make_request(REMOVE_REQUEST_DEF, params))
+        self.write_bytes(None, make_request(REMOVE_REQUEST_DEF, params))
 
     def wait_for_terminal(self, client):
         """ Wait until the request running on client finishes. """
         while not client.is_finished():
             if not self.socket.poll():
                 break
-            time.sleep(POLL_TIME_SECS)
+            if not client.is_finished():
+                self.socket.wait(POLL_TIME_SECS)
 
         # Doh saw this trip 20080124. Regression from NonBlockingSocket changes?
         # assert client.response
@@ -644,8 +741,8 @@ class FCPConnection:
                 params[b'Identifier'] = client.context.running_id
 
                 # Send new request.
-                self.socket.write_bytes(make_request(client.in_params.
-                                                     definition, params))
+                self.write_bytes(client, make_request(client.in_params.
+                                                      definition, params))
 
                 #print "MAPPED(1) [%s]->[%s]" % (client.context.running_id,
                 #                                str(client))
@@ -705,6 +802,8 @@ class FCPConnection:
 
         client = self.running_clients[msg[1][b'Identifier']]
         assert client.is_running()
+        if not self.tracer is None:
+            self.tracer.message_received(client, msg)
 
         if msg_is_terminal(msg, client.in_params.fcp_params):
             if self.handled_redirect(msg, client):
@@ -789,6 +888,7 @@ class FCPConnection:
                 client.message_callback(client, fake_msg)
 
         self.running_clients.clear()
+        self.written.clear()
         self.state_callback(self, CLOSED)
 
     def writable_handler(self):
@@ -802,22 +902,94 @@ class FCPConnection:
         if not data:
             self.data_source.release()
             self.data_source = None
+            self.data_client = None
             self.socket.writable_callback = None
             if self.is_connected():
                 self.state_callback(self, CONNECTED)
             return
+        self.write_bytes(self.data_client, data)
+
+    def write_bytes(self, client, data):
+        """ INTERNAL: Queue data written for client, which can be
+            None, on the socket. """
         self.socket.write_bytes(data)
+        self.written.append([client, len(data)])
+
+    def sent_handler(self, count):
+        """ INTERNAL: Callback called by the IAsyncSocket delegate when
+            it wrote count bytes. Tells the tracer which requests
+            they were for.
+        """
+        while count > 0:
+            entry = self.written[0]
+            sent = min(count, entry[1])
+            if not self.tracer is None and not entry[0] is None:
+                self.tracer.request_sent(entry[0], sent)
+            entry[1] -= sent
+            count -= sent
+            if entry[1] == 0:
+                self.written.popleft()
+
+class MemoryBudget:
+    """ Bounds the number of bytes of trailing data which DataSinks
+        hold in memory across all running requests.
+
+        A DataSink which would exceed either the per request limit or
+        the global limit spills its data to a temp file.
+    """
+    def __init__(self, max_bytes, request_bytes, tmp_dir=None):
+        self.max_bytes = max_bytes
+        self.request_bytes = request_bytes
+        self.tmp_dir = tmp_dir
+        self.in_flight = 0
+        self.peak = 0
+        self.spilled_requests = 0
+        self.spilled_bytes = 0
+
+    def reserve(self, sink_bytes, count):
+        """ Return True and account for count more bytes if a sink
+            which already holds sink_bytes can keep them in memory,
+            False otherwise. """
+        if (sink_bytes + count > self.request_bytes or
+            self.in_flight + count > self.max_bytes):
+            return False
+        self.in_flight += count
+        self.peak = max(self.peak, self.in_flight)
+        return True
+
+    def release(self, count):
+        """ Give back bytes previously reserved. """
+        self.in_flight -= count
+        assert self.in_flight >= 0
+
+    def stats(self):
+        """ Return a dictionary of buffering statistics. """
+        return {'in_flight':self.in_flight,
+                'peak_in_flight':self.peak,
+                'spilled_requests':self.spilled_requests,
+                'spilled_bytes':self.spilled_bytes}
 
 # Writes to file if file_name is set, raw_data otherwise
 class DataSink:
     """ INTERNAL: Helper class used to save trailing data for FCP
         messages.
+
+        If a MemoryBudget is set in the budget member, data which
+        doesn't fit into it is spilled into an anonymous temp file
+        instead of being held in memory while it arrives.
+
+        NOTE: raw_data reads spilled data back into memory, so the
+        whole payload is still in memory once the request finishes.
+        Requests which can get large payloads should set
+        in_params.file_name so the data goes straight to a file.
     """
 
     def __init__(self):
         self.file_name = None
         self.file = None
-        self.raw_data = b''
+        self.buffer = bytearray()
+        self.spill_file = None
+        self.budget = None
         self.data_bytes = 0
 
     def initialize(self, data_length, file_name):
@@ -826,7 +998,8 @@ class DataSink:
             the file, otherwise, it is saved in the raw_data member.
         """
         # This should only be called once. You can't reuse the datasink.
-        assert not self.file and not self.raw_data and not self.data_bytes
+        assert (not self.file and not self.buffer and not self.spill_file
+                and not self.data_bytes)
         self.data_bytes = data_length
         self.file_name = file_name
 
@@ -856,10 +1029,39 @@ class DataSink:
                 self.file.close()
             return
 
-        self.raw_data += bytes
+        if (not self.spill_file and not self.budget is None and
+            not self.budget.reserve(len(self.buffer), len(bytes))):
+            self.spill()
+
+        if self.spill_file:
+            self.spill_file.write(bytes)
+            self.budget.spilled_bytes += len(bytes)
+        else:
+            self.buffer += bytes
         self.data_bytes -= len(bytes)
         assert self.data_bytes >= 0
 
+    def spill(self):
+        """ INTERNAL: Move the data written so far into a temp file
+            and write all subsequent data there. """
+        self.spill_file = tempfile.TemporaryFile(dir=self.budget.tmp_dir)
+        self.spill_file.write(self.buffer)
+        self.budget.release(len(self.buffer))
+        self.budget.spilled_requests += 1
+        self.budget.spilled_bytes += len(self.buffer)
+        self.buffer = bytearray()
+
+    def get_raw_data(self):
+        """ Return the data written into the instance as bytes.
+
+            Spilled data is read back from the temp file. """
+        if self.spill_file:
+            self.spill_file.seek(0)
+            return self.spill_file.read()
+        return bytes(self.buffer)
+
+    raw_data = property(get_raw_data)
+
     def release(self):
         """ Release all resources associated with the instance. """
 
@@ -868,9 +1070,14 @@ class DataSink:
                   self.data_bytes)
         if self.file:
             self.file.close()
+        if self.spill_file:
+            self.spill_file.close()
+        elif not self.budget is None:
+            self.budget.release(len(self.buffer))
         self.file_name = None
         self.file = None
-        self.raw_data = b''
+        self.buffer = bytearray()
+        self.spill_file = None
         self.data_bytes = 0
 
 class RequestContext:
@@ -340,3 +340,63 @@ class FCPParser:
             assert not self.data_context or not self.data_context.writable()
             self.prev_chunk = bytes[last_eol + 1:]
 
+
+class StreamingFCPParser(FCPParser):
+    """ Drop in replacement for FCPParser which doesn't re-join or
+        re-slice its input.
+
+        Incoming bytes are scanned in place with a single cursor.
+        Only the tail of an incomplete line is carried over between
+        parse_bytes() calls (in a bytearray) and trailing data is
+        handed to the DataSink as memoryview slices of the input,
+        so it is never buffered twice. No recursion.
+
+        Delivers exactly the same messages as FCPParser.
+    """
+    def __init__(self):
+        FCPParser.__init__(self)
+        # Partial line left over from the previous parse_bytes() call.
+        self.line_buffer = bytearray()
+
+    def parse_bytes(self, raw_bytes):
+        """ This method drives an FCP Message parser and eventually causes
+            calls into msg_callback().
+        """
+        view = memoryview(raw_bytes)
+        length = len(view)
+        start = 0
+        while start < length:
+            if self.data_context and self.data_context.writable():
+                # Expecting raw data.
+                assert not self.line_buffer
+                count = min(self.data_context.writable(), length - start)
+                self.handle_data(view[start:start + count])
+                start += count
+                continue
+
+            # Expecting \n terminated lines.
+            pos = raw_bytes.find(b'\n', start)
+            if pos == -1:
+                self.line_buffer += view[start:]
+                break
+            if self.line_buffer:
+                # Finish the line started in a previous call.
+                self.line_buffer += view[start:pos]
+                line = bytes(self.line_buffer.strip())
+                del self.line_buffer[:]
+                start = pos + 1
+                if self.handle_line(line):
+                    continue
+                pos = raw_bytes.find(b'\n', start)
+
+            while pos != -1:
+                line = raw_bytes[start:pos].strip()
+                start = pos + 1
+                if self.handle_line(line):
+                    # Trailing data is handled at the top of the loop.
+                    break
+                pos = raw_bytes.find(b'\n', start)
+            else:
+                if start < length:
+                    self.line_buffer += view[start:]
+                break
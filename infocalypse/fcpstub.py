@@ -0,0 +1,679 @@
+""" A fake FCP 2.0 node for testing and benchmarking without Freenet.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+
+    FakeFCPNode runs a single threaded FCP server on a background
+    thread. Data inserted with ClientPut or ClientPutComplexDir is
+    kept in memory and can be fetched back with ClientGet.
+
+    Keys are fakes with the same shape as the real thing. CHKs are
+    derived from a hash of the inserted data. The public half of an SSK
+    is derived from a hash of the private half, so any well formed
+    insert URI can be inverted. USK editions are stored as SSKs
+    ('name-N'), and ClientGets for stale or negative USK editions fail
+    with a code 27 redirect to the latest edition, like a real node.
+
+    CHK inserts of more than a block with a Metadata.ContentType are
+    stored like splitfiles: fetching the CHK with its control bytes
+    cleared returns a fake metadata block with the content type in
+    it. Inserting a changed copy of that block gives another CHK for
+    the same data, which is how Infocalypse salts redundant inserts.
+
+    Reading from each client connection is throttled to the configured
+    bandwidth, so uploads really do take time on the client side too.
+"""
+#pylint: disable-msg=C0111
+import base64
+import heapq
+import random
+import re
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from hashlib import sha256
+
+from .chk import clear_control_bytes
+from .fcpconnection import RequestContext
+from .fcpmessage import StreamingFCPParser
+
+RECV_BLOCK = 64 * 1024
+SEND_BLOCK = 64 * 1024
+# Keep the kernel from soaking up throttled uploads.
+SOCKET_BUFFER = 64 * 1024
+# Upper bound on how long the server loop blocks. Bounds stop() latency.
+MAX_WAIT_SECS = 0.05
+# Bigger CHK inserts with a content type get a metadata block.
+FREENET_BLOCK_LEN = 32 * 1024
+# <FAKE_METADATA><content type><NUL><sha256 of the data>
+FAKE_METADATA = b'FakeSplitfileMetadata\x00'
+
+# Error codes from the FCP 2.0 spec.
+GET_DATA_NOT_FOUND = 13
+GET_ROUTE_NOT_FOUND = 15
+GET_INVALID_URI = 20
+GET_PERMANENT_REDIRECT = 27
+PUT_INVALID_URI = 1
+PUT_ROUTE_NOT_FOUND = 5
+
+# (message name, code) -> (ShortCodeDescription, CodeDescription)
+CODE_DESCRIPTIONS = {
+    (b'GetFailed', GET_DATA_NOT_FOUND):(b'Data not found',
+                                        b'Data not found'),
+    (b'GetFailed', GET_ROUTE_NOT_FOUND):(b'Route not found',
+                                         b'Route not found'),
+    (b'GetFailed', GET_INVALID_URI):(b'Invalid URI', b'Invalid URI'),
+    (b'GetFailed', GET_PERMANENT_REDIRECT):(b'New URI',
+                                            b'Permanent redirect: use the '
+                                            b'new URI'),
+    (b'PutFailed', PUT_INVALID_URI):(b'Invalid URI', b'Caller supplied a '
+                                     b'URI we cannot use'),
+    (b'PutFailed', PUT_ROUTE_NOT_FOUND):(b'Route not found',
+                                         b'Could not propagate the insert '
+                                         b'far enough'),
+    }
+
+def failed_fields(msg_name, code):
+    """ INTERNAL: Return the description fields for a failure. """
+    short, full = CODE_DESCRIPTIONS[(msg_name, code)]
+    return {b'ShortCodeDescription':short, b'CodeDescription':full}
+
+# The 'extra' field of SSK insert and request URIs.
+INSERT_EXTRA = b'AQECAAE'
+REQUEST_EXTRA = b'AQACAAE'
+
+URI_REGEX = re.compile(b'^(freenet:)?(?P<key_type>CHK|KSK|SSK|USK)@'
+                       + b'(?P<key>[^/]*)(?P<path>/.*)?$')
+EDITION_REGEX = re.compile(b'^/(?P<name>[^/]+)-(?P<edition>[0-9]+)(/.*)?$')
+
+def encode_key_part(raw):
+    """ INTERNAL: Freenet base64 without padding. """
+    return base64.b64encode(raw, b'~-').rstrip(b'=')
+
+def make_content_chk(data):
+    """ Return a well formed fake CHK which depends only on data. """
+    digest = sha256(data).digest()
+    return (b'CHK@' + encode_key_part(digest) + b','
+            + encode_key_part(sha256(digest).digest()) + b','
+            + encode_key_part(b'\x00\x02\x02\x00\x00'))
+
+def public_key(key):
+    """ Return the public 'routing,crypto,extra' key for an SSK or USK
+        key. Inverts the key if it is an insert key. """
+    fields = key.split(b',')
+    if len(fields) != 3:
+        raise ValueError("Malformed SSK key: %s" % key)
+    if fields[2] == INSERT_EXTRA:
+        fields[0] = encode_key_part(sha256(b'public:' + fields[0]).digest())
+    return b','.join((fields[0], fields[1], REQUEST_EXTRA))
+
+def split_uri(uri):
+    """ Return a (key_type, key, path) tuple for a Freenet URI.
+
+        The path is b'' or starts with a '/'.
+    """
+    match = URI_REGEX.match(uri)
+    if not match:
+        raise ValueError("Doesn't look like a Freenet URI: %s" % uri)
+    return (match.group('key_type'), match.group('key'),
+            match.group('path') or b'')
+
+def split_usk_path(path):
+    """ Return a (name, version, rest) tuple for the path part of a USK.
+
+        version is the raw bytes so that '-0' isn't lost.
+    """
+    fields = path[1:].split(b'/', 2)
+    if len(fields) < 2 or not re.match(b'^-?[0-9]+$', fields[1]):
+        raise ValueError("Couldn't parse a USK version from: %s" % path)
+    rest = b''
+    if len(fields) == 3:
+        rest = b'/' + fields[2]
+    return (fields[0], fields[1], rest)
+
+def dir_data_length(fields):
+    """ Return the total length of the direct uploads in the fields of a
+        ClientPutComplexDir message. """
+    total = 0
+    index = 0
+    while b'Files.%i.Name' % index in fields:
+        prefix = b'Files.%i.' % index
+        if fields.get(prefix + b'UploadFrom', b'direct') == b'direct':
+            total += int(fields[prefix + b'DataLength'])
+        index += 1
+    return total
+
+def format_msg(name, fields, data=None):
+    """ Return the raw bytes for an FCP message from the node. """
+    lines = [name]
+    for key, value in fields.items():
+        if isinstance(value, int):
+            value = b'%i' % value
+        lines.append(key + b'=' + value)
+    if data is None:
+        lines.append(b'EndMessage\n')
+        return b'\n'.join(lines)
+    lines.append(b'Data\n')
+    return b'\n'.join(lines) + data
+
+class NodeSideParser(StreamingFCPParser):
+    """ INTERNAL: FCPParser for messages sent by clients.
+
+        Clients terminate direct ClientPuts with EndMessage, not
+        Data, and send the trailing data right after it.
+
+        ClientPutComplexDir has no top level DataLength. The data for
+        all the direct Files.N entries follows the message back to back.
+    """
+    def handle_line(self, line):
+        """ INTERNAL: Process a single line of an FCP message. """
+        if line == b'EndMessage' and self.msg:
+            if (self.msg[0] == b'ClientPut' and
+                b'DataLength' in self.msg[1] and
+                self.msg[1].get(b'UploadFrom', b'direct') == b'direct'):
+                line = b'Data'
+            elif (self.msg[0] == b'ClientPutComplexDir' and
+                  dir_data_length(self.msg[1]) > 0):
+                self.msg[1][b'DataLength'] = (b'%i' %
+                                              dir_data_length(self.msg[1]))
+                line = b'Data'
+        return StreamingFCPParser.handle_line(self, line)
+
+class FakeNodeConnection:
+    """ INTERNAL: Server side state for a single client connection. """
+    def __init__(self, sock):
+        self.sock = sock
+        self.parser = NodeSideParser()
+        self.parser.context_callback = self.get_context
+        self.contexts = {}
+        self.buffer = deque()
+        self.offset = 0
+        # Throttling.
+        self.next_read_time = 0.0
+        self.reply_time = 0.0
+        self.events = 0
+
+    def get_context(self, identifier):
+        """ FCPParser context_callback for trailing data. """
+        context = RequestContext(0, identifier, None)
+        context.file_name = None
+        self.contexts[identifier] = context
+        return context
+
+    def take_data(self, identifier):
+        """ Return the trailing data received for identifier. """
+        context = self.contexts.pop(identifier, None)
+        if context is None:
+            return b''
+        data = context.data_sink.raw_data
+        context.release()
+        return data
+
+class FakeFCPNode:
+    """ Fake FCP node.
+
+        latency_secs -- delay added to every reply
+        bandwidth -- max bytes/sec read from, and replied to, each
+                     connection. None for unlimited.
+        failure_rate -- probability that a request fails
+        dnf_rate -- probability that a ClientGet fails with DataNotFound
+    """
+    def __init__(self, latency_secs=0.0, bandwidth=None,
+                 failure_rate=0.0, dnf_rate=0.0, seed=None,
+                 host='127.0.0.1', port=0):
+        self.latency_secs = latency_secs
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.dnf_rate = dnf_rate
+        self.random = random.Random(seed)
+
+        # uri -> raw data
+        self.store = {}
+        # (public key, name) -> latest USK edition
+        self.editions = {}
+        # sha256 digest -> data, for CHK inserts with metadata blocks
+        self.splitfiles = {}
+        # uri -> extra seconds before answering ClientGets for it
+        self.slow = {}
+        self.stats = {'connections':0, 'bytes_in':0, 'bytes_out':0,
+                      'requests':{}}
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(16)
+        self.listener.setblocking(0)
+        self.host, self.port = self.listener.getsockname()
+
+        self.connections = []
+        # (time, sequence, connection, raw_bytes)
+        self.timers = []
+        self.sequence = 0
+        self.selector = None
+        self.thread = None
+        self.running = False
+
+        self.handlers = {b'ClientHello':self.handle_hello,
+                         b'ClientGet':self.handle_get,
+                         b'ClientPut':self.handle_put,
+                         b'ClientPutComplexDir':self.handle_put_dir,
+                         b'GenerateSSK':self.handle_generate_ssk,
+                         b'RemoveRequest':self.handle_remove,
+                         }
+
+    def start(self):
+        """ Start serving on a background thread. """
+        assert self.thread is None
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stop serving and close all sockets. """
+        self.running = False
+        if not self.thread is None:
+            self.thread.join()
+            self.thread = None
+
+    def insert(self, uri, data):
+        """ Put data directly into the node's store.
+
+            CHK and KSK uris are used as is. SSK and USK uris are
+            handled as if data was inserted with ClientPut.
+
+            Returns the request URI.
+        """
+        if split_uri(uri)[0] in (b'CHK', b'KSK'):
+            self.put_data(uri, data)
+            return uri
+        store_uri, request_uri = self.resolve_insert(uri, data)
+        self.put_data(store_uri, data)
+        return request_uri
+
+    # Key handling.
+    def resolve_insert(self, uri, data):
+        """ INTERNAL: Return a (store_uri, request_uri) tuple for an
+            insert of data to uri.
+
+            Raises ValueError if uri is malformed.
+        """
+        key_type, key, path = split_uri(uri)
+        if key_type == b'CHK':
+            uri = make_content_chk(data)
+            return (uri, uri)
+        if key_type == b'KSK':
+            uri = b'KSK@' + key + path
+            return (uri, uri)
+        key = public_key(key)
+        if key_type == b'SSK':
+            uri = b'SSK@' + key + path.rstrip(b'/')
+            return (uri, uri)
+
+        # USKs are inserted to the first free edition.
+        name, version, rest = split_usk_path(path.rstrip(b'/'))
+        edition = abs(int(version))
+        while b'SSK@%s/%s-%i' % (key, name, edition) in self.store:
+            edition += 1
+        return (b'SSK@%s/%s-%i%s' % (key, name, edition, rest),
+                b'USK@%s/%s/%i%s' % (key, name, edition, rest))
+
+    def put_metadata(self, chk, data, content_type):
+        """ INTERNAL: Store the metadata block for a CHK insert, and
+            make CHKs for metadata blocks point at their data. """
+        if data.startswith(FAKE_METADATA):
+            original = self.splitfiles.get(data[-32:])
+            if not original is None:
+                # A salted copy of a metadata block.
+                self.store[chk] = original
+                self.store[clear_control_bytes(chk)] = data
+            return
+        if content_type is None or len(data) <= FREENET_BLOCK_LEN:
+            return
+        digest = sha256(data).digest()
+        self.splitfiles[digest] = data
+        self.store[clear_control_bytes(chk)] = (FAKE_METADATA + content_type
+                                                + b'\x00' + digest)
+
+    def put_data(self, store_uri, data):
+        """ INTERNAL: Store data, keeping track of USK editions. """
+        self.store[store_uri] = data
+        key_type, key, path = split_uri(store_uri)
+        if key_type != b'SSK':
+            return
+        match = EDITION_REGEX.match(path)
+        if match:
+            name = (key, match.group('name'))
+            self.editions[name] = max(self.editions.get(name, 0),
+                                      int(match.group('edition')))
+
+    def lookup(self, uri):
+        """ INTERNAL: Return a (data, redirect_uri) tuple for a ClientGet
+            of uri. Both are None if there's no data.
+
+            Raises ValueError if uri is malformed.
+        """
+        key_type, key, path = split_uri(uri)
+        if key_type in (b'CHK', b'KSK'):
+            return (self.store.get(key_type + b'@' + key + path), None)
+        key = public_key(key)
+        path = path.rstrip(b'/')
+        if key_type == b'SSK':
+            return (self.store.get(b'SSK@' + key + path), None)
+
+        name, version, rest = split_usk_path(path)
+        latest = self.editions.get((key, name))
+        if latest is None or latest < abs(int(version)):
+            return (None, None)
+        if version.startswith(b'-') or latest != int(version):
+            return (None, b'USK@%s/%s/%i%s' % (key, name, latest, rest))
+        return (self.store.get(b'SSK@%s/%s-%i%s' % (key, name, latest, rest)),
+                None)
+
+    # Server loop.
+    def run(self):
+        """ INTERNAL: The server loop. """
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        try:
+            while self.running:
+                self.run_once()
+        finally:
+            for connection in self.connections:
+                connection.sock.close()
+            self.connections = []
+            self.selector.close()
+            self.listener.close()
+
+    def run_once(self):
+        """ INTERNAL: Run a single iteration of the server loop. """
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            connection, raw_bytes = heapq.heappop(self.timers)[2:]
+            if connection in self.connections:
+                connection.buffer.append(memoryview(raw_bytes))
+
+        wait_secs = MAX_WAIT_SECS
+        if self.timers:
+            wait_secs = min(wait_secs, self.timers[0][0] - now)
+        for connection in self.connections:
+            events = 0
+            if connection.next_read_time <= now:
+                events |= selectors.EVENT_READ
+            else:
+                wait_secs = min(wait_secs, connection.next_read_time - now)
+            if connection.buffer:
+                events |= selectors.EVENT_WRITE
+            self.set_events(connection, events)
+
+        for key, mask in self.selector.select(max(wait_secs, 0)):
+            if key.fileobj is self.listener:
+                self.accept()
+                continue
+            connection = key.data
+            if mask & selectors.EVENT_WRITE:
+                self.do_write(connection)
+            if mask & selectors.EVENT_READ and connection in self.connections:
+                self.do_read(connection)
+
+    def set_events(self, connection, events):
+        """ INTERNAL: Update the selector registration for connection. """
+        if events == connection.events:
+            return
+        if connection.events == 0:
+            self.selector.register(connection.sock, events, connection)
+        elif events == 0:
+            self.selector.unregister(connection.sock)
+        else:
+            self.selector.modify(connection.sock, events, connection)
+        connection.events = events
+
+    def accept(self):
+        """ INTERNAL: Accept a new client connection. """
+        try:
+            sock = self.listener.accept()[0]
+        except socket.error:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        sock.setblocking(0)
+        connection = FakeNodeConnection(sock)
+        connection.parser.msg_callback = (lambda msg, conn=connection:
+                                          self.handle_msg(conn, msg))
+        self.connections.append(connection)
+        self.stats['connections'] += 1
+
+    def drop(self, connection):
+        """ INTERNAL: Close a client connection. """
+        self.set_events(connection, 0)
+        connection.sock.close()
+        self.connections.remove(connection)
+
+    def do_read(self, connection):
+        """ INTERNAL: Read from a client connection. """
+        try:
+            data = connection.sock.recv(RECV_BLOCK)
+        except socket.error:
+            data = None
+        if not data:
+            self.drop(connection)
+            return
+        self.stats['bytes_in'] += len(data)
+        if self.bandwidth:
+            connection.next_read_time = (time.time() +
+                                         len(data) / float(self.bandwidth))
+        connection.parser.parse_bytes(data)
+
+    def do_write(self, connection):
+        """ INTERNAL: Write to a client connection. """
+        chunk = connection.buffer[0]
+        try:
+            sent = connection.sock.send(chunk[connection.offset:
+                                              connection.offset + SEND_BLOCK])
+        except socket.error:
+            self.drop(connection)
+            return
+        self.stats['bytes_out'] += sent
+        connection.offset += sent
+        if connection.offset >= len(chunk):
+            connection.buffer.popleft()
+            connection.offset = 0
+
+    def reply(self, connection, raw_bytes, delay=0.0):
+        """ INTERNAL: Queue raw_bytes to be sent to the client after
+            the configured latency. """
+        when = time.time() + self.latency_secs
+        if self.bandwidth:
+            # Replies on a connection share its bandwidth.
+            when = (max(when, connection.reply_time) +
+                    len(raw_bytes) / float(self.bandwidth))
+            connection.reply_time = when
+        # Don't hold up other replies.
+        when += delay
+        self.sequence += 1
+        heapq.heappush(self.timers, (when, self.sequence, connection,
+                                     raw_bytes))
+
+    def fails(self, rate):
+        """ INTERNAL: Return True with probability rate. """
+        return rate > 0 and self.random.random() < rate
+
+    # Message handlers.
+    def handle_msg(self, connection, msg):
+        """ INTERNAL: Dispatch an incoming FCP message. """
+        requests = self.stats['requests']
+        requests[msg[0]] = requests.get(msg[0], 0) + 1
+        handler = self.handlers.get(msg[0])
+        if handler is None:
+            self.reply(connection, format_msg(b'ProtocolError',
+                                              {b'Code':17,
+                                               b'CodeDescription':
+                                               b'Unknown message: ' + msg[0],
+                                               b'Fatal':b'false'}))
+            return
+        handler(connection, msg)
+
+    def handle_hello(self, connection, dummy_msg):
+        self.reply(connection, format_msg(b'NodeHello',
+                                          {b'FCPVersion':b'2.0',
+                                           b'Node':b'Fred',
+                                           b'Version':b'Fred,0.7,1.0,1239',
+                                           b'Build':b'1239',
+                                           b'ConnectionIdentifier':
+                                           b'fake_%i' % id(connection)}))
+
+    def get_failed(self, connection, identifier, code, fields=None,
+                   delay=0.0):
+        """ INTERNAL: Send a GetFailed message. """
+        reply = {b'Code':code,
+                 b'Identifier':identifier,
+                 b'Fatal':(b'false' if code == GET_ROUTE_NOT_FOUND
+                           else b'true')}
+        reply.update(failed_fields(b'GetFailed', code))
+        reply.update(fields or {})
+        self.reply(connection, format_msg(b'GetFailed', reply), delay)
+
+    def put_failed(self, connection, identifier, code):
+        """ INTERNAL: Send a PutFailed message. """
+        reply = {b'Code':code,
+                 b'Identifier':identifier,
+                 b'Fatal':(b'false' if code == PUT_ROUTE_NOT_FOUND
+                           else b'true')}
+        reply.update(failed_fields(b'PutFailed', code))
+        self.reply(connection, format_msg(b'PutFailed', reply))
+
+    def put_successful(self, connection, identifier, uri):
+        """ INTERNAL: Send URIGenerated and PutSuccessful messages. """
+        self.reply(connection, format_msg(b'URIGenerated',
+                                          {b'Identifier':identifier,
+                                           b'URI':uri}) +
+                   format_msg(b'PutSuccessful',
+                              {b'Identifier':identifier,
+                               b'URI':uri}))
+
+    def handle_get(self, connection, msg):
+        identifier = msg[1][b'Identifier']
+        delay = self.slow.get(msg[1][b'URI'], 0.0)
+        if self.fails(self.failure_rate):
+            self.get_failed(connection, identifier, GET_ROUTE_NOT_FOUND,
+                            delay=delay)
+            return
+        try:
+            data, redirect_uri = self.lookup(msg[1][b'URI'])
+        except ValueError:
+            self.get_failed(connection, identifier, GET_INVALID_URI,
+                            delay=delay)
+            return
+        if (data is None and redirect_uri is None) or self.fails(self.dnf_rate):
+            self.get_failed(connection, identifier, GET_DATA_NOT_FOUND,
+                            delay=delay)
+            return
+        if not redirect_uri is None:
+            self.get_failed(connection, identifier, GET_PERMANENT_REDIRECT,
+                            {b'RedirectURI':redirect_uri}, delay)
+            return
+        self.reply(connection,
+                   format_msg(b'DataFound',
+                              {b'Identifier':identifier,
+                               b'Metadata.ContentType':
+                               b'application/octet-stream',
+                               b'DataLength':len(data)}) +
+                   format_msg(b'AllData',
+                              {b'Identifier':identifier,
+                               b'DataLength':len(data)}, data), delay)
+
+    def handle_put(self, connection, msg):
+        identifier = msg[1][b'Identifier']
+        data = connection.take_data(identifier)
+        if self.fails(self.failure_rate):
+            self.put_failed(connection, identifier, PUT_ROUTE_NOT_FOUND)
+            return
+        try:
+            store_uri, request_uri = self.resolve_insert(msg[1][b'URI'], data)
+        except ValueError:
+            self.put_failed(connection, identifier, PUT_INVALID_URI)
+            return
+        if not msg[1].get(b'GetCHKOnly', b'false').lower() == b'true':
+            self.put_data(store_uri, data)
+            if store_uri.startswith(b'CHK@'):
+                self.put_metadata(store_uri, data,
+                                  msg[1].get(b'Metadata.ContentType'))
+        self.put_successful(connection, identifier, request_uri)
+
+    def handle_put_dir(self, connection, msg):
+        identifier = msg[1][b'Identifier']
+        data = connection.take_data(identifier)
+        if self.fails(self.failure_rate):
+            self.put_failed(connection, identifier, PUT_ROUTE_NOT_FOUND)
+            return
+
+        # Only direct uploads are supported.
+        files = []
+        offset = 0
+        index = 0
+        while b'Files.%i.Name' % index in msg[1]:
+            prefix = b'Files.%i.' % index
+            if msg[1].get(prefix + b'UploadFrom', b'direct') == b'direct':
+                length = int(msg[1][prefix + b'DataLength'])
+                files.append((msg[1][prefix + b'Name'],
+                              data[offset:offset + length]))
+                offset += length
+            index += 1
+        if not files:
+            self.put_failed(connection, identifier, PUT_INVALID_URI)
+            return
+        default_name = msg[1].get(b'DefaultName', files[0][0])
+
+        # The CHK for a container depends on all the names and data.
+        manifest = b''.join([name + b'\x00' + sha256(file_data).digest()
+                             for name, file_data in sorted(files)])
+        try:
+            store_uri, request_uri = self.resolve_insert(msg[1][b'URI'],
+                                                         manifest)
+        except ValueError:
+            self.put_failed(connection, identifier, PUT_INVALID_URI)
+            return
+        if not msg[1].get(b'GetCHKOnly', b'false').lower() == b'true':
+            for name, file_data in files:
+                self.put_data(store_uri + b'/' + name, file_data)
+                if name == default_name:
+                    self.put_data(store_uri, file_data)
+        self.put_successful(connection, identifier, request_uri)
+
+    def handle_generate_ssk(self, connection, msg):
+        private = encode_key_part(bytes(bytearray(self.random.getrandbits(8)
+                                                  for dummy in range(32))))
+        crypto = encode_key_part(bytes(bytearray(self.random.getrandbits(8)
+                                                 for dummy in range(32))))
+        insert_key = b','.join((private, crypto, INSERT_EXTRA))
+        self.reply(connection, format_msg(b'SSKKeypair',
+                                          {b'Identifier':
+                                           msg[1][b'Identifier'],
+                                           b'InsertURI':
+                                           b'SSK@' + insert_key + b'/',
+                                           b'RequestURI':
+                                           b'SSK@' + public_key(insert_key)
+                                           + b'/'}))
+
+    def handle_remove(self, connection, msg):
+        # Everything already finished or will finish shortly.
+        self.reply(connection, format_msg(b'PersistentRequestRemoved',
+                                          {b'Identifier':
+                                           msg[1][b'Identifier']}))
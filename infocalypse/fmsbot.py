@@ -295,8 +295,7 @@ def run_event_loops(bot_runner, request_runner,
                     out_func = lambda msg:None):
     """ Graft the event loops for the FMSBotRunner and RequestQueue together."""
     assert bot_poll_secs > fcp_poll_secs
-    connection = request_runner.connection
-    assert not connection is None
+    assert not request_runner.connection is None
     shutdown_msg = "unknown error"
     try:
         bot_runner.recv_msgs()
@@ -304,7 +303,7 @@ def run_event_loops(bot_runner, request_runner,
         while True:
             # Run the FCP event loop (frequent)
             try:
-                if not connection.socket.poll():
+                if not request_runner.poll():
                     out_func("Exiting because FCP poll exited.\n")
                     break
                 # Nudge the state machine.
@@ -317,8 +316,9 @@ def run_event_loops(bot_runner, request_runner,
                 raise
 
             if time.time() < timeout:
-                # Rest a little. :-)
-                time.sleep(fcp_poll_secs)
+                # Rest until there's FCP activity, an FCP timeout or
+                # it's time to run the FMS loop. :-)
+                request_runner.wait(min(timeout - time.time(), fcp_poll_secs))
                 continue
 
             # Run FMSBotRunner event loop (infrequent)
@@ -335,7 +335,7 @@ def run_event_loops(bot_runner, request_runner,
             timeout = time.time() + bot_poll_secs # Wash. Rinse. Repeat.
         shutdown_msg = "orderly shutdown"
     finally:
-        connection.close()
+        request_runner.close()
         bot_runner.shutdown(shutdown_msg)
 
 
@@ -25,13 +25,20 @@
 # REDFLAG: push MAX_PATH_LEN into graph class -> max_cannonical_len
 # REDFLAG: stash version map info in the graph?
 # REDFLAG: DOCUMENT version sorting assumptions/requirements
+import bisect
 import copy
+import heapq
+import os
 import random
 import functools
+import struct
 
-from binascii import hexlify
+from binascii import hexlify, unhexlify
+from hashlib import sha1
 from mercurial import commands
 
+from .cowdict import CowDict
+
 # Index for an empty repo.
 FIRST_INDEX = -1
 NULL_REV = b'0000000000000000000000000000000000000000'
@@ -115,6 +122,11 @@ def pull_bundle(repo, ui_, bundle_file):
 
 ############################################################
 
+def canonical_key(edge):
+    """ INTERNAL: Sort key for edges in ascending order of
+        'canonicalness'. """
+    return (edge[1], -edge[0], -edge[2])
+
 def edges_containing(graph, index):
     """ INTERNAL: Returns a list of edges containing index in order of
         ascending 'canonicalness'.
@@ -133,7 +145,7 @@ def edges_containing(graph, index):
     #     return diff
 
     edges = graph.contain(index)
-    edges.sort(key=lambda x: (x[1], -x[0], -x[2])) # Best last so you can pop
+    edges.sort(key=canonical_key) # Best last so you can pop
     #print "--- dumping edges_containing ---"
     #print '\n'.join([str(edge) for edge in edges])
     #print "---"
@@ -143,63 +155,303 @@ def tail(list_value):
     """ Returns the tail of a list. """
     return list_value[len(list_value) - 1]
 
-def canonical_path_itr(graph, from_index, to_index, max_search_len):
-    """ A generator which returns a sequence of canonical paths in
-        descending order of 'canonicalness'. """
-
-    returned = set([])
-    min_search_len = -1
-    while min_search_len <= max_search_len:
-        visited = set([]) # Retraverse for each length! REDFLAG: Do better?
-        steps = [edges_containing(graph, from_index), ]
-        current_search_len = max_search_len
-        while len(steps) > 0:
-            while len(tail(steps)) > 0:
-                #candidate = [tail(paths) for paths in steps]
-                #print "candidate: ", candidate
-                #print "end: ", tail(tail(steps))
-                if tail(tail(steps))[1] >= to_index:
-                    # The edge at the bottom of every list.
-                    value = [tail(step) for step in steps]
-                    #print "HIT:"
-                    #print value
-
-                    if min_search_len == -1:
-                        min_search_len = len(steps)
-
-                    current_search_len = max(len(steps), min_search_len)
-                    tag = str(value)
-                    if not tag in returned:
-                        returned.add(tag)
-
-                        # Shorter paths should already be in returned.
-                        assert len(value) >= min_search_len
-                        assert len(value) <= max_search_len
-                        yield value
-                    tail(steps).pop()
-                elif len(steps) < current_search_len:
-                    tag = str([tail(step) for step in steps])
-                    if not tag in visited:
-                        # Follow the path one more step.
-                        visited.add(tag)
-                        steps.append(edges_containing(graph,
-                                                      tail(tail(steps))[1] + 1))
+class PathSolver:
+    """ Finds update paths through a graph from from_index to to_index.
+
+        A path is a list of edges where the first edge contains
+        from_index, each edge contains the index after the end of the
+        previous one and only the last edge ends at or after to_index.
+
+        Whether there is a path of exactly n steps from an index is
+        memoized, so each edge is only looked at once per length no
+        matter how many paths go through it, and searches never
+        follow edges which can't lead to a path of the right length.
+
+        If cost_func is set, the cheapest path from each index is
+        memoized too, see min_costs().
+    """
+    def __init__(self, graph, from_index, to_index, cost_func=None):
+        self.graph = graph
+        self.from_index = from_index
+        self.to_index = to_index
+        # edge -> cost of using it.
+        self.cost_func = cost_func
+        # (index, max_len) -> cost of the cheapest path with max_len or
+        # fewer edges.
+        self.costs = {}
+        # index -> edges containing it in graph.contain() order.
+        self.containing = {}
+        # index -> edges containing it, most canonical first.
+        self.preferred = {}
+        # (index, steps) -> True if there's a path with exactly steps edges.
+        self.reachable = {}
+        # (index, steps) -> edges of the first path from index, for
+        # indices covering_paths() has returned all paths from.
+        self.covered = {}
+
+    def for_start(self, from_index):
+        """ Returns a PathSolver for paths from from_index which shares
+            this one's memos.
+
+            The memos don't depend on from_index, but they are only
+            valid as long as the graph doesn't change. """
+        solver = copy.copy(self)
+        solver.from_index = from_index
+        return solver
+
+    def edges(self, index, preferred=True):
+        """ Returns the edges containing index. """
+        edges = self.containing.get(index)
+        if edges is None:
+            edges = self.graph.contain(index)
+            self.containing[index] = edges
+            self.preferred[index] = sorted(edges, key=canonical_key,
+                                           reverse=True)
+        if preferred:
+            return self.preferred[index]
+        return edges
+
+    def can_reach(self, index, steps):
+        """ INTERNAL: Returns False if no path from index with steps
+            or fewer edges can reach to_index.
+
+            Cheap, but may return True when there is no such path. """
+        for dummy in range(steps):
+            end = self.graph.edge_table.furthest_end(index)
+            if end is None or end < index:
+                return False
+            if end >= self.to_index:
+                return True
+            index = end + 1
+        return False
+
+    def has_path(self, index, steps):
+        """ Returns True if there is a path from index to to_index with
+            exactly steps edges. """
+        key = (index, steps)
+        value = self.reachable.get(key)
+        if value is None:
+            value = False
+            if not self.can_reach(index, steps):
+                self.reachable[key] = value
+                return value
+            for edge in self.edges(index):
+                if edge[1] >= self.to_index:
+                    value = steps == 1
+                elif steps > 1:
+                    value = self.has_path(edge[1] + 1, steps - 1)
+                if value:
+                    break
+            self.reachable[key] = value
+        return value
+
+    def shortest_length(self, max_len):
+        """ Returns the number of edges in the shortest path, or None
+            if there's no path with max_len or fewer edges. """
+        for steps in range(1, max_len + 1):
+            if self.has_path(self.from_index, steps):
+                return steps
+        return None
+
+    def paths(self, steps, index=None, partial_path=()):
+        """ A generator which returns the paths with exactly steps edges
+            in descending order of 'canonicalness'. """
+        if index is None:
+            index = self.from_index
+        if not self.has_path(index, steps):
+            return
+        for edge in self.edges(index):
+            if edge[1] >= self.to_index:
+                if steps == 1:
+                    yield list(partial_path + (edge,))
+            elif steps > 1:
+                for path in self.paths(steps - 1, edge[1] + 1,
+                                       partial_path + (edge,)):
+                    yield path
+
+    def covering_paths(self, steps, index=None, partial_path=()):
+        """ Like paths(), but once all paths from an index have been
+            returned, the other paths through it are cut short to the
+            first one.
+
+            Every edge paths() returns is returned too, and edges
+            first appear in the same order. """
+        if index is None:
+            index = self.from_index
+        if not self.has_path(index, steps):
+            return
+        key = (index, steps)
+        first = self.covered.get(key)
+        if not first is None:
+            yield list(partial_path) + first
+            return
+        for edge in self.edges(index):
+            if edge[1] >= self.to_index:
+                if steps == 1:
+                    if first is None:
+                        first = [edge, ]
+                    yield list(partial_path + (edge,))
+            elif steps > 1:
+                for path in self.covering_paths(steps - 1, edge[1] + 1,
+                                                partial_path + (edge,)):
+                    if first is None:
+                        first = path[len(partial_path):]
+                    yield path
+        self.covered[key] = first
+
+    def has_short_path(self, index, max_len):
+        """ INTERNAL: Returns True if there is a path from index to
+            to_index with max_len or fewer edges. """
+        for steps in range(1, max_len + 1):
+            if self.has_path(index, steps):
+                return True
+        return False
+
+    def update_paths(self, max_len, index=None, partial_path=()):
+        """ Returns a list of all paths with max_len or fewer edges,
+            in the order UpdateGraph.enumerate_update_paths() returns
+            them. """
+        if index is None:
+            index = self.from_index
+        ret = []
+        # (edge iterator, max_len, partial_path) for each step.
+        stack = []
+        if self.has_short_path(index, max_len):
+            stack.append((iter(self.edges(index, False)), max_len,
+                          partial_path))
+        while stack:
+            edges, max_len, partial_path = stack[-1]
+            edge = next(edges, None)
+            if edge is None:
+                stack.pop()
+            elif edge[1] >= self.to_index:
+                ret.append(partial_path + (edge,))
+            elif self.has_short_path(edge[1] + 1, max_len - 1):
+                stack.append((iter(self.edges(edge[1] + 1, False)),
+                              max_len - 1, partial_path + (edge,)))
+        return ret
+
+    def min_costs(self, max_len):
+        """ Returns a dictionary of (index, steps) -> the cost of the
+            cheapest path from index to to_index with steps or fewer
+            edges, for every index a path from from_index with
+            max_len or fewer edges goes through. There's no entry if
+            there's no such path. """
+        key = (self.from_index, max_len)
+        if key in self.costs or not self.has_short_path(self.from_index,
+                                                        max_len):
+            return self.costs
+
+        # The indices the paths go through after each number of steps.
+        levels = [set([self.from_index])]
+        for dummy in range(max_len - 1):
+            level = set([])
+            for index in levels[-1]:
+                for edge in self.edges(index, False):
+                    if edge[1] < self.to_index:
+                        level.add(edge[1] + 1)
+            levels.append(level)
+
+        # Then work back from to_index one step at a time.
+        for steps in range(1, max_len + 1):
+            for index in levels[max_len - steps]:
+                if (index, steps) in self.costs:
+                    continue
+                best = None
+                for edge in self.edges(index, False):
+                    if edge[1] >= self.to_index:
+                        rest = 0
                     else:
-                        tail(steps).pop()
-                else:
-                    # Abandon the path because it's too long.
-                    tail(steps).pop()
-
-            # Get rid of the empty list
-            assert len(tail(steps)) == 0
-            steps.pop()
-        if min_search_len == -1:
-            #print "No such path."
+                        rest = self.costs.get((edge[1] + 1, steps - 1))
+                        if rest is None:
+                            continue
+                    cost = self.cost_func(edge) + rest
+                    if best is None or cost < best:
+                        best = cost
+                if not best is None:
+                    self.costs[(index, steps)] = best
+        return self.costs
+
+    def first_step_costs(self, max_len):
+        """ Returns a list of (cost, edge) tuples with the cost of the
+            cheapest path with max_len or fewer edges starting with
+            each edge that has one. """
+        costs = self.min_costs(max_len)
+        ret = []
+        for edge in self.edges(self.from_index, False):
+            if edge[1] >= self.to_index:
+                rest = 0
+            else:
+                rest = costs.get((edge[1] + 1, max_len - 1))
+                if rest is None:
+                    continue
+            ret.append((self.cost_func(edge) + rest, edge))
+        return ret
+
+    def cheapest_paths(self, max_len):
+        """ A generator which returns (cost, path) tuples for all paths
+            with max_len or fewer edges in ascending order of cost.
+
+            The memoized cheapest costs to finish from each index
+            tell exactly how much each partial path will cost at
+            best, so partial paths that can't finish are dropped and
+            getting the first k paths only expands partial paths
+            that are cheaper than the kth one. Paths with the same
+            cost are returned in the order they were found.
+        """
+        costs = self.min_costs(max_len)
+        if not (self.from_index, max_len) in costs:
             return
-        min_search_len += 1
+        # (best total cost, ordinal, cost so far, index, steps, path)
+        # index is None for complete paths.
+        heap = [(costs[(self.from_index, max_len)], 0, 0, self.from_index,
+                 max_len, ())]
+        ordinal = 1
+        while heap:
+            dummy, dummy, cost, index, steps, path = heapq.heappop(heap)
+            if index is None:
+                yield cost, list(path)
+                continue
+            for edge in self.edges(index, False):
+                edge_cost = cost + self.cost_func(edge)
+                if edge[1] >= self.to_index:
+                    entry = (edge_cost, ordinal, edge_cost, None, 0,
+                             path + (edge,))
+                else:
+                    rest = costs.get((edge[1] + 1, steps - 1))
+                    if rest is None:
+                        continue
+                    entry = (edge_cost + rest, ordinal, edge_cost,
+                             edge[1] + 1, steps - 1, path + (edge,))
+                heapq.heappush(heap, entry)
+                ordinal += 1
 
-    #print "exiting"
-    # Done iterating.
+def canonical_path_itr(graph, from_index, to_index, max_search_len):
+    """ A generator which returns a sequence of canonical paths in
+        descending order of 'canonicalness'.
+
+        i.e. The shortest paths first, and paths of the same length
+        in order of their most recent, most redundant steps. """
+    solver = PathSolver(graph, from_index, to_index)
+    shortest = solver.shortest_length(max_search_len)
+    if shortest is None:
+        #print "No such path."
+        return
+    for steps in range(shortest, max_search_len + 1):
+        for path in solver.paths(steps):
+            yield path
+
+def covering_path_itr(graph, from_index, to_index, max_search_len):
+    """ A generator which returns paths containing the same edges as
+        canonical_path_itr(), in the same order of first appearance,
+        without returning every path. """
+    solver = PathSolver(graph, from_index, to_index)
+    shortest = solver.shortest_length(max_search_len)
+    if shortest is None:
+        return
+    for steps in range(shortest, max_search_len + 1):
+        for path in solver.covering_paths(steps):
+            yield path
 
 def get_changes(repo, version_map, versions):
     """ INTERNAL: Helper function used by UpdateGraph.update()
@@ -246,11 +498,16 @@ def get_changes(repo, version_map, versions):
 def block_cost(length):
     """ Return the number of Freenet blocks required to store
         data of length, length. """
-    blocks = length/FREENET_BLOCK_LEN
+    blocks = length // FREENET_BLOCK_LEN
     if (length % FREENET_BLOCK_LEN) != 0:
         blocks += 1
     return blocks
 
+# Modes for UpdateGraph.rep_invariant().
+INVARIANT_STRUCTURAL = 1
+INVARIANT_INCREMENTAL = 2
+INVARIANT_FULL = 3
+
 class UpdateGraphException(Exception):
     """ Base class for UpdateGraph exceptions. """
     def __init__(self, msg):
@@ -262,6 +519,284 @@ class UpToDate(UpdateGraphException):
     def __init__(self, msg):
         UpdateGraphException.__init__(self, msg)
 
+# Edges spanning more indices than this are rare. EdgeTable scans them
+# separately.
+SHORT_EDGE_SPAN = 64
+
+class IndexTable(CowDict):
+    """ The index_table of an UpdateGraph.
+
+        A CowDict which also keeps a head rev -> index map and the
+        heads of the graph up to each index up to date, so that
+        get_heads() and latest_index() don't have to scan the whole
+        table.
+    """
+    def __init__(self, *args, **kwargs):
+        # head rev -> index
+        self.head_index = CowDict()
+        # Incremented on every change.
+        self.version = 0
+        # The heads of the graph up to each index, valid if
+        # heads_version == version.
+        self.heads_version = -1
+        # index -> heads tuple
+        self.heads_by_index = None
+        # The heads for the last index in heads_by_index.
+        self.current_heads = None
+        # base rev -> True for all indices in heads_by_index.
+        self.all_bases = None
+        # False if the heads_* values are shared with a copy.
+        self.owns_heads = True
+        # Indices changed since the last UpdateGraph.rep_invariant().
+        self.touched = set([])
+        CowDict.__init__(self, *args, **kwargs)
+
+    def __setitem__(self, index, entry):
+        # Adding the next index doesn't require rebuilding the heads.
+        extend = (self.heads_version == self.version and
+                  not index in self.heads_by_index and
+                  index - 1 in self.heads_by_index)
+        if index in self:
+            self.unindex(index)
+        CowDict.__setitem__(self, index, entry)
+        for head in entry[1]:
+            previous = self.head_index.get(head)
+            if not previous is None and previous != index:
+                # So rep_invariant() sees the duplicate head.
+                self.touched.add(previous)
+            self.head_index[head] = index
+        self.version += 1
+        self.touched.add(index)
+        if extend:
+            if not self.owns_heads:
+                self.heads_by_index = self.heads_by_index.copy()
+                self.current_heads = set(self.current_heads)
+                self.all_bases = self.all_bases.copy()
+                self.owns_heads = True
+            self.add_heads(index, entry)
+            self.heads_version = self.version
+
+    def __delitem__(self, index):
+        self.unindex(index)
+        CowDict.__delitem__(self, index)
+        self.version += 1
+        self.touched.add(index)
+
+    def unindex(self, index):
+        """ INTERNAL: Remove the heads of index from head_index. """
+        for head in self[index][1]:
+            if self.head_index.get(head) == index:
+                del self.head_index[head]
+
+    def clear(self):
+        """ Implementation of dict method. """
+        self.touched.update(self.ordered_keys())
+        CowDict.clear(self)
+        self.head_index.clear()
+        self.version += 1
+
+    def copy(self):
+        """ Returns a copy which shares everything with this one. """
+        copied = CowDict.copy(self)
+        copied.head_index = self.head_index.copy()
+        copied.touched = set(self.touched)
+        self.owns_heads = False
+        copied.owns_heads = False
+        return copied
+
+    def add_heads(self, index, entry):
+        """ INTERNAL: Add the heads up to index to heads_by_index. """
+        for base in entry[0]:
+            self.all_bases[base] = True
+        self.current_heads.difference_update(entry[0])
+        self.current_heads.update([head for head in entry[1]
+                                   if not head in self.all_bases])
+        self.heads_by_index[index] = tuple(sorted(self.current_heads))
+
+    def heads(self, to_index):
+        """ Returns the sorted tuple of heads of all indices up to
+            and including to_index, or None if the indices up to
+            to_index aren't contiguous. """
+        if self.heads_version != self.version:
+            # Build for every index in one pass.
+            self.heads_by_index = CowDict()
+            self.current_heads = set([])
+            self.all_bases = CowDict()
+            self.owns_heads = True
+            index = FIRST_INDEX
+            while index in self:
+                self.add_heads(index, self[index])
+                index += 1
+            self.heads_version = self.version
+        return self.heads_by_index.get(to_index)
+
+class EdgeTable(CowDict):
+    """ The edge_table of an UpdateGraph.
+
+        A CowDict which also keeps start index -> end indices and end
+        index -> start indices maps up to date, and caches the
+        results of UpdateGraph.contain().
+    """
+    def __init__(self, *args, **kwargs):
+        # start index -> frozenset of end indices
+        self.outgoing = CowDict()
+        # end index -> frozenset of start indices
+        self.incoming = CowDict()
+        # Sorted list of all start indices.
+        self.starts = []
+        # The highest end index of the edges starting at or before
+        # starts[n]. Built when needed.
+        self.max_ends = None
+        # False if starts and max_ends are shared with a copy.
+        self.owns_lists = True
+        # Edges longer than SHORT_EDGE_SPAN.
+        self.long_edges = frozenset([])
+        # index -> list of edge triples containing it.
+        self.contain_cache = {}
+        # Edges changed since the last UpdateGraph.rep_invariant().
+        self.touched = set([])
+        # Incremented on every change.
+        self.version = 0
+        CowDict.__init__(self, *args, **kwargs)
+
+    def own_lists(self):
+        """ INTERNAL: Copy starts and max_ends if they are shared. """
+        if not self.owns_lists:
+            self.starts = list(self.starts)
+            if not self.max_ends is None:
+                self.max_ends = list(self.max_ends)
+            self.owns_lists = True
+
+    def __setitem__(self, pair, edge_info):
+        if not pair in self:
+            self.own_lists()
+            ends = self.outgoing.get(pair[0])
+            if ends is None:
+                bisect.insort(self.starts, pair[0])
+                if not self.max_ends is None:
+                    self.add_max_end(pair[0])
+                ends = frozenset([])
+            self.outgoing[pair[0]] = ends | frozenset([pair[1]])
+            self.incoming[pair[1]] = (self.incoming.get(pair[1], frozenset([]))
+                                      | frozenset([pair[0]]))
+            if pair[1] - pair[0] > SHORT_EDGE_SPAN:
+                self.long_edges = self.long_edges | frozenset([pair])
+            self.raise_max_ends(pair)
+            self.contain_cache = {}
+        elif len(self[pair]) != len(edge_info):
+            # Added a redundant CHK.
+            self.contain_cache = {}
+        CowDict.__setitem__(self, pair, edge_info)
+        self.touched.add(pair)
+        self.version += 1
+
+    def add_max_end(self, start):
+        """ INTERNAL: Make room in max_ends for a new start index. """
+        position = bisect.bisect_left(self.starts, start)
+        if position == 0:
+            self.max_ends.insert(0, FIRST_INDEX)
+        else:
+            self.max_ends.insert(position,
+                                 max(self.max_ends[position - 1], start))
+
+    def raise_max_ends(self, pair):
+        """ INTERNAL: Update max_ends for a new edge. """
+        if self.max_ends is None:
+            return
+        for position in range(bisect.bisect_left(self.starts, pair[0]),
+                              len(self.max_ends)):
+            if self.max_ends[position] >= pair[1]:
+                break
+            self.max_ends[position] = pair[1]
+
+    def __delitem__(self, pair):
+        CowDict.__delitem__(self, pair)
+        self.own_lists()
+        ends = self.outgoing[pair[0]] - frozenset([pair[1]])
+        if ends:
+            self.outgoing[pair[0]] = ends
+        else:
+            del self.outgoing[pair[0]]
+            del self.starts[bisect.bisect_left(self.starts, pair[0])]
+        starts = self.incoming[pair[1]] - frozenset([pair[0]])
+        if starts:
+            self.incoming[pair[1]] = starts
+        else:
+            del self.incoming[pair[1]]
+        self.long_edges = self.long_edges - frozenset([pair])
+        self.contain_cache = {}
+        self.max_ends = None
+        self.touched.add(pair)
+        self.version += 1
+
+    def clear(self):
+        """ Implementation of dict method. """
+        self.touched.update(self.ordered_keys())
+        CowDict.clear(self)
+        self.outgoing.clear()
+        self.incoming.clear()
+        self.starts = []
+        self.max_ends = None
+        self.owns_lists = True
+        self.long_edges = frozenset([])
+        self.contain_cache = {}
+        self.version += 1
+
+    def copy(self):
+        """ Returns a copy which shares everything with this one. """
+        copied = CowDict.copy(self)
+        copied.outgoing = self.outgoing.copy()
+        copied.incoming = self.incoming.copy()
+        copied.touched = set(self.touched)
+        # The cached lists are shared. Edges aren't.
+        self.owns_lists = False
+        copied.owns_lists = False
+        return copied
+
+    def furthest_end(self, index):
+        """ Returns the highest end index of all edges which contain
+            index or any index before it, or None if there aren't
+            any. """
+        if self.max_ends is None:
+            max_ends = []
+            highest = FIRST_INDEX
+            for start in self.starts:
+                highest = max(highest, max(self.outgoing[start]))
+                max_ends.append(highest)
+            self.max_ends = max_ends
+        position = bisect.bisect_left(self.starts, index)
+        if position == 0:
+            return None
+        return self.max_ends[position - 1]
+
+    def contain(self, contains_index):
+        """ Returns a list of edge triples which contain contains_index.
+
+            The result is cached until the table changes. Don't
+            modify it.
+        """
+        ret = self.contain_cache.get(contains_index)
+        if not ret is None:
+            return ret
+        # Short edges which contain contains_index must start less
+        # than SHORT_EDGE_SPAN indices before it.
+        pairs = [(start, end) for start in
+                 self.starts[bisect.bisect_left(self.starts, contains_index
+                                                - SHORT_EDGE_SPAN):
+                             bisect.bisect_left(self.starts, contains_index)]
+                 for end in self.outgoing[start]
+                 if end >= contains_index and end - start <= SHORT_EDGE_SPAN]
+        pairs += [pair for pair in self.long_edges
+                  if pair[0] < contains_index <= pair[1]]
+        # Same order as iterating the table.
+        pairs.sort(key=self.ordinal)
+        ret = []
+        for pair in pairs:
+            for index in range(0, len(self[pair]) - 1):
+                ret.append(pair + (index,))
+        self.contain_cache[contains_index] = ret
+        return ret
+
 class UpdateGraph:
     """ A digraph representing an Infocalypse Freenet
         hg repository. """ # REDFLAG: digraph of what dude?
@@ -273,7 +808,7 @@ class UpdateGraph:
         # need to bundle a collection of changes.
         #
         # index_ordinal -> ((base_revs, ), (tip_revs, ))
-        self.index_table = {FIRST_INDEX:((), (NULL_REV,))}
+        self.index_table = IndexTable({FIRST_INDEX:((), (NULL_REV,))})
 
         # These are edges in the update digraph.
         # There can be multiple redundant edges.
@@ -282,13 +817,19 @@ class UpdateGraph:
         # Edges contain changesets for the indices from
         # start_index + 1 to end_index, but not for start_index.
         # (start_index, end_index) -> (length, chk@, chk@,  ...)
-        self.edge_table = {}
+        self.edge_table = EdgeTable()
 
         self.latest_index = -1
 
     def clone(self):
-        """ Return a deep copy of the graph. """
-        return copy.deepcopy(self) # REDFLAG: correct
+        """ Return a copy of the graph.
+
+            The copy shares the index and edge tables with this
+            graph until either one changes them. """
+        graph = copy.copy(self)
+        graph.index_table = self.index_table.copy()
+        graph.edge_table = self.edge_table.copy()
+        return graph
 
     # Contains the end_index changesets but not the start index changesets.
     def add_edge(self, index_pair, length_chk_pair):
@@ -441,17 +982,22 @@ class UpdateGraph:
     # REDFLAG: really no need for ui? if so, remove arg
     # Index and edges to insert
     # Returns index triples with new edges that need to be inserted.
-    def update(self, repo, dummy, versions, cache):
+    def update(self, repo, dummy, versions, cache, version_map=None):
         """ Update the graph to include versions up to version
             in repo.
 
             This may add multiple edges for redundancy.
 
+            version_map is the version table for the graph before
+            the update. It is loaded with load_version_table() if
+            it is None.
+
             Returns the new edges.
 
             The client code is responsible for setting their CHKs!"""
 
-        version_map = build_version_table(self, repo)
+        if version_map is None:
+            version_map = load_version_table(self, repo)
 
         base_revs, new_heads = get_changes(repo, version_map, versions)
 
@@ -460,6 +1006,15 @@ class UpdateGraph:
         #for version in new_heads:
         #    version_map[version] = self.latest_index + 1
 
+        return self.add_changes(base_revs, new_heads, version_map, cache)
+
+    def add_changes(self, base_revs, new_heads, version_map, cache):
+        """ Add an index for new_heads and the edges required to
+            reach it.
+
+            This is the part of update() which doesn't need the repo.
+
+            Returns the new edges. """
         index = self.add_index(list(base_revs), new_heads)
         new_edges = []
 
@@ -564,21 +1119,8 @@ class UpdateGraph:
         """ INTERNAL: Returns a list of paths from the start index to the end
             index. """
 
-        if max_len <= 0:
-            return []
-        ret = []
-
-        candidates = self.contain(containing_start)
-        #print "CANDIDATES: ", candidates
-        for candidate in candidates:
-            if candidate[1] >= to_end:
-                ret.append(partial_path + (candidate,))
-            else:
-                ret += self.enumerate_update_paths(candidate[1] + 1, to_end,
-                                                   max_len - 1,
-                                                   partial_path
-                                                   + (candidate,))
-        return ret
+        return PathSolver(self, containing_start,
+                          to_end).update_paths(max_len, None, partial_path)
 
     # REQUIRES: Using the same index mappings!
     def copy_path(self, from_graph, path):
@@ -623,15 +1165,24 @@ class UpdateGraph:
     # Returns ((start_index, end_index, chk_list_ordinal), ...)
     def contain(self, contains_index):
         """ Returns a list of edge triples which contain contains_index. """
-        ret = []
-        for pair in self.edge_table:
-            if pair[0] >= contains_index:
-                continue
-            if pair[1] < contains_index:
-                continue
-            for index in range(0, len(self.edge_table[pair]) - 1):
-                ret.append(pair + (index,))
-        return ret
+        return list(self.edge_table.contain(contains_index))
+
+    def edges_from(self, index):
+        """ Returns a sorted list of the (start_index, end_index) pairs of
+            the edges starting at index. """
+        return [(index, end) for end in
+                sorted(self.edge_table.outgoing.get(index, ()))]
+
+    def edges_to(self, index):
+        """ Returns a sorted list of the (start_index, end_index) pairs of
+            the edges ending at index. """
+        return [(start, index) for start in
+                sorted(self.edge_table.incoming.get(index, ()))]
+
+    def head_index(self, version):
+        """ Returns the index which has version as a head, or None
+            if there isn't one. """
+        return self.index_table.head_index.get(version)
 
     def cmp_recency(self, path_a, path_b):
         """ INTERNAL: A comparison function for sorting single edge paths
@@ -738,8 +1289,98 @@ class UpdateGraph:
             ret.append(edge)
         return ret
 
-    def rep_invariant(self, repo=None, full=True):
-        """ Debugging function to check invariants. """
+    def rep_invariant(self, repo=None, full=True, mode=None):
+        """ Debugging function to check invariants.
+
+            mode is one of:
+            INVARIANT_STRUCTURAL -- Constant time checks of the table
+                                    sizes and bounds.
+            INVARIANT_INCREMENTAL -- The structural checks and checks of
+                                     the indices and edges changed
+                                     since the last incremental or
+                                     full check. Checks that their
+                                     revs are in repo if it is set.
+            INVARIANT_FULL -- Check everything. If repo is set, check
+                              the version table too, and if full is
+                              True that it contains every changeset.
+
+            The default is INVARIANT_FULL if repo is set and
+            INVARIANT_INCREMENTAL otherwise. """
+        if mode is None:
+            mode = INVARIANT_INCREMENTAL
+            if not repo is None:
+                mode = INVARIANT_FULL
+        if (mode != INVARIANT_FULL and
+            not (isinstance(self.index_table, IndexTable) and
+                 isinstance(self.edge_table, EdgeTable))):
+            # Can't tell what changed.
+            mode = INVARIANT_FULL
+
+        if mode == INVARIANT_STRUCTURAL:
+            self.structural_rep_invariant()
+            return
+        if mode == INVARIANT_FULL:
+            self.full_rep_invariant(repo, full)
+        else:
+            self.structural_rep_invariant()
+            self.touched_rep_invariant(repo)
+
+        if isinstance(self.index_table, IndexTable):
+            self.index_table.touched = set([])
+        if isinstance(self.edge_table, EdgeTable):
+            self.edge_table.touched = set([])
+
+    def structural_rep_invariant(self):
+        """ INTERNAL: Constant time invariant checks. """
+        assert self.index_table[FIRST_INDEX][0] == ()
+        assert self.index_table[FIRST_INDEX][1] == (NULL_REV, )
+        assert self.latest_index in self.index_table
+        assert not self.latest_index + 1 in self.index_table
+        # Together with the checks on every changed index, this means
+        # the indices are contiguous.
+        assert len(self.index_table) == self.latest_index - FIRST_INDEX + 1
+
+        starts = self.edge_table.starts
+        assert len(starts) == len(self.edge_table.outgoing)
+        if starts:
+            assert starts[0] >= FIRST_INDEX
+            assert starts[-1] < self.latest_index
+
+    def touched_rep_invariant(self, repo=None):
+        """ INTERNAL: Invariant checks for the indices and edges
+            changed since the last check. """
+        for index in self.index_table.touched:
+            if not index in self.index_table:
+                # No dangling edges.
+                assert not index in self.edge_table.outgoing
+                assert not index in self.edge_table.incoming
+                continue
+            assert FIRST_INDEX <= index <= self.latest_index
+            if index == FIRST_INDEX:
+                continue
+            # Each index except for the empty graph sentinel
+            # must have at least one base and head rev.
+            bases, heads = self.index_table[index]
+            assert len(bases) > 0
+            assert len(heads) > 0
+            if repo is None:
+                continue
+            for version in bases + heads:
+                assert has_version(repo, version)
+            for version in heads:
+                # Each head should appear in one and only one index.
+                assert self.index_table.head_index[version] == index
+
+        for edge in self.edge_table.touched:
+            if not edge in self.edge_table:
+                continue
+            # All edges must be resolvable.
+            assert edge[0] in self.index_table
+            assert edge[1] in self.index_table
+            assert edge[0] < edge[1]
+
+    def full_rep_invariant(self, repo=None, full=True):
+        """ INTERNAL: Check every invariant. """
         max_index = -1
         min_index = -1
         for index in list(self.index_table.keys()):
@@ -813,18 +1454,20 @@ class UpdateGraph:
                 assert not version in every_head
                 every_head.add(version)
 
-# REDFLAG: O(n), has_index().
 def latest_index(graph, repo):
     """ Returns the index of the latest hg version in the graph
         that exists in repo. """
     graph.rep_invariant()
+    # Heads usually stay heads for many indices. Only ask repo once.
+    present = {}
     for index in range(graph.latest_index, FIRST_INDEX - 1, -1):
         if not index in graph.index_table:
             continue
-        # BUG: Dog slow for big repos? cache index -> heads map
         skip = False
         for head in get_heads(graph, index):
-            if not has_version(repo, head):
+            if not head in present:
+                present[head] = has_version(repo, head)
+            if not present[head]:
                 skip = True
                 break # Inner loop... grrr named continue?
 
@@ -901,27 +1544,135 @@ def print_list(msg, values):
     if len(values) == 0:
         print()
 # REDFLAG: is it a version_map or a version_table? decide an fix all names
-# REDFLAG: Scales to what? 10k nodes?
 # Returns version -> index mapping
 # REQUIRES: Every version is in an index!
 def build_version_table(graph, repo):
     """ INTERNAL: Build a version -> index ordinal map for all changesets
         in the graph. """
-    table = {NULL_REV:-1}
-    for index in range(0, graph.latest_index + 1):
-        assert index in graph.index_table
+    return extend_version_table(graph, repo, {NULL_REV:FIRST_INDEX},
+                                FIRST_INDEX + 1)
+
+def extend_version_table(graph, repo, table, first_index):
+    """ INTERNAL: Add the changesets first added in first_index or
+        later to a version table built for the earlier indices.
+
+        The ancestors of every version in the table are in it too,
+        so the walk back from each head can stop at the first
+        version it already knows. That makes the cost proportional
+        to the number of new changesets. """
+    for index in range(first_index, graph.latest_index + 1):
         dummy, heads = graph.index_table[index]
         for head in heads:
-            if not head in table:
-                assert not head in table
-                table[head] = index
-
-            ancestors = repo[head].ancestors()
-            for ancestor in ancestors:
-                version = hexlify(ancestor.node())
+            pending = [head, ]
+            while pending:
+                version = pending.pop()
                 if version in table:
                     continue
                 table[version] = index
+                pending += [hexlify(parent.node())
+                            for parent in repo[version].parents()]
+    return table
+
+# File in the repo's .hg directory that load_version_table() uses.
+VERSION_TABLE_FILE = b'infocalypse_versions'
+VERSION_TABLE_MAGIC = b'infocalypse version table 1\n'
+VERSION_TABLE_RECORD = struct.Struct('>20si')
+DIGEST_LEN = 20
+
+def index_digests(graph):
+    """ INTERNAL: Returns a list with a hash of the index entries up
+        to and including each index above FIRST_INDEX.
+
+        The hashes for two graphs match up to the first index where
+        they differ. """
+    digests = []
+    digest = b''
+    for index in range(FIRST_INDEX + 1, graph.latest_index + 1):
+        bases, heads = graph.index_table[index]
+        digest = sha1(digest + b':'.join(bases) + b'|'
+                      + b':'.join(heads)).digest()
+        digests.append(digest)
+    return digests
+
+def read_version_table(file_name):
+    """ INTERNAL: Returns (digests, table) for a file written by
+        write_version_table(). """
+    in_file = open(file_name, 'rb')
+    try:
+        data = in_file.read()
+    finally:
+        in_file.close()
+    if not data.startswith(VERSION_TABLE_MAGIC):
+        raise ValueError("Not a version table file.")
+    pos = len(VERSION_TABLE_MAGIC)
+    end = data.find(b'\n', pos)
+    if end == -1:
+        raise ValueError("Truncated version table file.")
+    pos, end = end + 1, end + 1 + int(data[pos:end]) * DIGEST_LEN
+    digests = [data[offset:offset + DIGEST_LEN]
+               for offset in range(pos, end, DIGEST_LEN)]
+    records = data[end:]
+    if len(records) % VERSION_TABLE_RECORD.size != 0:
+        raise ValueError("Truncated version table file.")
+    table = {NULL_REV:FIRST_INDEX}
+    for node, index in VERSION_TABLE_RECORD.iter_unpack(records):
+        table[hexlify(node)] = index
+    return digests, table
+
+def write_version_table(file_name, digests, table):
+    """ INTERNAL: Write a version table and the index_digests() of
+        the graph it was built for. """
+    tmp_name = file_name + b'.tmp'
+    out_file = open(tmp_name, 'wb')
+    try:
+        out_file.write(VERSION_TABLE_MAGIC)
+        out_file.write(b'%i\n' % len(digests))
+        out_file.write(b''.join(digests))
+        out_file.write(b''.join([VERSION_TABLE_RECORD.pack(unhexlify(version),
+                                                           index)
+                                 for version, index in table.items()
+                                 if version != NULL_REV]))
+    finally:
+        out_file.close()
+    # Don't leave a half written file behind.
+    os.replace(tmp_name, file_name)
+
+def load_version_table(graph, repo):
+    """ Returns the same version table as build_version_table().
+
+        The table is saved in the repo's .hg directory along with
+        hashes of the index entries it was built from. The entries
+        for the leading indices graph shares with the saved graph are
+        reused, so usually only the changesets added by the new
+        indices are looked up in the repo. """
+    file_name = os.path.join(repo.path, VERSION_TABLE_FILE)
+    try:
+        saved_digests, table = read_version_table(file_name)
+    except (IOError, ValueError, struct.error):
+        saved_digests, table = [], {NULL_REV:FIRST_INDEX}
+
+    digests = index_digests(graph)
+    shared = 0
+    for saved, digest in zip(saved_digests, digests):
+        if saved != digest:
+            break
+        shared += 1
+    # REDFLAG: Only catches repos stripped below the last shared index.
+    if (shared > 0 and
+        not has_version(repo, graph.index_table[shared - 1][1][0])):
+        shared = 0
+
+    if shared < len(saved_digests):
+        # Only keep the versions from the shared indices.
+        table = dict([(version, index) for version, index in table.items()
+                      if index < shared])
+    extend_version_table(graph, repo, table, shared)
+    if shared < len(digests) or shared < len(saved_digests):
+        try:
+            write_version_table(file_name, digests, table)
+        except IOError:
+            # Just slower next time.
+            pass
     return table
 
 # Find most recent ancestors for version which are already in
@@ -962,6 +1713,11 @@ def get_heads(graph, to_index=None):
     if to_index is None:
         to_index = graph.latest_index
 
+    if isinstance(graph.index_table, IndexTable):
+        heads = graph.index_table.heads(to_index)
+        if not heads is None:
+            return heads
+
     heads = set([])
     bases = set([])
     for index in range(FIRST_INDEX, to_index + 1):
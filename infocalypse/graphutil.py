@@ -19,12 +19,14 @@
     Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
 """
 
+import base64
+import bisect
 
-from binascii import hexlify
+from binascii import hexlify, unhexlify
 
 from .graph import FIRST_INDEX, MAX_PATH_LEN, UpdateGraph, \
-     UpdateGraphException, canonical_path_itr, edges_containing, INSERT_HUGE, \
-     INSERT_NORMAL, MAX_METADATA_HACK_LEN
+     UpdateGraphException, covering_path_itr, edges_containing, \
+     INSERT_HUGE, INSERT_NORMAL, MAX_METADATA_HACK_LEN
 
 ############################################################
 # Doesn't dump FIRST_INDEX entry.
@@ -161,6 +163,262 @@ def parse_v100_graph(text):
     return graph
 
 ############################################################
+# Binary graph format.
+#
+# <BINARY_GRAPH_MAGIC><version><number section length>
+# <number section><key part blob><rev blob>
+#
+# The number section is a sequence of varints:
+# <key part count> then for each: <kind><length>
+# <index count> then for each index above FIRST_INDEX:
+#   <index - previous index><base count><head count>
+# <edge count> then for each edge in sorted order:
+#   <start - previous start><end - start><length><CHK count>
+#   then for each CHK: <part count><key part table offsets...>
+#
+# The key part blob holds the key parts back to back and the rev
+# blob the 20 byte binary base and head revs of each index.
+#
+# CHKs are split at ',' and each distinct part is stored once, so
+# the shared trailing fields cost a byte or two per CHK. Keeping the
+# numbers together lets read_varints() decode them all in one loop.
+
+BINARY_GRAPH_MAGIC = b'\x89IGB'
+BINARY_GRAPH_VERSION = 1
+
+PART_RAW = 0 # Stored as is.
+PART_BASE64 = 1 # Freenet base64 stored decoded.
+PART_CHK_BASE64 = 2 # b'CHK@' + Freenet base64 stored decoded.
+
+def write_varint(value, out):
+    """ INTERNAL: Append value as a varint to the bytearray out. """
+    assert value >= 0
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(data, pos):
+    """ INTERNAL: Returns (value, pos) for the varint at data[pos]. """
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("Truncated binary graph.")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def read_varints(data):
+    """ INTERNAL: Returns the list of varints in data. """
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        if byte < 0x80:
+            values.append(value | (byte << shift))
+            value = 0
+            shift = 0
+        else:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+    if shift:
+        raise ValueError("Truncated binary graph.")
+    return values
+
+def encode_key_part(part):
+    """ INTERNAL: Returns (kind, bytes) for a CHK field. """
+    kind, encoded = PART_BASE64, part
+    if part.startswith(b'CHK@'):
+        kind, encoded = PART_CHK_BASE64, part[4:]
+    try:
+        raw = base64.b64decode(encoded + b'=' * (-len(encoded) % 4), b'~-')
+    except ValueError:
+        return PART_RAW, part
+    # Only if it comes back exactly the same.
+    if base64.b64encode(raw, b'~-').rstrip(b'=') != encoded:
+        return PART_RAW, part
+    return kind, raw
+
+def decode_key_parts(kinds, raws):
+    """ INTERNAL: The inverse of encode_key_part() for lists of
+        kinds and bytes. """
+    # Encoding them all at once is much faster. Zero padding each
+    # one to a multiple of 3 bytes keeps their encodings apart and
+    # doesn't change the characters before the '=' padding.
+    encoded = base64.b64encode(b''.join([raw + b'\0' * (-len(raw) % 3)
+                                         for raw in raws]), b'~-')
+    parts = []
+    pos = 0
+    for kind, raw in zip(kinds, raws):
+        end = pos + 4 * ((len(raw) + 2) // 3)
+        if kind == PART_RAW:
+            parts.append(raw)
+        elif kind == PART_BASE64:
+            parts.append(encoded[pos:pos + (4 * len(raw) + 2) // 3])
+        elif kind == PART_CHK_BASE64:
+            parts.append(b'CHK@' + encoded[pos:pos + (4 * len(raw) + 2) // 3])
+        else:
+            raise ValueError("Unknown key part kind: %i" % kind)
+        pos = end
+    return parts
+
+def graph_to_binary(graph):
+    """ Returns a compact binary representation of the graph.
+
+        Like graph_to_string() it doesn't include the FIRST_INDEX
+        entry and always returns the same bytes for the same graph. """
+    parts = {}
+    part_list = []
+    edge_numbers = bytearray()
+    index_pairs = list(graph.edge_table.keys())
+    index_pairs.sort()
+    write_varint(len(index_pairs), edge_numbers)
+    previous = FIRST_INDEX
+    for index_pair in index_pairs:
+        edge_info = graph.edge_table[index_pair]
+        write_varint(index_pair[0] - previous, edge_numbers)
+        write_varint(index_pair[1] - index_pair[0], edge_numbers)
+        write_varint(edge_info[0], edge_numbers)
+        write_varint(len(edge_info) - 1, edge_numbers)
+        for chk in edge_info[1:]:
+            fields = chk.split(b',')
+            write_varint(len(fields), edge_numbers)
+            for field in fields:
+                offset = parts.get(field)
+                if offset is None:
+                    offset = len(part_list)
+                    parts[field] = offset
+                    part_list.append(field)
+                write_varint(offset, edge_numbers)
+        previous = index_pair[0]
+
+    numbers = bytearray()
+    part_blob = bytearray()
+    write_varint(len(part_list), numbers)
+    for part in part_list:
+        kind, raw = encode_key_part(part)
+        write_varint(kind, numbers)
+        write_varint(len(raw), numbers)
+        part_blob += raw
+
+    rev_blob = bytearray()
+    indices = list(graph.index_table.keys())
+    indices.sort()
+    indices.remove(FIRST_INDEX)
+    write_varint(len(indices), numbers)
+    previous = FIRST_INDEX
+    for index in indices:
+        entry = graph.index_table[index]
+        write_varint(index - previous, numbers)
+        write_varint(len(entry[0]), numbers)
+        write_varint(len(entry[1]), numbers)
+        for rev in entry[0] + entry[1]:
+            if len(rev) != 40:
+                raise ValueError("Can't write short rev: %s" % rev)
+            rev_blob += unhexlify(rev)
+        previous = index
+    numbers += edge_numbers
+
+    out = bytearray(BINARY_GRAPH_MAGIC)
+    write_varint(BINARY_GRAPH_VERSION, out)
+    write_varint(len(numbers), out)
+    return bytes(out + numbers + part_blob + rev_blob)
+
+def parse_binary_graph(data):
+    """ Returns a graph parsed from data.
+        data must be in the format used by graph_to_binary().
+    """
+    if not data.startswith(BINARY_GRAPH_MAGIC):
+        raise ValueError("Not a binary graph.")
+    version, pos = read_varint(data, len(BINARY_GRAPH_MAGIC))
+    if version != BINARY_GRAPH_VERSION:
+        raise ValueError("Unsupported binary graph version: %i" % version)
+    length, pos = read_varint(data, pos)
+    if pos + length > len(data):
+        raise ValueError("Truncated binary graph.")
+    numbers = iter(read_varints(data[pos:pos + length]))
+    pos += length
+
+    try:
+        kinds = []
+        raws = []
+        for dummy in range(next(numbers)):
+            kinds.append(next(numbers))
+            length = next(numbers)
+            if pos + length > len(data):
+                raise ValueError("Truncated binary graph.")
+            raws.append(data[pos:pos + length])
+            pos += length
+        part_list = decode_key_parts(kinds, raws)
+
+        graph = UpdateGraph()
+        # Cheaper than hexlifying each rev.
+        revs = hexlify(data[pos:])
+        if len(revs) % 40 != 0:
+            raise ValueError("Truncated binary graph.")
+        pos = 0
+        index = FIRST_INDEX
+        for dummy in range(next(numbers)):
+            index += next(numbers)
+            parent_count = next(numbers)
+            head_count = next(numbers)
+            if parent_count < 1:
+                raise ValueError("index %i has no parent revs" % index)
+            if head_count < 1:
+                raise ValueError("index %i has no head revs" % index)
+            end = pos + 40 * parent_count
+            parents = tuple([revs[offset:offset + 40]
+                             for offset in range(pos, end, 40)])
+            pos = end + 40 * head_count
+            heads = tuple([revs[offset:offset + 40]
+                           for offset in range(end, pos, 40)])
+            graph.index_table[index] = (parents, heads)
+        if pos != len(revs):
+            raise ValueError("Wrong number of revs in binary graph.")
+
+        start = FIRST_INDEX
+        for dummy in range(next(numbers)):
+            start += next(numbers)
+            end = start + next(numbers)
+            edge_info = [next(numbers), ]
+            for dummy in range(next(numbers)):
+                edge_info.append(b','.join([part_list[next(numbers)]
+                                            for dummy in
+                                            range(next(numbers))]))
+            graph.edge_table[(start, end)] = tuple(edge_info)
+    except StopIteration:
+        raise ValueError("Truncated binary graph.")
+    except IndexError:
+        raise ValueError("Bad key part offset in binary graph.")
+    if not next(numbers, None) is None:
+        raise ValueError("Trailing numbers in binary graph.")
+
+    graph.latest_index = index
+    graph.rep_invariant()
+
+    return graph
+
+def parse_graph_data(data):
+    """ Returns a graph parsed from data in either the text or the
+        binary format.
+
+        Leading '#' lines, like the ones InsertingGraph adds to get
+        different CHKs for the same graph, are skipped. """
+    pos = 0
+    while data.startswith(b'#', pos):
+        end = data.find(b'\n', pos)
+        if end == -1:
+            break
+        pos = end + 1
+    if data.startswith(BINARY_GRAPH_MAGIC, pos):
+        return parse_binary_graph(data[pos:])
+    return parse_graph(data)
+
+############################################################
 
 
 def should_add_head(repo, version_table, head, to_index):
@@ -333,7 +591,7 @@ def important_edge_itr(graph, known_paths):
 
     # Edges which are in the canonical path
     index = graph.latest_index
-    canonical_paths = canonical_path_itr(graph, 0, index, MAX_PATH_LEN)
+    canonical_paths = covering_path_itr(graph, 0, index, MAX_PATH_LEN)
 
     for path in canonical_paths:
         for edge in path:
@@ -348,7 +606,7 @@ def important_edge_itr(graph, known_paths):
     # Then add bootstrap paths back to previous indices
     # Favors older edges.
     for upper_index in range(index - 1, FIRST_INDEX, - 1):
-        canonical_paths = canonical_path_itr(graph, 0, upper_index,
+        canonical_paths = covering_path_itr(graph, 0, upper_index,
                                              MAX_PATH_LEN)
         for path in canonical_paths:
             for edge in path:
@@ -358,7 +616,108 @@ def important_edge_itr(graph, known_paths):
                 yield edge
     return
 
-# Really slow
+def digit_count(count):
+    """ INTERNAL: Returns the total number of digits in 0 ... count - 1."""
+    total = 0
+    power = 1
+    digits = 1
+    while count > power * 10:
+        total += (power * 10 - power) * digits
+        power *= 10
+        digits += 1
+    if count > power:
+        total += (count - power) * digits
+    return total + min(count, 1)
+
+class GraphSizer:
+    """ INTERNAL: Keeps track of len(graph_to_string(subgraph(...)))
+        as edges are added, without building or formatting the
+        subgraph.
+
+        Adding an index only changes the index lines for it and the
+        next higher index that's kept. Renumbering only changes the
+        lengths of the numbers which become a power of ten.
+    """
+    def __init__(self, graph, repo, version_table):
+        self.graph = graph
+        self.repo = repo
+        self.version_table = version_table
+        # Sorted list of the kept indices. i.e. the vertices of the
+        # subgraph. The subgraph index is the position - 1.
+        self.indices = [FIRST_INDEX]
+        # index -> number of kept edges that start or end at it
+        self.references = {FIRST_INDEX:0}
+        # index -> length of its index line without the number.
+        self.index_lengths = {}
+        # index pairs of the kept edges
+        self.pairs = set([])
+        # All but the digits in the index lines.
+        self.length = 0
+        # The digits of the indices in the edge lines.
+        self.edge_digits = 0
+
+    def total(self):
+        """ Returns the length of the subgraph formatted with
+            graph_to_string(). """
+        if len(self.indices) == 1:
+            return 1 # Just the trailing '\n'
+        return self.length + self.edge_digits + digit_count(
+            len(self.indices) - 1)
+
+    def index_length(self, from_index, to_index):
+        """ INTERNAL: Length of the index line for to_index with
+            the changes from from_index rolled up into it, without the
+            number. """
+        if from_index == to_index:
+            bases, heads = self.graph.index_table[to_index]
+        else:
+            bases, heads = get_rollup_bounds(self.graph, self.repo,
+                                             from_index, to_index,
+                                             self.version_table)
+        # I:<index>:<bases>:|:<heads>\n
+        return (len(b':'.join(bases)) + len(b':'.join(heads))
+                + len(b'I::::|\n'))
+
+    def add_index(self, index):
+        """ INTERNAL: Add a vertex to the subgraph. """
+        position = bisect.bisect_left(self.indices, index)
+        # The subgraph index of everything above moves up one.
+        number = 9
+        while number < len(self.indices) - 1:
+            if number + 1 >= position:
+                self.edge_digits += self.references[self.indices[number + 1]]
+            number = number * 10 + 9
+
+        previous = self.indices[position - 1]
+        self.indices.insert(position, index)
+        self.references[index] = 0
+        self.index_lengths[index] = self.index_length(previous + 1, index)
+        self.length += self.index_lengths[index]
+        if position + 1 < len(self.indices):
+            above = self.indices[position + 1]
+            self.length -= self.index_lengths[above]
+            self.index_lengths[above] = self.index_length(index + 1, above)
+            self.length += self.index_lengths[above]
+
+    def add_edge(self, edge):
+        """ Add the edge (and all the other CHKs for its index pair) to
+            the subgraph. """
+        pair = edge[:2]
+        if pair in self.pairs:
+            return
+        self.pairs.add(pair)
+        for index in pair:
+            if not index in self.references:
+                self.add_index(index)
+            self.references[index] += 1
+            self.edge_digits += len(str(
+                bisect.bisect_left(self.indices, index) - 1))
+        edge_info = self.graph.edge_table[pair]
+        chks = b':'.join(edge_info[1:])
+        # E:<start>:<end>:<length>:<chk>...\n
+        self.length += (len(b'E:::\n') + len(str(edge_info[0])) +
+                        len(chks) + min(len(chks), 1))
+
 def minimal_graph(graph, repo, version_table, max_size=32*1024,
                   formatter_func=graph_to_string):
     """ Returns a subgraph that can be formatted to <= max_size
@@ -373,10 +732,36 @@ def minimal_graph(graph, repo, version_table, max_size=32*1024,
     index = graph.latest_index
     assert index > FIRST_INDEX
 
+    if formatter_func != graph_to_string:
+        return minimal_graph_formatted(graph, repo, version_table, max_size,
+                                       formatter_func)
+
     # All the edges that would be included in the top key.
     # This includes the canonical bootstrap path and the
     # two cheapest updates from the previous index.
     paths = [[edge, ] for edge in graph.get_top_key_edges()]
+    sizer = GraphSizer(graph, repo, version_table)
+    for path in paths:
+        sizer.add_edge(path[0])
+    if sizer.total() > max_size:
+        raise UpdateGraphException("Too big with only required paths (%i > %i)"
+                                   % (sizer.total(), max_size))
+
+    # Add edges in order of importance until one doesn't fit.
+    for edge in important_edge_itr(graph, paths):
+        sizer.add_edge(edge)
+        if sizer.total() > max_size:
+            break
+        paths.append([edge, ])
+
+    return subgraph(graph, repo, version_table, paths)
+
+# Really slow
+def minimal_graph_formatted(graph, repo, version_table, max_size,
+                            formatter_func):
+    """ INTERNAL: minimal_graph() for formatters other than
+        graph_to_string(). Formats every candidate subgraph. """
+    paths = [[edge, ] for edge in graph.get_top_key_edges()]
     minimal = subgraph(graph, repo, version_table, paths)
     length = len(formatter_func(minimal))
     if length > max_size:
@@ -32,14 +32,19 @@ from mercurial import commands
 
 from .fcpclient import parse_progress, is_usk, is_ssk, get_version, \
      get_usk_for_usk_version, FCPClient, is_usk_file, is_negative_usk
-from .fcpconnection import FCPConnection, PolledSocket, CONNECTION_STATES, \
-     get_code, FCPError
+from .fcpconnection import FCPConnection, PolledSocket, SelectorSocket, \
+     CONNECTION_STATES, get_code, FCPError
 from .fcpmessage import PUT_FILE_DEF
 
 from .requestqueue import RequestRunner
+from .tracing import RequestTracer, read_trace, summarize_trace, \
+     format_summary
 
 from .graph import UpdateGraph, get_heads, has_version
-from .bundlecache import BundleCache, is_writable, make_temp_file
+from .costmodel import cost_model_report, COST_FUNCS
+from .bundlecache import BundleCache, BundleStore, is_writable, \
+     make_temp_file
+from .bundlepool import make_bundle_pool
 from .updatesm import UpdateStateMachine, QUIESCENT, FINISHING, REQUESTING_URI, \
      REQUESTING_GRAPH, REQUESTING_BUNDLES, INVERTING_URI, \
      REQUESTING_URI_4_INSERT, INSERTING_BUNDLES, INSERTING_GRAPH, \
@@ -68,7 +73,16 @@ DEFAULT_PARAMS = {
     # Non-FCP stuff
     'N_CONCURRENT':8, # Maximum number of concurrent FCP requests.
     'CANCEL_TIME_SECS': 120 * 60, # Bound request time.
-    'POLL_SECS':1.00, # Time to sleep in the polling loop.
+    'POLL_SECS':1.00, # Max time to wait for socket activity in the loop.
+    'POLLED_SOCKET':False, # Sleep POLL_SECS between polls instead of select.
+    'N_UPLOAD_CONNECTIONS':1, # Extra FCP connections used only for uploads.
+    'PIPELINED_RETRIES':False, # Retry failed requests while others run.
+    'PACK_TOP_KEY':False, # Choose top key updates by simulated pulls.
+    'COST_MODEL':None, # Edge costs for pulls, a costmodel.COST_FUNCS name.
+    'BUNDLE_STORE_MB':0, # Keep up to this many MB of bundles between runs.
+    'BUNDLE_WORKERS':0, # Processes building bundles ahead of inserts.
+    'BUNDLE_PREBUILD_MB':64, # Bound on MB of bundles built ahead.
+    'BINARY_GRAPH':False, # Insert the graph in the binary format.
 
     # Testing HACKs
     #'TEST_DISABLE_GRAPH': True, # Disable reading the graph.
@@ -238,6 +252,39 @@ def get_config_info(ui_, opts):
             arg_name = b'requesturi'
 
         ui_.status(b'--nosearch ignored because --%s was not set.\n' % arg_name)
+    # e.g. [infocalypse] tracefile = ~/infocalypse_trace.jsonl
+    trace_file = ui_.config(b'infocalypse', b'tracefile', None)
+    if trace_file:
+        params['TRACE_FILE'] = os.path.expanduser(trace_file.decode('utf-8'))
+    # e.g. [infocalypse] bundlestore = 256
+    params['BUNDLE_STORE_MB'] = ui_.configint(b'infocalypse', b'bundlestore',
+                                              params['BUNDLE_STORE_MB'])
+    # e.g. [infocalypse] bundleworkers = 2
+    params['BUNDLE_WORKERS'] = ui_.configint(b'infocalypse', b'bundleworkers',
+                                             params['BUNDLE_WORKERS'])
+    # e.g. [infocalypse] binarygraph = True
+    params['BINARY_GRAPH'] = ui_.configbool(b'infocalypse', b'binarygraph',
+                                            params['BINARY_GRAPH'])
+    # e.g. [infocalypse] pipelinedretries = True
+    params['PIPELINED_RETRIES'] = ui_.configbool(b'infocalypse',
+                                                 b'pipelinedretries',
+                                                 params['PIPELINED_RETRIES'])
+    # e.g. [infocalypse] polledsocket = True
+    params['POLLED_SOCKET'] = ui_.configbool(b'infocalypse', b'polledsocket',
+                                             params['POLLED_SOCKET'])
+    # e.g. [infocalypse] packtopkey = True
+    params['PACK_TOP_KEY'] = ui_.configbool(b'infocalypse', b'packtopkey',
+                                            params['PACK_TOP_KEY'])
+    # e.g. [infocalypse] costmodel = latency
+    cost_model = ui_.config(b'infocalypse', b'costmodel', None)
+    if cost_model:
+        cost_model = cost_model.decode('utf-8')
+        if cost_model in COST_FUNCS:
+            params['COST_MODEL'] = cost_model
+        else:
+            ui_.warn(b'Ignored unknown costmodel: %s. Use one of: %s.\n'
+                     % (cost_model.encode('utf-8'),
+                        ', '.join(sorted(COST_FUNCS)).encode('utf-8')))
     params['AGGRESSIVE_SEARCH'] = (bool(opts.get('aggressive')) and
                                    not params['NO_SEARCH'])
     if bool(opts.get('aggressive')) and params['NO_SEARCH']:
@@ -299,9 +346,17 @@ def setup(ui_, repo, params, stored_cfg):
     if not repo is None:
         # BUG:? shouldn't this be reading TMP_DIR from stored_cfg
         cache = BundleCache(repo, ui_, params['TMP_DIR'])
+        if params.get('BUNDLE_STORE_MB', 0) > 0:
+            cache.store = BundleStore(os.path.join(cache.base_dir,
+                                                   b'bundles'),
+                                      params['BUNDLE_STORE_MB'] * 1024 * 1024)
 
     try:
-        async_socket = PolledSocket(params['FCP_HOST'], params['FCP_PORT'])
+        if params.get('POLLED_SOCKET'):
+            socket_class = PolledSocket
+        else:
+            socket_class = SelectorSocket
+        async_socket = socket_class(params['FCP_HOST'], params['FCP_PORT'])
         connection = FCPConnection(async_socket, True,
                                    callbacks.connection_state)
     except socket.error as err: # Not an IOError until 2.6.
@@ -314,6 +369,18 @@ def setup(ui_, repo, params, stored_cfg):
         raise err
 
     runner = RequestRunner(connection, params['N_CONCURRENT'])
+    if 'TMP_DIR' in params:
+        runner.memory_budget.tmp_dir = os.path.expanduser(params['TMP_DIR'])
+    # Run uploads on their own connections so that they don't block fetches.
+    for dummy in range(params.get('N_UPLOAD_CONNECTIONS', 0)):
+        try:
+            runner.add_connection(
+                FCPConnection(socket_class(params['FCP_HOST'],
+                                           params['FCP_PORT']), True),
+                True)
+        except (socket.error, IOError):
+            ui_.warn(b"Couldn't open an extra FCP connection for uploads.\n")
+            break
 
     if repo is None:
         # For incremental archives.
@@ -325,6 +392,9 @@ def setup(ui_, repo, params, stored_cfg):
         ctx.repo = repo
         ctx.ui_ = ui_
         ctx.bundle_cache = cache
+        ctx.bundle_pool = make_bundle_pool(
+            cache, params.get('BUNDLE_WORKERS', 0),
+            params.get('BUNDLE_PREBUILD_MB', 64) * 1024 * 1024)
         update_sm = UpdateStateMachine(runner, ctx)
 
 
@@ -332,6 +402,13 @@ def setup(ui_, repo, params, stored_cfg):
     update_sm.transition_callback = callbacks.transition_callback
     update_sm.monitor_callback = callbacks.monitor_callback
 
+    if params.get('TRACE_FILE'):
+        # Don't write insert URIs into the trace.
+        tracer = RequestTracer(open(params['TRACE_FILE'], 'a'),
+                               params.get('REQUEST_URI') or '')
+        runner.set_tracer(tracer)
+        update_sm.tracer = tracer
+
     # Modify only after copy.
     update_sm.params[b'FREENET_BUILD'] = runner.connection.node_hello[1][b'Build']
 
@@ -341,14 +418,13 @@ def run_until_quiescent(update_sm, poll_secs, close_socket=True):
     """ Run the state machine until it reaches the QUIESCENT state. """
     runner = update_sm.runner
     assert not runner is None
-    connection = runner.connection
-    assert not connection is None
+    assert not runner.connection is None
     raised = True
     try:
         while update_sm.current_state.name != QUIESCENT:
-            # Poll the FCP Connection.
+            # Poll the FCP Connections.
             try:
-                if not connection.socket.poll():
+                if not runner.poll():
                     print("run_until_quiescent -- poll returned False") 
                     # REDFLAG: jam into quiesent state?,
                     # CONNECTION_DROPPED state?
@@ -363,12 +439,13 @@ def run_until_quiescent(update_sm, poll_secs, close_socket=True):
                 # REDLAG: better message.
                 update_sm.ctx.ui_.warn("Exiting because of an IO error.\n")
                 raise
-            # Rest :-)
-            time.sleep(poll_secs)
+            # Rest until there's socket activity or the next timeout. :-)
+            if update_sm.current_state.name != QUIESCENT:
+                runner.wait(poll_secs)
         raised = False
     finally:
         if raised or close_socket:
-            update_sm.runner.connection.close()
+            update_sm.runner.close()
 
 def cleanup(update_sm):
     """ INTERNAL: Cleanup after running an Infocalypse command. """
@@ -376,7 +453,15 @@ def cleanup(update_sm):
         return
 
     if not update_sm.runner is None:
-        update_sm.runner.connection.close()
+        update_sm.runner.close()
+
+    if not update_sm.tracer is None:
+        update_sm.tracer.close()
+        update_sm.tracer = None
+
+    if not update_sm.ctx.bundle_pool is None:
+        update_sm.ctx.bundle_pool.close()
+        update_sm.ctx.bundle_pool = None
 
     if not update_sm.ctx.bundle_cache is None:
         update_sm.ctx.bundle_cache.remove_files()
@@ -700,9 +785,11 @@ def execute_pull(ui_, repo, params, stored_cfg):
 
 
 # Note: doesn't close the socket, but its ok because cleanup() does.
-def read_freenet_heads(params, update_sm, request_uri):
-    """ Helper function reads the know heads from Freenet. """
-    update_sm.start_requesting_heads(request_uri)
+def read_freenet_heads(params, update_sm, request_uri, require_graph=False):
+    """ Helper function reads the know heads from Freenet.
+
+        If require_graph is True, update_sm.ctx.graph is set too. """
+    update_sm.start_requesting_heads(request_uri, require_graph)
     run_until_quiescent(update_sm, params['POLL_SECS'], False)
     if update_sm.get_state(QUIESCENT).arrived_from(((FINISHING,))):
         if update_sm.ctx.graph is None:
@@ -767,16 +854,44 @@ def execute_info(ui_, repo, params, stored_cfg):
     ui_.status(INFO_FMT %
                (usk_hash, max_index or -1, trusted, request_uri, insert_uri))
 
+    cost_model = params.get('COST_MODEL_REPORT', False)
     update_sm = setup(ui_, repo, params, stored_cfg)
     try:
         ui_.status(b'Freenet head(s): %s\n' %
                    b' '.join([ver[:12] for ver in
                              read_freenet_heads(params, update_sm,
-                                                request_uri)]))
+                                                request_uri, cost_model)]))
+        if cost_model:
+            ui_.status(b'\n' + '\n'.join(cost_model_report(
+                update_sm.ctx.graph)).encode('utf-8') + b'\n')
     finally:
         cleanup(update_sm)
 
 
+def execute_trace(ui_, params):
+    """ Print percentiles for the requests in a trace file. """
+    trace_file = params.get('TRACE_FILE')
+    if not trace_file:
+        ui_.warn(b"No trace file. Set one with --file or the tracefile "
+                 b"option in the [infocalypse] section of your hgrc.\n")
+        return
+    if not os.path.exists(trace_file):
+        ui_.warn(b"Trace file doesn't exist: %s\n"
+                 % trace_file.encode('utf-8'))
+        return
+
+    in_file = open(trace_file, 'r')
+    try:
+        entries = read_trace(in_file, params.get('TRACE_LAST_RUN', False))
+    finally:
+        in_file.close()
+
+    runs = len([entry for entry in entries if entry['type'] == 'run'])
+    requests = len([entry for entry in entries if entry['type'] == 'request'])
+    ui_.status(b"%i run(s), %i request(s)\n" % (runs, requests))
+    for line in format_summary(summarize_trace(entries)):
+        ui_.status(line.encode('utf-8') + b'\n')
+
 def setup_tmp_dir(ui_, tmp):
     """ INTERNAL: Setup the temp directory. """
     tmp = os.path.expanduser(tmp)
@@ -860,13 +975,13 @@ def execute_setup(ui_, host, port, tmp, cfg_file = None):
     try:
         ui_.status(b"Testing FCP connection [%s:%i]...\n" % (host, port))
 
-        connection = FCPConnection(PolledSocket(host, port))
+        connection = FCPConnection(SelectorSocket(host, port))
 
         started = time.time()
         while (not connection.is_connected() and
                time.time() - started < timeout_secs):
             connection.socket.poll()
-            time.sleep(.25)
+            connection.socket.wait(.25)
 
         if not connection.is_connected():
             connection_failure((b"\nGave up after waiting %i secs for an "
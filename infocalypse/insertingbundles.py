@@ -21,7 +21,7 @@
 """
 
 from .graph import UpToDate, INSERT_SALTED_METADATA, INSERT_HUGE, \
-     FREENET_BLOCK_LEN, build_version_table, get_heads, \
+     FREENET_BLOCK_LEN, load_version_table, get_heads, \
      PENDING_INSERT1
 from .graphutil import graph_to_string, find_redundant_edges, \
      find_alternate_edges, get_huge_top_key_edges
@@ -79,9 +79,9 @@ class InsertingBundles(RequestQueueState):
             self.parent.ctx.ui_.status(b"No bundles to reinsert.\n")
             # REDFLAG: Think this through. Crappy code, but expedient.
             # Hmmmm.... need version table to build minimal graph
-            self.parent.ctx.version_table = build_version_table(graph,
-                                                                self.parent.ctx.
-                                                                repo)
+            self.parent.ctx.version_table = load_version_table(graph,
+                                                               self.parent.ctx.
+                                                               repo)
             self.parent.transition(INSERTING_GRAPH)
             return
 
@@ -179,7 +179,10 @@ class InsertingBundles(RequestQueueState):
 
         request = None
         try:
-            edge = self.new_edges.pop()
+            edge = self.next_new_edge()
+            if edge is None:
+                # Waiting for a worker to finish a bundle.
+                return None
             request = self.parent.ctx.make_edge_insert_request(edge, edge,
                                                            self.salting_cache)
             self.pending[edge] = request
@@ -199,6 +202,22 @@ class InsertingBundles(RequestQueueState):
 
         return request
 
+    def next_new_edge(self):
+        """ INTERNAL: Pop the next edge to insert from new_edges.
+
+            Returns None if the bundle for every remaining edge is
+            still being built by the bundle pool. """
+        pool = self.parent.ctx.bundle_pool
+        if pool is None:
+            return self.new_edges.pop()
+        # new_edges is popped from the end.
+        edge = pool.next_ready(self.parent.ctx.graph,
+                               self.parent.ctx.version_table,
+                               self.new_edges[::-1])
+        if not edge is None:
+            self.new_edges.remove(edge)
+        return edge
+
     def request_done(self, client, msg):
         """ Implementation of RequestQueueState virtual. """
         #print "TAG: ", client.tag
@@ -252,6 +271,7 @@ class InsertingBundles(RequestQueueState):
                         + b"match!\nPossibly inserted with a different version of Mercurial.\n")
                     self.parent.transition(FAILING)
                     return
+            self.parent.ctx.bundle_cache.set_chk(edge[:2], edge[2], chk1)
 
         else:
             # REDFLAG: retrying?
@@ -276,16 +296,17 @@ class InsertingBundles(RequestQueueState):
         """ INTERNAL: Set the list of new edges to insert. """
 
         # REDFLAG: Think this through.
-        self.parent.ctx.version_table = build_version_table(graph,
-                                                            self.parent.ctx.
-                                                            repo)
+        self.parent.ctx.version_table = load_version_table(graph,
+                                                           self.parent.ctx.
+                                                           repo)
         # Hmmmm level == 1 handled elsewhere...
         level = self.parent.ctx.get('REINSERT', 0)
         if level == 0: # Insert update, don't re-insert
             self.new_edges = graph.update(self.parent.ctx.repo,
                                           self.parent.ctx.ui_,
                                           self.parent.ctx[b'TARGET_VERSIONS'],
-                                          self.parent.ctx.bundle_cache)
+                                          self.parent.ctx.bundle_cache,
+                                          self.parent.ctx.version_table)
         elif level in [2, 3]: # Topkey(s), graphs(s), updates
             # Hmmmm... later support different values of REINSERT?
             self.new_edges = graph.get_top_key_edges()
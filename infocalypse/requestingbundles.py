@@ -30,10 +30,12 @@ from .bundlecache import make_temp_file
 from .graph import latest_index, \
      FREENET_BLOCK_LEN, chk_to_edge_triple_map, \
      dump_paths, MAX_PATH_LEN, get_heads, canonical_path_itr
-from .graphutil import parse_graph
+from .graphutil import parse_graph_data
 from .choose import get_update_edges, dump_update_edges, SaltingState
+from .costmodel import make_cost_model
 
 from .statemachine import RetryingRequestList, CandidateRequest
+from .requestqueue import PRIORITY_UPDATE_PATH, PRIORITY_REDUNDANT
 
 from .chk import clear_control_bytes
 
@@ -75,6 +77,8 @@ class RequestingBundles(RetryingRequestList):
         self.failure_state = failure_state
         self.top_key_tuple = None # FNA sskdata
         self.freenet_heads = None
+        # Kept for the whole pull. The graph doesn't change.
+        self.cost_model = None
 
     ############################################################
     # State implementation
@@ -88,10 +92,20 @@ class RequestingBundles(RetryingRequestList):
         self._initialize()
         #self.dump()
 
+    def leave(self, dummy_to_state):
+        """ Implementation of State virtual. """
+        for generation, count, median, p90, longest in \
+                self.generation_stats():
+            self.parent.ctx.ui_.debug(b"Request generation %i: %i requests, "
+                                      b"median %.1fs, p90 %.1fs, max %.1fs\n"
+                                      % (generation, count, median, p90,
+                                         longest))
+
     def reset(self):
         """ Implementation of State virtual. """
         #print "reset -- pending: ", len(self.pending)
         self.top_key_tuple = None
+        self.cost_model = None
         RetryingRequestList.reset(self)
 
     ############################################################
@@ -123,6 +137,12 @@ class RequestingBundles(RetryingRequestList):
         # tag == edge, but what if we don't have an edge yet?
         request = CandidateRequest(self.parent)
         request.in_params.fcp_params = self.parent.params.copy()
+        if candidate[2] and not candidate[6]:
+            # Salted or redundant single block request.
+            request.priority = PRIORITY_REDUNDANT
+        else:
+            # The graph or a full bundle on the update path.
+            request.priority = PRIORITY_UPDATE_PATH
 
         uri = candidate[0]
         if candidate[2]:
@@ -266,6 +286,9 @@ class RequestingBundles(RetryingRequestList):
             keys to request next.
         """
         self.top_key_tuple = top_key_tuple
+        self.pipeline_depth = None
+        if self.parent.params.get('PIPELINED_RETRIES', False):
+            self.pipeline_depth = self.parent.params['N_CONCURRENT']
 
         self._handle_testing_hacks()
         ############################################################
@@ -401,6 +424,8 @@ class RequestingBundles(RetryingRequestList):
                 self.freenet_heads == all_heads)
         self.freenet_heads = all_heads
         self.parent.ctx.graph = graph
+        self.cost_model = make_cost_model(graph,
+                                          self.parent.params.get('COST_MODEL'))
 
         self.rep_invariant()
 
@@ -483,7 +508,7 @@ class RequestingBundles(RetryingRequestList):
                     self.parent.ctx.ui_.status(b"--- Raw Graph Data ---\n")
                     self.parent.ctx.ui_.status(data)
                     self.parent.ctx.ui_.status(b"\n---\n")
-                graph = parse_graph(data)
+                graph = parse_graph_data(data)
                 self._handle_dump_canonical_paths(graph)
                 self._set_graph(graph)
                 assert(not self.freenet_heads is None)
@@ -830,7 +855,7 @@ class RequestingBundles(RetryingRequestList):
 
         # Find the edges we need to update.
         first, second = get_update_edges(graph, index, redundancy, True,
-                                         all_edges)
+                                         all_edges, self.cost_model)
 
         if self.parent.params.get('DUMP_UPDATE_EDGES', False):
             dump_update_edges(first, second, all_edges)
@@ -21,9 +21,47 @@
     Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
 """
 
+import heapq
 import time
 
-from .fcpconnection import MinimalClient
+from .fcpconnection import MinimalClient, MemoryBudget, wait_for_sockets
+
+# Max bytes of trailing data held in memory while it arrives, for all
+# running requests.
+MAX_BUFFERED_BYTES = 16 * 1024 * 1024
+# Max bytes of trailing data held in memory while it arrives, for a
+# single request.
+REQUEST_BUFFERED_BYTES = 1024 * 1024
+
+# FCP error codes for canceled requests.
+CANCELED_GET_CODE = 25
+CANCELED_PUT_CODE = 10
+
+# Seconds between RemoveRequests for a timed out request which
+# hasn't been acknowledged yet.
+REMOVE_RETRY_SECS = 1.0
+
+# Request classes, most urgent first.
+# Top keys and key inversion. Nothing else can start without them.
+PRIORITY_TOP_KEY = 0
+# Graph CHKs and full bundles on the update path.
+PRIORITY_UPDATE_PATH = 1
+# Everything which doesn't say otherwise.
+PRIORITY_NORMAL = 2
+# Salted and redundant copies of data which is also requested or
+# inserted elsewhere.
+PRIORITY_REDUNDANT = 3
+
+# Request class -> FCP PriorityClass.
+FCP_PRIORITY_CLASSES = {PRIORITY_TOP_KEY:1,
+                        PRIORITY_UPDATE_PATH:1,
+                        PRIORITY_NORMAL:2,
+                        PRIORITY_REDUNDANT:3}
+
+PRIORITY_NAMES = {PRIORITY_TOP_KEY:'top_key',
+                  PRIORITY_UPDATE_PATH:'update_path',
+                  PRIORITY_NORMAL:'normal',
+                  PRIORITY_REDUNDANT:'redundant'}
 
 class QueueableRequest(MinimalClient):
     """ A request which can be queued in a RequestQueue and run
@@ -36,9 +74,160 @@ class QueueableRequest(MinimalClient):
         # The time after which this request should be canceled.
         self.cancel_time_secs = None # RequestQueue.next_request() MUST set this
         self.custom_data_source = None
+        # One of the PRIORITY_* request classes. If this is None the
+        # request is scheduled as PRIORITY_NORMAL and the FCP
+        # PriorityClass in fcp_params is left alone.
+        self.priority = None
+        # Soft deadline. Requests which miss it are started before
+        # all others.
+        self.deadline_secs = None
+        # Set by the RequestRunner.
+        self.queued_time_secs = None
+        self.sequence = None
+
+def request_class(client):
+    """ Return the request class the client is scheduled with. """
+    if client.priority is None:
+        return PRIORITY_NORMAL
+    return client.priority
+
+def is_upload(client):
+    """ Return True if the client's request sends trailing data. """
+    return bool(client.in_params.send_data)
+
+class QueueDelayTracer:
+    """ Records how long requests waited in the RequestRunner between
+        being taken from their RequestQueue and being started,
+        by request class. """
+    def __init__(self):
+        # request class -> [count, total_secs, max_secs]
+        self.delays = {}
+
+    def request_queued(self, client):
+        """ Called by the RequestRunner when it takes a request from
+            its queue. """
+        pass
+
+    def request_started(self, client, delay_secs):
+        """ Called by the RequestRunner when it starts a request. """
+        entry = self.delays.setdefault(request_class(client), [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += delay_secs
+        entry[2] = max(entry[2], delay_secs)
+
+    def request_done(self, client, msg):
+        """ Called by the RequestRunner when a request finishes. """
+        pass
+
+    def request_sent(self, client, byte_count):
+        """ Called by an FCPConnection when byte_count bytes of a
+            request's message or trailing data were written to the
+            socket. """
+        pass
+
+    def message_received(self, client, msg):
+        """ Called by an FCPConnection for every message it
+            receives for a request. """
+        pass
+
+    def stats(self):
+        """ Return a dictionary which maps request class names to
+            (count, mean_secs, max_secs) tuples. """
+        ret = {}
+        for priority, (count, total, longest) in self.delays.items():
+            ret[PRIORITY_NAMES.get(priority, str(priority))] = (
+                count, total / count, longest)
+        return ret
+
+class DeadlineHeap:
+    """ A min heap of items ordered by deadline.
+
+        deadline_func(item) returns the item's current deadline. Code
+        which only moves deadlines later, like
+        UpdateContextBase.set_cancel_time(), can just change the item
+        and doesn't need to know about the heap: entries whose deadline
+        moved are put back instead of expiring. To move a deadline
+        earlier push() the item again. Only the last push() of an item
+        counts.
+
+        push() and pop_expired() are O(log n) per item.
+    """
+    def __init__(self, deadline_func):
+        self.deadline_func = deadline_func
+        # (deadline, sequence, item) tuples.
+        self.heap = []
+        # item -> sequence of its live entry
+        self.live = {}
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.live)
+
+    def __contains__(self, item):
+        return item in self.live
+
+    def push(self, item, deadline=None):
+        """ Add item or reschedule it. If deadline is None
+            deadline_func(item) is used. """
+        if deadline is None:
+            deadline = self.deadline_func(item)
+        self.sequence += 1
+        self.live[item] = self.sequence
+        heapq.heappush(self.heap, (deadline, self.sequence, item))
+
+    def remove(self, item):
+        """ Remove item if it's in the heap. """
+        self.live.pop(item, None)
+
+    def next_deadline(self):
+        """ Return the earliest deadline or None if the heap is empty.
+
+            This can be earlier than the real next deadline if
+            a deadline was moved later.
+        """
+        heap = self.heap
+        while heap and self.live.get(heap[0][2]) != heap[0][1]:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return heap[0][0]
+
+    def pop_expired(self, now):
+        """ Remove and return a list of the items whose
+            deadline is <= now, earliest first. """
+        expired = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            deadline, sequence, item = heapq.heappop(heap)
+            if self.live.get(item) != sequence:
+                continue # Removed or pushed again.
+            current = self.deadline_func(item)
+            if current > deadline and current > now:
+                self.push(item, current) # Moved later.
+                continue
+            del self.live[item]
+            expired.append(item)
+        return expired
 
 class RequestRunner:
-    """ Class to run requests scheduled on one or more RequestQueues. """
+    """ Class to run requests scheduled on one or more RequestQueues.
+
+        Requests can be spread across a pool of FCPConnections.
+        The connection passed to the constructor is always a fetch
+        lane. Additional connections can be added with add_connection().
+        If there are upload lanes, requests with trailing data only run
+        on them, so that uploads don't block fetches.
+
+        Requests are taken from the queues in weighted round robin order
+        and started in order of request class (see PRIORITY_*), with soft
+        deadlines first. Up to lookahead requests more than can run are
+        taken from the queues so that there is something to choose from.
+        The time a request waits to be started doesn't count against
+        its cancel_time_secs.
+
+        Timeouts are kept in a DeadlineHeap so kick() only looks at
+        the requests which actually timed out.
+    """
     def __init__(self, connection, concurrent):
         self.connection = connection
         self.concurrent = concurrent
@@ -46,9 +235,104 @@ class RequestRunner:
         self.running = {}
         self.request_queues = []
         self.index = 0
+        # queue -> number of requests taken from it per turn
+        self.weights = {}
+        self.credits = 0
+        self.lookahead = concurrent
+        # Sequence number used to keep scheduling FIFO within a class.
+        self.sequence = 0
+        # Set this to a QueueDelayTracer to record queueing delay.
+        # See set_tracer().
+        self.tracer = None
+        # Trailing data which doesn't fit is spilled to temp files.
+        self.memory_budget = MemoryBudget(MAX_BUFFERED_BYTES,
+                                          REQUEST_BUFFERED_BYTES)
+        connection.memory_budget = self.memory_budget
 
-    def add_queue(self, request_queue):
-        """ Add a queue to the scheduler. """
+        self.fetch_lanes = [connection]
+        self.upload_lanes = []
+        # request id -> connection
+        self.lanes = {}
+        # Requests taken from a queue which haven't started yet.
+        self.deferred = set()
+        # Heaps of (urgency, sequence, client) entries for deferred
+        # fetches and uploads. Entries for clients which aren't
+        # in self.deferred any more are skipped.
+        self.waiting = ([], [])
+        # Cancel times of running requests and of deferred requests
+        # which were canceled.
+        self.timeouts = DeadlineHeap(lambda client: client.cancel_time_secs)
+        # Soft deadlines of deferred requests.
+        self.soft_deadlines = DeadlineHeap(lambda client:
+                                           client.deadline_secs)
+
+    def add_connection(self, connection, uploads):
+        """ Add a connected FCPConnection to the pool.
+
+            If uploads is True it is used only for requests with
+            trailing data, otherwise only for requests without it.
+        """
+        assert not connection in self.connections()
+        connection.memory_budget = self.memory_budget
+        connection.tracer = self.tracer
+        if uploads:
+            self.upload_lanes.append(connection)
+        else:
+            self.fetch_lanes.append(connection)
+
+    def set_tracer(self, tracer):
+        """ Set the QueueDelayTracer used by the runner and all the
+            connections in the pool. None to stop tracing. """
+        self.tracer = tracer
+        for connection in self.connections():
+            connection.tracer = tracer
+
+    def connections(self):
+        """ Return a list of all connections in the pool. """
+        return self.fetch_lanes + self.upload_lanes
+
+    def poll(self):
+        """ Poll the sockets of all the connections in the pool.
+
+            Returns the result of polling the primary connection's socket.
+        """
+        ret = self.connection.socket.poll()
+        for connection in self.connections()[1:]:
+            if connection.is_connected():
+                connection.socket.poll()
+        return ret
+
+    def wait(self, max_secs):
+        """ Block until there is activity on any of the connections or
+            a running request times out, but not more than max_secs. """
+        timeout = self.wait_secs(max_secs)
+        connections = [connection for connection in self.connections()
+                       if connection.is_connected()]
+        if len(connections) > 1:
+            wait_for_sockets([connection.socket for connection in connections],
+                             timeout)
+        else:
+            self.connection.socket.wait(timeout)
+
+    def close(self):
+        """ Close all the connections in the pool. """
+        for connection in self.connections():
+            connection.close()
+
+    def buffer_stats(self):
+        """ Return a dictionary with the current and peak number of
+            bytes of trailing data held in memory, and how much
+            was spilled to disk. """
+        return self.memory_budget.stats()
+
+    def add_queue(self, request_queue, weight=1):
+        """ Add a queue to the scheduler.
+
+            weight is the number of requests taken from the queue
+            each time it's its turn.
+        """
+        assert weight > 0
+        self.weights[request_queue] = weight
         if not request_queue in self.request_queues:
             self.request_queues.append(request_queue)
 
@@ -56,6 +340,7 @@ class RequestRunner:
         """ Remove a queue from the scheduler. """
         if request_queue in self.request_queues:
             self.request_queues.remove(request_queue)
+            del self.weights[request_queue]
 
     def cancel_request(self, client):
         """ Cancel a request.
@@ -66,71 +351,216 @@ class RequestRunner:
         if type(client) == type(1):
             raise Exception("Hack added to find bug: REDFLAG")
 
-        self.connection.remove_request(client.request_id())
+        if self.is_deferred(client):
+            # Never started. Fail it on the next kick().
+            client.cancel_time_secs = 0
+            self.timeouts.push(client)
+            return
+        self.lanes[client.request_id()].remove_request(client.request_id())
         # REDFLAG: BUG: fix to set cancel time in the past.
         #               fix kick to check cancel time before starting?
+
+    def is_deferred(self, client):
+        """ Return True if the client's request was taken from its
+            queue but hasn't been started yet. """
+        return client in self.deferred
+
+    def wait_secs(self, max_secs):
+        """ Return the number of seconds until the next running
+            request times out, but not more than max_secs.
+
+            Event loops can block on the connection's socket for this
+            long without missing a timeout.
+        """
+        deadline = self.timeouts.next_deadline()
+        if deadline is None:
+            return max_secs
+        return max(0, min(max_secs, deadline - time.time()))
+
     def kick(self):
         """ Run the scheduler state machine.
 
             You MUST call this frequently.
         """
-
-        if self.connection.is_uploading():
-            # REDFLAG: Test this code path!
-            #print "kick -- bailed out, still UPLOADING..."
-            # Wait for upload to finish.
-            return
-
-        # Cancel running requests which have timed out.
         now = time.time()
-        for client in list(self.running.values()):
-            assert client.cancel_time_secs
-            if client.cancel_time_secs < now:
-                self.connection.remove_request(client.request_id())
+        self.handle_timeouts(now)
 
         # REDFLAG: test this code with multiple queues!!!
-        # Round robin schedule requests from queues
+        # Weighted round robin requests from queues
         idle_queues = 0
         # Catch before uninsightful /0 error on the next line.
         assert len(self.request_queues) > 0
         self.index = self.index % len(self.request_queues) # Paranoid
         start_index = self.index
-        while (len(self.running) < self.concurrent
-               and idle_queues <  len(self.request_queues)
-               and not self.connection.is_uploading()):
+        while (len(self.running) + len(self.deferred) <
+               self.concurrent + self.lookahead
+               and idle_queues <  len(self.request_queues)):
             #print "IDLE_QUEUES:", idle_queues
             if self.index == start_index:
                 idle_queues = 0
-            client = self.request_queues[self.index].next_runnable()
+            queue = self.request_queues[self.index]
+            client = queue.next_runnable()
             #print "CLIENT:", client
             if client:
-#                 print ("client.queue: ", str(client.queue))
-#                 print ("running: ", str(client))
-#                 print ("client.in_params: ", str(client.in_params))
-#                 if 'URI' in client.in_params.fcp_params:
-#                     print ("   ", client.in_params.fcp_params['URI'])
-                assert client.queue == self.request_queues[self.index]
-                client.in_params._async = True
-                client.message_callback = self.msg_callback
-                request_id = self.connection.start_request(
-                    client, client.custom_data_source)
-                # print(request_id)
-                self.running[request_id] = client
+                assert client.queue == queue
+                self.defer(client, now)
+                self.credits += 1
+                if self.credits < self.weights.get(queue, 1):
+                    # Stay on this queue until it used up its weight.
+                    continue
             else:
                 idle_queues += 1
+            self.credits = 0
             self.index = (self.index + 1) % len(self.request_queues)
 
+        # Requests which missed their soft deadline go first.
+        for client in self.soft_deadlines.pop_expired(now):
+            heapq.heappush(self.waiting[is_upload(client)],
+                           ((-1, client.deadline_secs), client.sequence,
+                            client))
+
+        self.start_deferred(now)
+
+    def handle_timeouts(self, now):
+        """ INTERNAL: Cancel running requests and fail deferred requests
+            which timed out. """
+        for client in self.timeouts.pop_expired(now):
+            if client in self.deferred:
+                self.deferred.remove(client)
+                self.soft_deadlines.remove(client)
+                self.fail_deferred(client)
+                continue
+            request_id = client.request_id()
+            if not request_id in self.running:
+                continue # Hmmmm... finished without msg_callback()?
+            # Keep trying until the node acknowledges the RemoveRequest.
+            # It can't be sent while a lane is uploading.
+            self.timeouts.push(client, now + REMOVE_RETRY_SECS)
+            if not self.lanes[request_id].is_uploading():
+                self.lanes[request_id].remove_request(request_id)
+
+    def defer(self, client, now):
+        """ INTERNAL: Hold a request taken from its queue until
+            it can be started. """
+        assert client.cancel_time_secs
+        client.queued_time_secs = now
+        self.sequence += 1
+        client.sequence = self.sequence
+        self.deferred.add(client)
+        if not self.tracer is None:
+            self.tracer.request_queued(client)
+        if not client.deadline_secs is None:
+            self.soft_deadlines.push(client)
+        heapq.heappush(self.waiting[is_upload(client)],
+                       (self.urgency(client), client.sequence, client))
+
+    def urgency(self, client):
+        """ INTERNAL: Sort key for starting requests. Lower is
+            more urgent. """
+        deadline = client.deadline_secs
+        if deadline is None:
+            deadline = float('inf')
+        return (request_class(client), deadline)
+
+    def next_waiting(self, heap):
+        """ INTERNAL: Drop stale entries from the top of one of the
+            self.waiting heaps and return the top entry or None. """
+        while heap:
+            dummy, sequence, client = heap[0]
+            if client in self.deferred and client.sequence == sequence:
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+
+    def start_deferred(self, now):
+        """ INTERNAL: Start waiting requests, most urgent first. """
+        while len(self.running) < self.concurrent:
+            best = None
+            for heap in self.waiting:
+                entry = self.next_waiting(heap)
+                if entry is None or (not best is None and
+                                     best[0][:2] <= entry[:2]):
+                    continue
+                lane = self.pick_lane(entry[2])
+                if not lane is None:
+                    best = (entry, heap, lane)
+            if best is None:
+                break
+            entry, heap, lane = best
+            heapq.heappop(heap)
+            client = entry[2]
+            self.deferred.remove(client)
+            self.soft_deadlines.remove(client)
+            if client in self.timeouts:
+                # Canceled since the last kick().
+                self.timeouts.remove(client)
+                self.fail_deferred(client)
+                continue
+            # Waiting here doesn't count against the timeout.
+            client.cancel_time_secs += now - client.queued_time_secs
+            self.timeouts.push(client)
+            self.start_request(client, lane)
+            if not self.tracer is None:
+                self.tracer.request_started(
+                    client, now - client.queued_time_secs)
+
+    def pick_lane(self, client):
+        """ INTERNAL: Return the least busy connection which can
+            run the client's request or None if there isn't one. """
+        lanes = self.fetch_lanes
+        if is_upload(client):
+            lanes = [connection for connection in self.upload_lanes
+                     if connection.is_connected()] or self.fetch_lanes
+        lanes = [connection for connection in lanes
+                 if connection.is_connected() and
+                 not connection.is_uploading()]
+        if not lanes:
+            return None
+        return min(lanes, key=lambda connection:
+                   len(connection.running_clients))
+
+    def start_request(self, client, lane):
+        """ INTERNAL: Start client's request on lane. """
+        if not client.priority is None:
+            params = client.in_params.fcp_params
+            params[b'PriorityClass'] = FCP_PRIORITY_CLASSES[client.priority]
+        client.in_params._async = True
+        client.message_callback = self.msg_callback
+        request_id = lane.start_request(client, client.custom_data_source)
+        # print(request_id)
+        self.running[request_id] = client
+        self.lanes[request_id] = lane
+
+    def fail_deferred(self, client):
+        """ INTERNAL: Finish a request which was canceled or timed out
+            before it could be started. """
+        if is_upload(client):
+            msg = (b'PutFailed', {b'Code':b'%i' % CANCELED_PUT_CODE})
+        else:
+            msg = (b'GetFailed', {b'Code':b'%i' % CANCELED_GET_CODE})
+        msg[1][b'Identifier'] = b''
+        msg[1][b'CodeDescription'] = b'Canceled before it was started.'
+        msg[1][b'Fatal'] = b'true'
+        client.response = msg
+        if not self.tracer is None:
+            self.tracer.request_done(client, msg)
+        client.queue.request_done(client, msg)
+
     def msg_callback(self, client, msg):
         """ Route incoming FCP messages to the appropriate queues. """
         if client.is_finished():
+            if not self.tracer is None:
+                self.tracer.request_done(client, msg)
             client.queue.request_done(client, msg)
             #print "RUNNING:"
             #print self.running
             try:
                 del self.running[client.request_id()]
+                del self.lanes[client.request_id()]
             except KeyError:
                 print (self.running)
                 raise
+            self.timeouts.remove(client)
             self.kick() # haha
         else:
             client.queue.request_progress(client, msg)
@@ -29,7 +29,7 @@ import sys
 from configparser import ConfigParser
 
 from .fcpclient import FCPClient, get_usk_hash
-from .fcpconnection import FCPConnection, PolledSocket
+from .fcpconnection import FCPConnection, SelectorSocket
 from .requestqueue import RequestRunner
 from .bundlecache import is_writable
 
@@ -225,7 +225,7 @@ def run_wikibot(params):
     """ Setup an FMSBotRunner and run a single WikiBot instance in it. """
 
     # Setup RequestQueue for FCP requests.
-    async_socket = PolledSocket(params['FCP_HOST'], params['FCP_PORT'])
+    async_socket = SelectorSocket(params['FCP_HOST'], params['FCP_PORT'])
     request_runner = RequestRunner(FCPConnection(async_socket, True),
                                    params['N_CONCURRENT'])
 
@@ -24,10 +24,24 @@
 # REDFLAG: move this into requestqueue?
 
 import os
+import time
 
 from .fcpconnection import SUCCESS_MSGS
 from .requestqueue import QueueableRequest
 
+# Pipelined RetryingRequestLists wait this long before retrying a
+# candidate the first time. Doubles with every retry.
+RETRY_BACKOFF_SECS = 1.0
+MAX_RETRY_BACKOFF_SECS = 60.0
+
+def percentile(values, fraction):
+    """ Return the value at fraction (0.0 - 1.0) of the sorted values.
+        Uses the nearest rank, no interpolation. """
+    assert values
+    values = sorted(values)
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
 # Move this to fcpconnection?
 def delete_client_file(client):
     """ Delete the file in client.inf_params.file_name. """
@@ -53,6 +67,8 @@ class StateMachine:
         self.states = {}
         self.current_state = None # Subclass should set.
         self.transition_callback = lambda old_state, new_state: None
+        # Optional tracing.RequestTracer which is told about transitions.
+        self.tracer = None
 
     def get_state(self, state_name):
         """ Get a state object by name. """
@@ -70,6 +86,8 @@ class StateMachine:
         old_state.leave(new_state) # Shouldn't change state.
         assert self.current_state == old_state
         self.current_state = new_state # Hmmm... order
+        if not self.tracer is None:
+            self.tracer.state_changed(old_state, new_state)
         self.transition_callback(old_state, new_state) # Shouldn't change state
         assert self.current_state == new_state
         new_state.enter(old_state) # Can change state.
@@ -281,6 +299,16 @@ class RetryingRequestList(RequestQueueState):
     """ A RequestQueueState subclass which maintains a collection
         of 'candidate' objects which it uses to make request from.
 
+        By default the candidates in next_candidates (the next
+        generation) aren't run until all requests for the current
+        generation have finished. If pipeline_depth is set, they can
+        run while the tail of the current generation is still pending,
+        as long as fewer than pipeline_depth requests are pending.
+        In that mode a candidate which is put back on next_candidates
+        by candidate_done() waits RETRY_BACKOFF_SECS, doubling with
+        every retry, before it runs again, even after the generations
+        are swapped.
+
         NOTE:
         The definition of what a candidate is is left to the subclass.
     """
@@ -289,12 +317,23 @@ class RetryingRequestList(RequestQueueState):
         self.current_candidates = []
         self.next_candidates = []
         self.finished_candidates = []
+        self.pipeline_depth = None
+        self.pipelined = None # Set by get_candidate()
+        self.generation = 0
+        # id(candidate) -> [candidate, retries, ready_time_secs]
+        # The candidate is kept so that its id can't be reused.
+        self.backoff = {}
+        # generation -> list of request times in seconds
+        self.latencies = {}
 
     def reset(self):
         """ Implementation of State virtual. """
         self.current_candidates = []
         self.next_candidates = []
         self.finished_candidates = []
+        self.generation = 0
+        self.backoff = {}
+        self.latencies = {}
         RequestQueueState.reset(self)
 
     def next_runnable(self):
@@ -304,6 +343,10 @@ class RetryingRequestList(RequestQueueState):
             return None
 
         request = self.make_request(candidate)
+        request.generation = self.generation
+        if candidate is self.pipelined:
+            request.generation += 1
+        request.made_time_secs = time.time()
         self.pending[request.tag] = request
         return request
 
@@ -312,8 +355,14 @@ class RetryingRequestList(RequestQueueState):
         candidate = client.candidate
         assert not candidate is None
         del self.pending[client.tag]
+        if hasattr(client, 'made_time_secs'):
+            self.latencies.setdefault(client.generation, []).append(
+                time.time() - client.made_time_secs)
         # REDFLAG: fix signature? to get rid of candidate
         self.candidate_done(client, msg, candidate)
+        if (not self.pipeline_depth is None and
+            [True for queued in self.next_candidates if queued is candidate]):
+            self.start_backoff(candidate)
 
     ############################################################
     def is_stalled(self):
@@ -327,24 +376,46 @@ class RetryingRequestList(RequestQueueState):
             by the RequestQueue. """
         return [request.candidate for request in list(self.pending.values())]
 
+    def generation_stats(self):
+        """ Return a list of (generation, count, median, p90, max)
+            request time tuples, one per generation, times in seconds. """
+        return [(generation, len(values), percentile(values, .5),
+                 percentile(values, .9), max(values))
+                for generation, values in sorted(self.latencies.items())]
+
     # ORDER:
     # 0) Candidates are popped of the lists.
     # 1) All candidates are popped off of current before any are popped
     #    off of next.
     # 2) When current is empty AND all pending requests have finished
     #    next and current are swapped.
+    # 3) If pipeline_depth is set, candidates from next whose backoff
+    #    expired can be popped before 2) happens, and candidates which
+    #    are still backing off are skipped after it.
     def get_candidate(self):
         """ INTERNAL: Gets the next candidate to run, or None if none
             is available. """
+        self.pipelined = None
         if len(self.current_candidates) == 0:
-            if len(self.pending) != 0 or len(self.next_candidates) == 0:
-                # i.e. Don't run requests from the next_candidates
-                # until requests for current candidates have finished.
-                # REDFLAG: Add a parameter to control this behavior?
+            if len(self.next_candidates) == 0:
                 return None
+            if self.pipeline_depth is None:
+                if len(self.pending) != 0:
+                    # i.e. Don't run requests from the next_candidates
+                    # until requests for current candidates have finished.
+                    return None
+            else:
+                if len(self.pending) != 0:
+                    if len(self.pending) >= self.pipeline_depth:
+                        return None
+                    self.pipelined = self.pop_ready(self.next_candidates)
+                    return self.pipelined
+                if self.pop_ready(self.next_candidates, False) is None:
+                    return None # Everything is backing off.
 
             self.current_candidates = self.next_candidates
             self.next_candidates = []
+            self.generation += 1
             return self.get_candidate()
 
         #print "get_candidate -- ", len(self.pending)
@@ -355,9 +426,34 @@ class RetryingRequestList(RequestQueueState):
         #print "NEXT:"
         #print self.next_candidates
 
-        candidate = self.current_candidates.pop()
-
-        return candidate
+        if self.pipeline_depth is None:
+            return self.current_candidates.pop()
+        # Candidates swapped in from next can still be backing off.
+        return self.pop_ready(self.current_candidates)
+
+    def start_backoff(self, candidate):
+        """ INTERNAL: Start the backoff for a candidate which failed
+            and was queued to run again. """
+        entry = self.backoff.setdefault(id(candidate), [candidate, 0, 0])
+        entry[2] = time.time() + min(RETRY_BACKOFF_SECS * 2 ** entry[1],
+                                     MAX_RETRY_BACKOFF_SECS)
+        entry[1] += 1
+
+    def pop_ready(self, candidates, remove=True):
+        """ INTERNAL: Return the last candidate in candidates which
+            isn't backing off, or None if there isn't one.
+
+            If remove is True, the candidate is removed from the list.
+        """
+        now = time.time()
+        for index in range(len(candidates) - 1, -1, -1):
+            candidate = candidates[index]
+            entry = self.backoff.get(id(candidate))
+            if entry is None or entry[2] <= now:
+                if remove:
+                    del candidates[index]
+                return candidate
+        return None
 
     ############################################################
     def candidate_done(self, client, msg, candidate):
@@ -0,0 +1,754 @@
+""" Tests for BundleCache and BundleStore.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+#pylint: disable-msg=C0111,C0103,R0904,W0201
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from mercurial import commands, debugcommands, hg, ui
+# Registers the revset predicates hg bundle uses outside of hg.
+from mercurial import revset_predicates #pylint: disable-msg=W0611
+
+from .bundlecache import BundleCache, BundleStore, BundleSizeEstimator, \
+     BundleDataSource, BundleException, bundle_key, make_temp_file, \
+     STORE_INDEX, MAX_ROLLUP_TRIES
+from .bundlepool import make_bundle_pool
+from .fcpconnection import FileDataSource, sha1_hexdigest
+from .fcpmessage import PUT_FILE_DEF
+from .fcpstub import FakeFCPNode
+from .graph import UpdateGraph, build_version_table, hex_version, \
+     FIRST_INDEX, FREENET_BLOCK_LEN, MAX_REDUNDANT_LENGTH, NULL_REV, \
+     INSERT_PADDED, INSERT_SALTED_METADATA
+from .requestqueue import RequestQueue, QueueableRequest
+from .statemachine import percentile
+from .test_requestqueue import make_runner, run_queue, CANCEL_TIME_SECS
+
+def write_file(file_name, length, seed):
+    out_file = open(file_name, 'wb')
+    try:
+        out_file.write(random.Random(seed).randbytes(length))
+    finally:
+        out_file.close()
+
+def read_file(file_name):
+    in_file = open(file_name, 'rb')
+    try:
+        return in_file.read()
+    finally:
+        in_file.close()
+
+def make_repo(ui_, repo_dir, commits):
+    """ Make an hg repo with a linear history. """
+    repo = hg.repository(ui_, repo_dir, create=True)
+    rand = random.Random(commits)
+    for index in range(commits):
+        file_name = os.path.join(repo_dir, b'file%i' % (index % 5))
+        out_file = open(file_name, 'ab')
+        try:
+            out_file.write(rand.randbytes(4000).hex().encode('utf-8'))
+        finally:
+            out_file.close()
+        if index < 5:
+            commands.add(ui_, repo, file_name)
+        commands.commit(ui_, repo, message=b'change %i' % index)
+    return hg.repository(ui_, repo_dir)
+
+def read_source(source):
+    """ Read everything from an initialized IDataSource. """
+    blocks = []
+    while True:
+        block = source.read()
+        if not block:
+            return b''.join(blocks)
+        blocks.append(block)
+
+def make_dag_repo(ui_, repo_dir, commits):
+    """ Make an hg repo with a linear history of small changes. """
+    repo = hg.repository(ui_, repo_dir, create=True)
+    wlock = repo.wlock()
+    lock = repo.lock()
+    try:
+        debugcommands.debugbuilddag(ui_, repo, text=b'+%i' % commits,
+                                    mergeable_file=True,
+                                    overwritten_file=True, new_file=True)
+    finally:
+        lock.release()
+        wlock.release()
+    return hg.repository(ui_, repo_dir)
+
+def make_ui():
+    ui_ = ui.ui.load()
+    ui_.setconfig(b'ui', b'username', b'test')
+    ui_.setconfig(b'ui', b'quiet', b'true')
+    return ui_
+
+def make_graph(repo, ui_, cache, step):
+    """ Update a graph step changesets at a time, like a series of
+        pushes. """
+    graph = UpdateGraph()
+    for rev in range(step - 1, len(repo), step):
+        for edge in graph.update(repo, ui_, [hex_version(repo, rev)], cache):
+            graph.set_chk(edge[:2], edge[2], graph.get_length(edge),
+                          b'CHK@%i,%i,%i' % edge)
+    return graph
+
+def make_linear_graph(repo, step):
+    """ Make a graph with step changesets in each index. """
+    graph = UpdateGraph()
+    parent = NULL_REV
+    for rev in range(step - 1, len(repo), step):
+        head = hex_version(repo, rev)
+        graph.add_index([parent, ], [head, ])
+        parent = head
+    return graph
+
+def size_boundry(length):
+    return (length // FREENET_BLOCK_LEN + 1) * FREENET_BLOCK_LEN
+
+def linear_redundant_bundle(cache, graph, version_table, last_index):
+    """ The bundle BundleCache.make_redundant_bundle() used to find by
+        trying one more earlier index at a time. """
+    bundle = cache.make_bundle(graph, version_table,
+                               (last_index - 1, last_index))
+    if (bundle[0] % FREENET_BLOCK_LEN == 0 or
+        bundle[0] > MAX_REDUNDANT_LENGTH):
+        return bundle
+    limit = size_boundry(bundle[0])
+    start = last_index - 1
+    while start > FIRST_INDEX:
+        next_bundle = cache.make_bundle(graph, version_table,
+                                        (start - 1, last_index))
+        if next_bundle[0] > limit:
+            break
+        bundle = next_bundle
+        start -= 1
+    return bundle
+
+class CountingCache(BundleCache):
+    """ A BundleCache which counts the bundles it makes. """
+    def __init__(self, repo, ui_, base_dir):
+        BundleCache.__init__(self, repo, ui_, base_dir)
+        self.enabled = False
+        self.made = 0
+
+    def make_bundle(self, graph, version_table, index_pair, out_file=None):
+        self.made += 1
+        return BundleCache.make_bundle(self, graph, version_table,
+                                       index_pair, out_file)
+
+def reinsert_bundles(graph, repo, ui_, cache_dir, store_dir):
+    """ Make the bundles for every edge in graph the way a fresh
+        fn-reinsert run does and return (lengths, store). """
+    cache = BundleCache(repo, ui_, cache_dir)
+    if not store_dir is None:
+        cache.store = BundleStore(store_dir)
+    tmp_file = os.path.join(cache_dir, b'_tmp_bundle')
+    version_table = build_version_table(graph, repo)
+    lengths = []
+    try:
+        for pair in graph.edge_table:
+            lengths.append(cache.make_bundle(graph, version_table, pair,
+                                             tmp_file)[0])
+    finally:
+        cache.remove_files()
+    return (lengths, cache.store)
+
+class StoreTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp().encode('utf-8')
+        self.store_dir = os.path.join(self.tmp_dir, b'store')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_file(self, length, seed):
+        file_name = os.path.join(self.tmp_dir, b'in%i' % seed)
+        write_file(file_name, length, seed)
+        return file_name
+
+    def test_store(self):
+        store = BundleStore(self.store_dir)
+        key = bundle_key((b'aa', ), (b'cc', b'bb'), b'salt')
+        self.assertEqual(key, bundle_key((b'aa', ), (b'bb', b'cc'), b'salt'))
+        self.assertNotEqual(key, bundle_key((b'aa', ), (b'bb', b'cc'),
+                                            b'other'))
+        self.assertTrue(store.lookup(key) is None)
+        in_file = self.make_file(1000, 1)
+        store.add(key, in_file)
+        # Same contents, different key. Shares the file.
+        other = bundle_key((b'dd', ), (b'ee', ), b'salt')
+        store.add(other, in_file)
+        store.set_chk(key, 1, b'CHK@one')
+        self.assertEqual(store.total_bytes, 1000)
+
+        # Read it back in a new run.
+        store = BundleStore(self.store_dir)
+        self.assertEqual(store.lookup(key)[1:], (1000, {1:b'CHK@one'}))
+        out_file = os.path.join(self.tmp_dir, b'out')
+        self.assertEqual(store.copy_bundle(key, out_file), 1000)
+        self.assertEqual(read_file(out_file), read_file(in_file))
+        self.assertEqual(store.copy_bundle(other), 1000)
+        store.drop(other)
+        self.assertTrue(os.path.exists(store.lookup(key)[0]))
+        self.assertEqual((store.hits, store.misses), (4, 0))
+
+    def test_integrity(self):
+        store = BundleStore(self.store_dir)
+        keys = [b'%i' % index for index in range(3)]
+        for index, key in enumerate(keys):
+            store.add(key, self.make_file(500, index))
+        out_file = os.path.join(self.tmp_dir, b'out')
+
+        # Same length, different contents.
+        write_file(store.lookup(keys[0])[0], 500, 99)
+        self.assertTrue(store.copy_bundle(keys[0], out_file) is None)
+        self.assertFalse(os.path.exists(out_file))
+        # Truncated.
+        file_name = store.lookup(keys[1])[0]
+        write_file(file_name, 100, 1)
+        self.assertTrue(store.copy_bundle(keys[1]) is None)
+        self.assertFalse(os.path.exists(file_name))
+        # Missing.
+        os.remove(store.lookup(keys[2])[0])
+        self.assertTrue(store.lookup(keys[2]) is None)
+        self.assertEqual(len(store.entries), 0)
+
+        # Half written index line and a stray file.
+        store.add(keys[0], self.make_file(500, 0))
+        out_file = open(os.path.join(self.store_dir, STORE_INDEX), 'ab')
+        out_file.write(b'put 1234')
+        out_file.close()
+        write_file(os.path.join(self.store_dir, b'stray.hg'), 10, 0)
+        store = BundleStore(self.store_dir)
+        self.assertEqual(list(store.entries), [keys[0]])
+        self.assertEqual(sorted(os.listdir(self.store_dir)),
+                         sorted([STORE_INDEX,
+                                 store.entries[keys[0]][0] + b'.hg']))
+
+    def test_eviction(self):
+        store = BundleStore(self.store_dir, 2500)
+        keys = [b'%i' % index for index in range(4)]
+        for key in keys[:2]:
+            store.add(key, self.make_file(1000, int(key)))
+        # Now the first one is the most recently used.
+        self.assertFalse(store.lookup(keys[0]) is None)
+        store.add(keys[2], self.make_file(1000, 2))
+        self.assertEqual(list(store.entries), [keys[0], keys[2]])
+        self.assertEqual(store.total_bytes, 2000)
+
+        store = BundleStore(self.store_dir, 2500)
+        self.assertEqual(list(store.entries), [keys[0], keys[2]])
+        self.assertFalse(store.lookup(keys[0]) is None)
+        store = BundleStore(self.store_dir, 2500)
+        store.add(keys[3], self.make_file(1000, 3))
+        self.assertEqual(list(store.entries), [keys[0], keys[3]])
+        self.assertEqual(len(os.listdir(self.store_dir)), 3)
+
+        # Too big to keep at all.
+        store.add(keys[1], self.make_file(3000, 1))
+        self.assertEqual(len(store.entries), 0)
+        self.assertEqual(os.listdir(self.store_dir), [STORE_INDEX])
+
+    def test_compact(self):
+        store = BundleStore(self.store_dir)
+        keys = [b'%i' % index for index in range(3)]
+        for key in keys:
+            store.add(key, self.make_file(100, int(key)))
+        for dummy in range(100):
+            for key in keys:
+                store.lookup(key)
+        self.assertTrue(store.log_lines < 100)
+        self.assertEqual(list(BundleStore(self.store_dir).entries), keys)
+
+class BundleCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp().encode('utf-8')
+        self.ui_ = make_ui()
+        self.repo = make_repo(self.ui_, os.path.join(self.tmp_dir, b'repo'),
+                              12)
+        self.cache_dir = os.path.join(self.tmp_dir, b'cache')
+        os.makedirs(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_store(self):
+        store_dir = os.path.join(self.cache_dir, b'bundles')
+        cache = BundleCache(self.repo, self.ui_, self.cache_dir)
+        cache.store = BundleStore(store_dir)
+        graph = make_graph(self.repo, self.ui_, cache, 3)
+        cache.set_chk((-1, 0), 0, b'CHK@-1,0,0')
+        cache.remove_files()
+        self.assertTrue(len(cache.store.entries) > 0)
+
+        lengths = [graph.get_length(pair + (0, )) for pair in graph.edge_table]
+        uncached = reinsert_bundles(graph, self.repo, self.ui_,
+                                    self.cache_dir, None)[0]
+        self.assertEqual(uncached, lengths)
+        stored, store = reinsert_bundles(graph, self.repo, self.ui_,
+                                         self.cache_dir, store_dir)
+        self.assertEqual(stored, lengths)
+        self.assertEqual((store.hits, store.misses), (len(lengths), 0))
+        self.assertEqual(store.lookup(cache.store_keys[(-1, 0)])[2],
+                         {0:b'CHK@-1,0,0'})
+        # Another version of Mercurial can't use them.
+        cache = BundleCache(self.repo, self.ui_, self.cache_dir)
+        cache.store = store
+        cache.salt += b'+other'
+        cache.make_bundle(graph, build_version_table(graph, self.repo),
+                          (-1, 0))
+        self.assertEqual(store.misses, 1)
+
+    def test_data_source(self):
+        graph = make_linear_graph(self.repo, 4)
+        version_table = build_version_table(graph, self.repo)
+        cache = BundleCache(self.repo, self.ui_, self.cache_dir)
+        length, file_name = cache.get_bundle_file(graph, version_table, (0, 2))
+        self.assertEqual(file_name, cache.get_bundle_path((0, 2)))
+        self.assertEqual(cache.get_bundle_file(graph, version_table, (0, 2)),
+                         (length, file_name))
+        self.assertEqual(cache.make_bundle(graph, version_table, (0, 2))[0],
+                         length)
+
+        source = BundleDataSource(file_name, b'\xff')
+        # Sent again when the request is retried.
+        for dummy in range(2):
+            source.initialize()
+            self.assertEqual(source.data_length(), length + 1)
+            data = read_source(source)
+            source.release()
+        self.assertEqual(data, read_file(file_name) + b'\xff')
+        self.assertEqual(source.hexdigest(), sha1_hexdigest(data))
+
+        source.initialize()
+        out_file = open(file_name, 'ab')
+        out_file.write(b'more')
+        out_file.close()
+        self.assertRaises(BundleException, read_source, source)
+        source.release()
+
+class RedundantBundleTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp().encode('utf-8')
+        self.ui_ = make_ui()
+        self.repo = make_dag_repo(self.ui_,
+                                  os.path.join(self.tmp_dir, b'repo'), 120)
+        self.cache_dir = os.path.join(self.tmp_dir, b'cache')
+        os.makedirs(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_estimator(self):
+        estimator = BundleSizeEstimator()
+        estimator.add(1000, 800)
+        self.assertEqual(estimator.predict(2000), 1600)
+        estimator.add(11000, 4800)
+        self.assertEqual(estimator.predict(21000), 8800)
+        # Lines that don't go up aren't used.
+        estimator.add(12000, 4700)
+        self.assertEqual(estimator.predict(24000), 9400)
+
+    def test_redundant_bundle(self):
+        graph = make_linear_graph(self.repo, 2)
+        version_table = build_version_table(graph, self.repo)
+        cache = CountingCache(self.repo, self.ui_, self.cache_dir)
+        last_indices = range(1, graph.latest_index + 1, 8)
+        same = 0
+        for last_index in last_indices:
+            cache.made = 0
+            bundle = cache.make_redundant_bundle(graph, version_table,
+                                                 last_index)
+            self.assertTrue(cache.made <= 1 + MAX_ROLLUP_TRIES)
+            self.assertEqual(bundle[2][1], last_index)
+            expected = linear_redundant_bundle(cache, graph, version_table,
+                                               last_index)
+            first = cache.make_bundle(graph, version_table,
+                                      (last_index - 1, last_index))
+            self.assertTrue(bundle[0] <= size_boundry(first[0]))
+            self.assertEqual(cache.make_bundle(graph, version_table,
+                                               bundle[2])[0], bundle[0])
+            self.assertTrue(bundle[2][0] >= expected[2][0])
+            same += int(bundle[2] == expected[2])
+        self.assertTrue(same * 2 > len(last_indices))
+
+        out_file = os.path.join(self.cache_dir, b'out')
+        bundle = cache.make_redundant_bundle(graph, version_table,
+                                             graph.latest_index, out_file)
+        self.assertEqual(os.path.getsize(out_file), bundle[0])
+
+class BundlePoolTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp().encode('utf-8')
+        self.ui_ = make_ui()
+        self.repo = make_repo(self.ui_, os.path.join(self.tmp_dir, b'repo'),
+                              12)
+        self.cache_dir = os.path.join(self.tmp_dir, b'cache')
+        os.makedirs(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_pool(self):
+        cache = BundleCache(self.repo, self.ui_, self.cache_dir)
+        graph = make_graph(self.repo, self.ui_, cache, 3)
+        version_table = build_version_table(graph, self.repo)
+        expected = {}
+        for pair in graph.edge_table:
+            expected[pair] = read_file(cache.get_bundle_file(
+                graph, version_table, pair)[1])
+        cache.remove_files()
+
+        store_dir = os.path.join(self.cache_dir, b'bundles')
+        cache.store = BundleStore(store_dir)
+        pool = make_bundle_pool(cache, 2, 1)
+        if pool is None:
+            print("Skipped test_pool, can't fork worker processes.")
+            return
+        try:
+            edges = [pair + (0, ) for pair in graph.edge_table]
+            order = []
+            started = time.time()
+            while edges:
+                self.assertTrue(time.time() - started < 60)
+                edge = pool.next_ready(graph, version_table, edges)
+                if edge is None:
+                    # Only as many as there are workers at a time.
+                    self.assertTrue(len(pool.building) <= 2)
+                    time.sleep(.01)
+                    continue
+                edges.remove(edge)
+                order.append(edge)
+                length, file_name = cache.get_bundle_file(graph,
+                                                          version_table,
+                                                          edge[:2])
+                self.assertEqual(read_file(file_name), expected[edge[:2]])
+                self.assertEqual(length, graph.get_length(edge))
+            self.assertEqual(sorted(order), sorted([pair + (0, ) for pair in
+                                                    graph.edge_table]))
+            self.assertEqual(pool.failed, 0)
+            self.assertEqual(pool.built, len(expected))
+            self.assertEqual(len(cache.store.entries), len(expected))
+        finally:
+            pool.close()
+        self.assertFalse([name for name in os.listdir(self.cache_dir)
+                          if name.endswith(b'.part')])
+
+def estimator_report(cache, graph, version_table, last_indices,
+                     spans=(4, 16, 64)):
+    """ Returns a list of text lines comparing the predicted lengths
+        of bundles rolling up spans earlier indices with the real ones.
+
+        One point estimates use just the bundle for the last index.
+        Two point estimates also use the one rolling up spans[0]. """
+    # span -> [(one point error, two point error), ...]
+    errors = {}
+    for last_index in last_indices:
+        changes = cache.changes_length(graph, version_table, last_index)
+        one = BundleSizeEstimator()
+        one.add(changes, cache.make_bundle(graph, version_table,
+                                           (last_index - 1, last_index))[0])
+        two = BundleSizeEstimator()
+        two.add(*one.points[0])
+        for span in spans:
+            if last_index - span < FIRST_INDEX:
+                break
+            changes = sum([cache.changes_length(graph, version_table, index)
+                           for index in range(last_index - span + 1,
+                                              last_index + 1)])
+            length = cache.make_bundle(graph, version_table,
+                                       (last_index - span, last_index))[0]
+            errors.setdefault(span, []).append(
+                (abs(one.predict(changes) - length) / length,
+                 abs(two.predict(changes) - length) / length))
+            if span == spans[0]:
+                two.add(changes, length)
+
+    lines = ['%-8s %6s %12s %12s %12s %12s' % ('span', 'count', '1pt p50',
+                                               '1pt p90', '2pt p50',
+                                               '2pt p90')]
+    for span in spans:
+        values = errors.get(span, [])
+        if not values:
+            continue
+        cells = []
+        for column in (0, 1):
+            column_values = [value[column] for value in values]
+            cells += ['%11.1f%%' % (100 * percentile(column_values, .5)),
+                      '%11.1f%%' % (100 * percentile(column_values, .9))]
+        lines.append('%-8i %6i ' % (span, len(values)) + ' '.join(cells))
+    return lines
+
+def benchmark_redundant_bundles(commits=3000, step=3, samples=20):
+    """ Compare make_redundant_bundle() with rolling up one index at a
+        time and report the BundleSizeEstimator's accuracy. """
+    tmp_dir = tempfile.mkdtemp().encode('utf-8')
+    try:
+        ui_ = make_ui()
+        start = time.time()
+        repo = make_dag_repo(ui_, os.path.join(tmp_dir, b'repo'), commits)
+        cache_dir = os.path.join(tmp_dir, b'cache')
+        os.makedirs(cache_dir)
+        graph = make_linear_graph(repo, step)
+        version_table = build_version_table(graph, repo)
+        print("%i changesets, %i indices, built in %.1fs" %
+              (commits, graph.latest_index + 1, time.time() - start))
+        last_indices = [graph.latest_index * (sample + 1) // samples
+                        for sample in range(samples)]
+
+        cache = CountingCache(repo, ui_, cache_dir)
+        start = time.time()
+        expected = [linear_redundant_bundle(cache, graph, version_table,
+                                            index) for index in last_indices]
+        print("one index at a time: %8.3fs, %i bundles" %
+              (time.time() - start, cache.made))
+
+        cache = CountingCache(repo, ui_, cache_dir)
+        start = time.time()
+        bundles = [cache.make_redundant_bundle(graph, version_table, index)
+                   for index in last_indices]
+        print("estimated:           %8.3fs, %i bundles, same result for "
+              "%i of %i" % (time.time() - start, cache.made,
+                            len([True for pair in zip(bundles, expected)
+                                 if pair[0][2] == pair[1][2]]),
+                            len(bundles)))
+        print("indices rolled up, one at a time: %i, estimated: %i" %
+              (sum([bundle[2][1] - bundle[2][0] for bundle in expected]),
+               sum([bundle[2][1] - bundle[2][0] for bundle in bundles])))
+        print()
+        print("Bundle length prediction errors:")
+        for line in estimator_report(cache, graph, version_table,
+                                     last_indices):
+            print(line)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def io_counters():
+    """ Returns the (bytes read, bytes written) by this process so far
+        or None if the platform doesn't say. """
+    try:
+        in_file = open('/proc/self/io', 'r')
+    except IOError:
+        return None
+    try:
+        fields = dict([line.split(':') for line in in_file])
+    finally:
+        in_file.close()
+    return (int(fields['rchar']), int(fields['wchar']))
+
+def copying_data_source(cache, graph, version_table, edge, pad):
+    """ What updatesm._get_bundle() used to do: copy the bundle to a
+        temp file, append the pad byte and send the temp file. """
+    tmp_file = make_temp_file(cache.base_dir)
+    cache.make_bundle(graph, version_table, edge[:2], tmp_file)
+    if pad:
+        out_file = open(tmp_file, 'ab')
+        try:
+            out_file.write(pad)
+        finally:
+            out_file.close()
+    return FileDataSource(tmp_file)
+
+def streaming_data_source(cache, graph, version_table, edge, pad):
+    """ What updatesm._get_bundle() does. """
+    return BundleDataSource(cache.get_bundle_file(graph, version_table,
+                                                  edge[:2])[1], pad)
+
+def benchmark_push_io(commits=100, step=5):
+    """ Count the bytes read and written to make the graph and send
+        the bundles for a series of pushes. """
+    if io_counters() is None:
+        print("Can't count I/O on this platform.")
+        return
+    tmp_dir = tempfile.mkdtemp().encode('utf-8')
+    try:
+        ui_ = make_ui()
+        repo = make_repo(ui_, os.path.join(tmp_dir, b'repo'), commits)
+        cache_dir = os.path.join(tmp_dir, b'cache')
+        os.makedirs(cache_dir)
+        for label, make_source in (('copying', copying_data_source),
+                                   ('streaming', streaming_data_source)):
+            cache = BundleCache(repo, ui_, cache_dir)
+            start = io_counters()
+            graph = make_graph(repo, ui_, cache, step)
+            version_table = build_version_table(graph, repo)
+            updated = io_counters()
+            sent = 0
+            for pair, edge_info in graph.edge_table.items():
+                for ordinal in range(len(edge_info) - 1):
+                    edge = pair + (ordinal, )
+                    kind = graph.insert_type(edge)
+                    if kind == INSERT_SALTED_METADATA:
+                        continue
+                    pad = b''
+                    if kind == INSERT_PADDED:
+                        pad = b'\xff'
+                    source = make_source(cache, graph, version_table, edge,
+                                         pad)
+                    source.initialize()
+                    sent += len(read_source(source))
+                    source.release()
+                    if isinstance(source, FileDataSource):
+                        os.remove(source.file_name)
+            done = io_counters()
+            cache.remove_files()
+            print("%-10s %i bytes sent, graph: %10i read %10i written, "
+                  "sending: %10i read %10i written" %
+                  ((label, sent) + tuple([done_count - count for done_count,
+                                          count in zip(updated, start)]) +
+                   tuple([done_count - count for done_count, count in
+                          zip(done, updated)])))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+class BundleInsertQueue(RequestQueue):
+    """ RequestQueue which inserts the bundles for a list of edges
+        the way InsertingBundles does. """
+    def __init__(self, runner, cache, graph, version_table, edges, pool):
+        RequestQueue.__init__(self, runner)
+        self.cache = cache
+        self.graph = graph
+        self.version_table = version_table
+        self.edges = list(edges)
+        self.pool = pool
+        self.finished = []
+        # Time spent in next_runnable(), when nothing else can run.
+        self.blocked_secs = 0.0
+
+    def next_runnable(self):
+        start = time.time()
+        try:
+            return self.next_put()
+        finally:
+            self.blocked_secs += time.time() - start
+
+    def next_put(self):
+        if not self.edges:
+            return None
+        if self.pool is None:
+            edge = self.edges.pop(0)
+        else:
+            edge = self.pool.next_ready(self.graph, self.version_table,
+                                        self.edges)
+            if edge is None:
+                return None
+            self.edges.remove(edge)
+        request = QueueableRequest(self)
+        request.tag = edge
+        request.in_params.definition = PUT_FILE_DEF
+        request.in_params.fcp_params = {b'URI':b'CHK@'}
+        request.in_params.send_data = True
+        request.custom_data_source = BundleDataSource(
+            self.cache.get_bundle_file(self.graph, self.version_table,
+                                       edge[:2])[1])
+        request.cancel_time_secs = time.time() + CANCEL_TIME_SECS
+        return request
+
+    def request_done(self, client, msg):
+        self.finished.append(msg)
+
+def benchmark_pooled_reinsert(commits=100, step=5, workers=(0, 2, 4),
+                              bandwidth=1024 * 1024):
+    """ Insert every bundle for a graph to a FakeFCPNode, making the
+        bundles serially and with a BundlePool, and report how much of
+        the FCP connection's bandwidth and the pool's time was used. """
+    tmp_dir = tempfile.mkdtemp().encode('utf-8')
+    try:
+        ui_ = make_ui()
+        repo = make_repo(ui_, os.path.join(tmp_dir, b'repo'), commits)
+        cache_dir = os.path.join(tmp_dir, b'cache')
+        os.makedirs(cache_dir)
+        cache = BundleCache(repo, ui_, cache_dir)
+        graph = make_graph(repo, ui_, cache, step)
+        cache.remove_files()
+        version_table = build_version_table(graph, repo)
+        edges = [pair + (0, ) for pair in graph.edge_table]
+        total = sum([graph.get_length(edge) for edge in edges])
+        print("%i changesets, %i bundles, %i bytes" % (commits, len(edges),
+                                                       total))
+        for count in workers:
+            cache = BundleCache(repo, ui_, cache_dir)
+            pool = make_bundle_pool(cache, count)
+            node = FakeFCPNode(latency_secs=0.05, bandwidth=bandwidth)
+            node.start()
+            try:
+                runner = make_runner(node, 4)
+                queue = BundleInsertQueue(runner, cache, graph,
+                                          version_table, edges, pool)
+                elapsed = run_queue(runner, queue, len(edges), 600)
+                sent = node.stats['bytes_in']
+            finally:
+                node.stop()
+                if not pool is None:
+                    pool.close()
+                cache.remove_files()
+            assert len([msg for msg in queue.finished
+                        if msg[0] == b'PutSuccessful']) == len(edges)
+            pool_use = ''
+            if not pool is None:
+                pool_use = ', pool busy %3.0f%%' % (
+                    100.0 * pool.busy_secs / (count * elapsed))
+            print("%i workers: %7.2fs, event loop blocked %6.2fs, "
+                  "FCP connection used %3.0f%%%s" %
+                  (count, elapsed, queue.blocked_secs,
+                   100.0 * sent / (bandwidth * elapsed), pool_use))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def benchmark_reinsert(commits=100, step=5, runs=2):
+    """ Time the bundle making part of repeated fn-reinsert runs with
+        and without a BundleStore. """
+    tmp_dir = tempfile.mkdtemp().encode('utf-8')
+    try:
+        ui_ = make_ui()
+        repo = make_repo(ui_, os.path.join(tmp_dir, b'repo'), commits)
+        cache_dir = os.path.join(tmp_dir, b'cache')
+        os.makedirs(cache_dir)
+        store_dir = os.path.join(cache_dir, b'bundles')
+        cache = BundleCache(repo, ui_, cache_dir)
+        graph = make_graph(repo, ui_, cache, step)
+        cache.remove_files()
+        print("%i changesets, %i edges" % (commits, len(graph.edge_table)))
+        for label, directory in (('no store', None), ('store', store_dir)):
+            for run in range(runs):
+                start = time.time()
+                store = reinsert_bundles(graph, repo, ui_, cache_dir,
+                                         directory)[1]
+                hits = 0
+                if not store is None:
+                    hits = store.hits
+                print("%-10s run %i: %8.3fs, %i store hits" %
+                      (label, run, time.time() - start, hits))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    if '--benchmark' in sys.argv:
+        benchmark_reinsert()
+        benchmark_redundant_bundles()
+        benchmark_push_io()
+        benchmark_pooled_reinsert()
+    else:
+        unittest.main()
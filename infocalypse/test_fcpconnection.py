@@ -0,0 +1,305 @@
+""" Tests and micro-benchmarks for the byte level FCP socket code.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+#pylint: disable-msg=C0111,C0103,R0904,W0201
+import random
+import resource
+import socket
+import sys
+import threading
+import time
+import unittest
+
+from .fcpconnection import NonBlockingSocket, PolledSocket, SelectorSocket, \
+     IDataSource, RequestContext, DataSink, MemoryBudget, READ_BLOCK, \
+     MAX_SOCKET_READ
+from .fcpmessage import FCPParser, StreamingFCPParser
+
+class SocketPairPolledSocket(PolledSocket):
+    """ PolledSocket running over one end of a socket.socketpair(). """
+    def __init__(self, connected_socket):
+        connected_socket.setblocking(0)
+        NonBlockingSocket.__init__(self, connected_socket)
+
+class SocketPairSelectorSocket(SelectorSocket):
+    """ SelectorSocket running over one end of a socket.socketpair(). """
+    def __init__(self, connected_socket):
+        connected_socket.setblocking(0)
+        NonBlockingSocket.__init__(self, connected_socket)
+        self.selector = None
+        self.events = 0
+
+class RepeatingDataSource(IDataSource):
+    """ IDataSource which returns the same block over and over
+        without touching the disk. """
+    def __init__(self, total_bytes, block_size=READ_BLOCK):
+        IDataSource.__init__(self)
+        self.total_bytes = total_bytes
+        self.block = bytes(bytearray(range(256)) * (block_size // 256))
+        self.remaining = 0
+
+    def initialize(self):
+        self.remaining = self.total_bytes
+
+    def data_length(self):
+        return self.total_bytes
+
+    def release(self):
+        self.remaining = 0
+
+    def read(self):
+        if self.remaining <= 0:
+            return None
+        block = self.block[:self.remaining]
+        self.remaining -= len(block)
+        return block
+
+class Drain(threading.Thread):
+    """ Reads everything from a socket until EOF. """
+    def __init__(self, sock, keep=False):
+        threading.Thread.__init__(self)
+        self.sock = sock
+        self.keep = keep
+        self.received = 0
+        self.data = []
+
+    def run(self):
+        while True:
+            data = self.sock.recv(256 * 1024)
+            if not data:
+                break
+            self.received += len(data)
+            if self.keep:
+                self.data.append(data)
+
+def pump_upload(polled, source):
+    """ Drive polled.poll() until source is exhausted and
+        the write queue is empty. """
+    def writable():
+        data = source.read()
+        if not data:
+            polled.writable_callback = None
+            return
+        polled.write_bytes(data)
+
+    source.initialize()
+    polled.writable_callback = writable
+    while polled.buffer or polled.writable_callback:
+        polled.poll()
+    source.release()
+
+class WriteQueueTests(unittest.TestCase):
+    def test_ordering(self):
+        left, right = socket.socketpair()
+        drain = Drain(right, True)
+        drain.start()
+        polled = SocketPairPolledSocket(left)
+        chunks = [b'x' * 10, b'abc', b'y' * 200000, b'z']
+        for chunk in chunks:
+            polled.write_bytes(chunk)
+        self.assertEqual(polled.buffered_bytes(), sum(map(len, chunks)))
+        source = RepeatingDataSource(100000, 1024)
+        pump_upload(polled, source)
+        self.assertEqual(polled.buffered_bytes(), 0)
+        left.close()
+        drain.join()
+        right.close()
+        received = b''.join(drain.data)
+        expected = b''.join(chunks)
+        self.assertEqual(received[:len(expected)], expected)
+        self.assertEqual(len(received), len(expected) + 100000)
+
+def make_transcript(rand, count, max_data=4096):
+    """ Make a random raw FCP byte stream with count messages.
+        Some of the messages have trailing data. """
+    chunks = []
+    for index in range(count):
+        eol = rand.choice((b'\n', b'\r\n'))
+        identifier = b'id_%i' % index
+        fields = [b'Identifier=' + identifier,
+                  b'ExtraDescription=Invalid size: %i maxlength=10' % index,
+                  b' Padded = %s ' % (b'x' * rand.randint(0, 64))]
+        data = None
+        if rand.random() < .3:
+            length = rand.randint(1, max_data)
+            data = rand.getrandbits(8 * length).to_bytes(length, 'big')
+            fields.append(b'DataLength=%i' % len(data))
+        chunks.append(rand.choice((b'', eol)) + b'AllData' + eol)
+        chunks.append(eol.join(fields) + eol)
+        if data is None:
+            chunks.append(rand.choice((b'End', b'EndMessage')) + eol)
+        else:
+            chunks.append(b'Data' + eol)
+            chunks.append(data)
+    return b''.join(chunks)
+
+def run_parser(parser, transcript, cuts):
+    """ Push transcript into parser, split at cuts, and return a list of
+        (msg, trailing_data) tuples. """
+    results = []
+    contexts = {}
+    def get_context(identifier):
+        context = RequestContext(0, identifier, None)
+        context.file_name = None
+        contexts[identifier] = context
+        return context
+    def msg_callback(msg):
+        data = None
+        if msg[1][b'Identifier'] in contexts:
+            data = bytes(contexts[msg[1][b'Identifier']].data_sink.raw_data)
+        results.append((msg, data))
+
+    parser.context_callback = get_context
+    parser.msg_callback = msg_callback
+    prev = 0
+    for pos in cuts + [len(transcript)]:
+        if pos > prev:
+            parser.parse_bytes(transcript[prev:pos])
+            prev = pos
+    return results
+
+class SelectorSocketTests(unittest.TestCase):
+    def test_wait(self):
+        left, right = socket.socketpair()
+        polled = SocketPairSelectorSocket(left)
+        received = []
+        polled.recv_callback = received.append
+
+        # Times out when idle.
+        start = time.time()
+        polled.wait(.2)
+        self.assertTrue(time.time() - start >= .15)
+
+        # Wakes up as soon as there's something to read.
+        timer = threading.Timer(.05, right.sendall, (b'NodeHello\n',))
+        timer.start()
+        start = time.time()
+        polled.wait(10)
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue(polled.poll())
+        self.assertEqual(received, [b'NodeHello\n'])
+        timer.join()
+
+        # Doesn't block when there's something to write.
+        polled.write_bytes(b'ClientHello\n')
+        start = time.time()
+        polled.wait(10)
+        self.assertTrue(time.time() - start < 5)
+        polled.poll()
+        self.assertEqual(right.recv(1024), b'ClientHello\n')
+
+        polled.close()
+        right.close()
+
+class DataSinkTests(unittest.TestCase):
+    def test_spill(self):
+        budget = MemoryBudget(2500, 2000)
+        sinks = [DataSink() for dummy in range(3)]
+        blobs = [b'a' * 1500, b'b' * 1500, b'c' * 2500]
+        for sink, blob in zip(sinks, blobs):
+            sink.budget = budget
+            sink.initialize(len(blob), None)
+            for pos in range(0, len(blob), 500):
+                sink.write_bytes(blob[pos:pos + 500])
+
+        # The second exceeds the global budget, the third the request
+        # limit.
+        self.assertFalse(sinks[0].spill_file)
+        self.assertTrue(sinks[1].spill_file)
+        self.assertTrue(sinks[2].spill_file)
+        for sink, blob in zip(sinks, blobs):
+            self.assertEqual(sink.raw_data, blob)
+
+        stats = budget.stats()
+        self.assertEqual(stats['in_flight'], 1500)
+        self.assertEqual(stats['peak_in_flight'], 2500)
+        self.assertEqual(stats['spilled_requests'], 2)
+        self.assertEqual(stats['spilled_bytes'], 4000)
+        for sink in sinks:
+            sink.release()
+        self.assertEqual(budget.stats()['in_flight'], 0)
+
+class ParserTests(unittest.TestCase):
+    def test_equivalence(self):
+        rand = random.Random(0xfcb)
+        for dummy in range(50):
+            transcript = make_transcript(rand, rand.randint(1, 40))
+            cuts = sorted(rand.randint(0, len(transcript))
+                          for dummy in range(rand.randint(0, 60)))
+            expected = run_parser(FCPParser(), transcript, [])
+            self.assertEqual(run_parser(FCPParser(), transcript, cuts),
+                             expected)
+            self.assertEqual(run_parser(StreamingFCPParser(), transcript,
+                                        cuts), expected)
+
+    def test_byte_at_a_time(self):
+        rand = random.Random(7)
+        transcript = make_transcript(rand, 20, 256)
+        self.assertEqual(run_parser(StreamingFCPParser(), transcript,
+                                    list(range(len(transcript)))),
+                         run_parser(FCPParser(), transcript, []))
+
+    def test_burst(self):
+        # FCPParser recurses once per trailing data blob in a chunk.
+        rand = random.Random(3)
+        transcript = make_transcript(rand, 20000, 1)
+        results = run_parser(StreamingFCPParser(), transcript, [])
+        self.assertEqual(len(results), 20000)
+
+def benchmark_parser(count=20000):
+    """ Time both parsers over the same synthetic transcripts, fed
+        in MAX_SOCKET_READ sized chunks like PolledSocket does. """
+    for max_data in (64, 32 * 1024):
+        transcript = make_transcript(random.Random(1), count, max_data)
+        cuts = list(range(MAX_SOCKET_READ, len(transcript), MAX_SOCKET_READ))
+        for parser_class in (FCPParser, StreamingFCPParser):
+            start = time.time()
+            msgs = len(run_parser(parser_class(), transcript, cuts))
+            elapsed = max(time.time() - start, 1e-6)
+            print("%s: %i msgs, %.1f MB in %.2fs -> %.1f MB/s" %
+                  (parser_class.__name__, msgs, len(transcript) / 1048576.0,
+                   elapsed, len(transcript) / 1048576.0 / elapsed))
+
+def benchmark_upload(megabytes=256):
+    """ Push megabytes through a socketpair and print MB/s and
+        peak RSS. """
+    left, right = socket.socketpair()
+    drain = Drain(right)
+    drain.start()
+    polled = SocketPairPolledSocket(left)
+    source = RepeatingDataSource(megabytes * 1024 * 1024)
+    start = time.time()
+    pump_upload(polled, source)
+    left.close()
+    drain.join()
+    right.close()
+    elapsed = max(time.time() - start, 1e-6)
+    assert drain.received == megabytes * 1024 * 1024
+    # ru_maxrss is in kilobytes on Linux.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("upload: %i MB in %.2fs -> %.1f MB/s, peak RSS %i KB" %
+          (megabytes, elapsed, megabytes / elapsed, peak))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark':
+        benchmark_upload(int(sys.argv[2]) if len(sys.argv) > 2 else 256)
+        benchmark_parser()
+    else:
+        unittest.main()
@@ -0,0 +1,317 @@
+""" Tests for the fake FCP node and an end to end benchmark harness for
+    fn-create/fn-push/fn-pull/fn-archive which runs against it.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+#pylint: disable-msg=C0111,C0103,R0904,W0201
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from .chk import clear_control_bytes
+from .fcpconnection import FCPError, SelectorSocket
+from .fcpclient import FCPClient
+from .fcpmessage import GET_REQUEST_URI_DEF, PUT_COMPLEX_DIR_DEF
+from .fcpstub import FakeFCPNode, make_content_chk
+from .test_requestqueue import BytesDataSource
+
+def make_client(node):
+    client = FCPClient.connect(node.host, node.port, SelectorSocket)
+    client.message_callback = lambda dummy_client, dummy_msg: None
+    return client
+
+def invert(client, insert_uri):
+    """ Return the public URI for insert_uri the way InvertingUri does. """
+    client.reset()
+    client.in_params.definition = GET_REQUEST_URI_DEF
+    client.in_params.fcp_params = {b'URI':insert_uri,
+                                   b'UploadFrom':b'direct',
+                                   b'GetCHKOnly':True}
+    client.in_params.send_data = b'@' * 9
+    return client.conn.start_request(client)[1][b'URI']
+
+def put_dir(client, uri, files):
+    """ Insert files, a list of (name, data) tuples, with
+        ClientPutComplexDir. files[0] is the default document. """
+    client.reset()
+    client.in_params.definition = PUT_COMPLEX_DIR_DEF
+    fields = {}
+    for index, (name, data) in enumerate(files):
+        fields[b'Files.%i.Name' % index] = name
+        fields[b'Files.%i.UploadFrom' % index] = b'direct'
+        fields[b'Files.%i.DataLength' % index] = b'%i' % len(data)
+    client.in_params.fcp_params = {b'URI':uri, b'Files':fields,
+                                   b'DefaultName':files[0][0]}
+    client.in_params.send_data = True
+    return client.conn.start_request(
+        client, BytesDataSource(b''.join([data for dummy, data in files])),
+        False)
+
+class NodeTests(unittest.TestCase):
+    def setUp(self):
+        self.node = FakeFCPNode(seed=0).start()
+        self.client = make_client(self.node)
+
+    def tearDown(self):
+        self.client.close()
+        self.node.stop()
+
+    def assertCode(self, code, func, *args):
+        try:
+            func(*args)
+        except FCPError as err:
+            self.assertTrue(err.is_code(code))
+            return err.fcp_msg
+        self.fail("Didn't raise FCPError")
+
+    def test_chk(self):
+        data = b'some data' * 1000
+        uri = self.client.put(b'CHK@', data)[1][b'URI']
+        self.assertEqual(uri, make_content_chk(data))
+        self.assertEqual(self.client.get(uri)[2], data)
+        self.assertCode(13, self.client.get, make_content_chk(b'missing'))
+
+    def test_salted_metadata(self):
+        data = b'bundle data' * 10000
+        uri = self.client.put(b'CHK@', data,
+                              b'application/mercurial-bundle_0')[1][b'URI']
+        metadata = self.client.get(clear_control_bytes(uri))[2]
+        pos = metadata.find(b'application/mercurial-bundle_0')
+        self.assertTrue(pos > -1)
+        salted = metadata[:pos + 29] + b'1' + metadata[pos + 30:]
+        salted_uri = self.client.put(b'CHK@', salted)[1][b'URI']
+        self.assertNotEqual(salted_uri, uri)
+        self.assertEqual(self.client.get(salted_uri)[2], data)
+        self.assertEqual(self.client.get(clear_control_bytes(salted_uri))[2],
+                         salted)
+        # Small inserts are a single block, with no metadata to fetch.
+        uri = self.client.put(b'CHK@', b'small',
+                              b'application/mercurial-bundle_0')[1][b'URI']
+        self.assertCode(13, self.client.get, clear_control_bytes(uri))
+
+    def test_ssk(self):
+        keypair = self.client.generate_ssk()[1]
+        insert_uri = keypair[b'InsertURI'] + b'test-3'
+        request_uri = keypair[b'RequestURI'] + b'test-3'
+        self.assertEqual(invert(self.client, insert_uri), request_uri)
+        self.assertCode(13, self.client.get, request_uri)
+
+        uri = self.client.put(insert_uri, b'ssk data')[1][b'URI']
+        self.assertEqual(uri, request_uri)
+        self.assertEqual(self.client.get(request_uri)[2], b'ssk data')
+
+    def test_usk_editions(self):
+        keypair = self.client.generate_ssk()[1]
+        insert_uri = b'USK' + keypair[b'InsertURI'][3:] + b'test/0'
+        request_uri = b'USK' + keypair[b'RequestURI'][3:] + b'test/'
+        for edition in range(3):
+            uri = self.client.put(insert_uri, b'edition %i' % edition)[1][b'URI']
+            self.assertEqual(uri, request_uri + b'%i' % edition)
+
+        # Editions inserted as frozen SSKs count too.
+        self.client.put(keypair[b'InsertURI'] + b'test-3', b'edition 3')
+
+        self.assertEqual(self.client.get(request_uri + b'3')[2], b'edition 3')
+        msg = self.assertCode(27, self.client.get, request_uri + b'1')
+        self.assertEqual(msg[1][b'RedirectURI'], request_uri + b'3')
+        self.assertCode(27, self.client.get, request_uri + b'-3')
+        self.assertCode(13, self.client.get, request_uri + b'4')
+        self.assertEqual(self.client.get(request_uri + b'-1', 1)[2],
+                         b'edition 3')
+
+    def test_complex_dir(self):
+        files = [(b'index.html', b'<html/>'), (b'a.txt', b'a' * 100000),
+                 (b'b.txt', b'b')]
+        uri = put_dir(self.client, b'CHK@', files)[1][b'URI']
+        self.assertEqual(self.client.get(uri)[2], b'<html/>')
+        for name, data in files:
+            self.assertEqual(self.client.get(uri + b'/' + name)[2], data)
+
+        keypair = self.client.generate_ssk()[1]
+        uri = put_dir(self.client, b'USK' + keypair[b'InsertURI'][3:]
+                      + b'site/5/', files)[1][b'URI']
+        self.assertEqual(uri, b'USK' + keypair[b'RequestURI'][3:] + b'site/5')
+        self.assertEqual(self.client.get(uri + b'/a.txt')[2], files[1][1])
+
+    def test_failure_rate(self):
+        self.node.insert(b'CHK@fake', b'data')
+        self.node.failure_rate = 1.0
+        self.assertCode(15, self.client.get, b'CHK@fake')
+        self.assertCode(5, self.client.put, b'CHK@', b'data')
+        self.node.failure_rate = 0.0
+        self.node.dnf_rate = 1.0
+        self.assertCode(13, self.client.get, b'CHK@fake')
+
+# REQUIRES: mercurial in PYTHONPATH!
+def commit_random_files(ui_, repo, rand, count, max_bytes):
+    """ Commit count new or changed files of up to max_bytes. """
+    from mercurial import commands
+
+    for dummy in range(count):
+        name = b'file_%i.bin' % rand.randint(0, 4 * count)
+        full_path = os.path.join(repo.root, name)
+        length = rand.randint(1, max_bytes)
+        out_file = open(full_path, 'wb')
+        try:
+            out_file.write(rand.getrandbits(8 * length).to_bytes(length,
+                                                                 'big'))
+        finally:
+            out_file.close()
+        commands.commit(ui_, repo, addremove=True, user=b'bench',
+                        message=b'Changed %s' % name)
+
+def snapshot(node):
+    """ Returns a copy of the byte and request counts in node.stats. """
+    return (node.stats['bytes_in'], node.stats['bytes_out'],
+            dict(node.stats['requests']))
+
+def report(label, elapsed, before, after):
+    """ Print the time, bytes and requests between two snapshot()s. """
+    requests = ', '.join(['%s=%i' % (name.decode('utf-8'),
+                                     count - before[2].get(name, 0))
+                          for name, count in sorted(after[2].items())
+                          if count != before[2].get(name, 0)])
+    print("%s: %.2fs, %i bytes up, %i bytes down, requests: %s" %
+          (label, elapsed, after[0] - before[0], after[1] - before[1],
+           requests))
+
+def run_command(node, label, func, *args):
+    """ Run an execute_* function and report what it cost. """
+    before = snapshot(node)
+    start = time.time()
+    ret = func(*args)
+    report(label, time.time() - start, before, snapshot(node))
+    return ret
+
+def benchmark_commands(commits=20, max_bytes=64 * 1024, latency_secs=0.05,
+                       bandwidth=1024 * 1024, failure_rate=0.0, dnf_rate=0.0,
+                       archive=False):
+    """ Run create, push, pull and, if archive is True, archive create
+        end to end against a FakeFCPNode and print wall time, requests
+        and bytes for each.
+
+        archive is off by default because the wormarc code fn-archive
+        uses hasn't been ported to Python 3 yet. """
+    from mercurial import ui, hg
+    try:
+        # Registers the revsets and bundle2 parts hg bundle and
+        # hg unbundle need outside of hg. Older versions don't need it.
+        from mercurial import initialization #pylint: disable-msg=W0611
+    except ImportError:
+        pass
+    from . import config
+    from .infcmds import DEFAULT_PARAMS, execute_create, execute_push, \
+         execute_pull
+
+    rand = random.Random(0xf00)
+    node = FakeFCPNode(latency_secs, bandwidth, failure_rate, dnf_rate,
+                       seed=1).start()
+    test_root = tempfile.mkdtemp(prefix='fcpstub_bench_')
+    try:
+        ui_ = ui.ui.load()
+        ui_.setconfig(b'ui', b'quiet', b'true')
+        stored_cfg = config.Config()
+        stored_cfg.file_name = os.path.join(test_root, 'infocalypse.cfg')
+        # infcmds wants bytes paths.
+        stored_cfg.defaults['TMP_DIR'] = os.fsencode(os.path.join(test_root,
+                                                                  'tmp'))
+        stored_cfg.defaults['PORT'] = node.port
+        os.makedirs(stored_cfg.defaults['TMP_DIR'])
+
+        def make_params(**extra):
+            params = DEFAULT_PARAMS.copy()
+            params.update({'FCP_HOST':node.host,
+                           'FCP_PORT':node.port,
+                           'TMP_DIR':stored_cfg.defaults['TMP_DIR'],
+                           'VERBOSITY':1,
+                           'NO_SEARCH':False,
+                           'AGGRESSIVE_SEARCH':False})
+            params.update(extra)
+            return params
+
+        client = make_client(node)
+        try:
+            private_key = client.generate_ssk()[1][b'InsertURI']
+        finally:
+            client.close()
+        # Like fn-setup.
+        stored_cfg.defaults['DEFAULT_PRIVATE_KEY'] = private_key
+        insert_uri = b'USK' + private_key[3:] + b'bench.R1/0'
+
+        source = hg.repository(ui_, os.path.join(test_root,
+                                                 'source').encode('utf-8'),
+                               create=True)
+        commit_random_files(ui_, source, rand, commits, max_bytes)
+        request_uris = run_command(node, 'fn-create', execute_create, ui_,
+                                   source,
+                                   make_params(INSERT_URI=insert_uri,
+                                               TO_VERSIONS=(b'tip',)),
+                                   stored_cfg)
+        assert request_uris
+
+        commit_random_files(ui_, source, rand, max(commits // 4, 1),
+                            max_bytes)
+        run_command(node, 'fn-push', execute_push, ui_, source,
+                    make_params(INSERT_URI=insert_uri,
+                                TO_VERSIONS=(b'tip',)),
+                    stored_cfg)
+
+        target = hg.repository(ui_, os.path.join(test_root,
+                                                 'target').encode('utf-8'),
+                               create=True)
+        run_command(node, 'fn-pull', execute_pull, ui_, target,
+                    make_params(REQUEST_URI=request_uris[0]), stored_cfg)
+        assert target[b'tip'].node() == source[b'tip'].node()
+
+        if archive:
+            from .arccmds import execute_arc_create
+            from_dir = os.path.join(test_root, 'archive')
+            os.makedirs(from_dir)
+            for index in range(commits):
+                out_file = open(os.path.join(from_dir,
+                                             'file_%i.bin' % index), 'wb')
+                try:
+                    length = rand.randint(1, max_bytes)
+                    out_file.write(rand.getrandbits(8 * length).to_bytes(
+                        length, 'big'))
+                finally:
+                    out_file.close()
+            run_command(node, 'fn-archive --create', execute_arc_create, ui_,
+                        make_params(INSERT_URI=b'USK' + private_key[3:]
+                                    + b'archive.R1/0',
+                                    FROM_DIR=os.fsencode(from_dir),
+                                    ARCHIVE_CACHE_DIR=os.fsencode(
+                                        os.path.join(test_root, 'arc_cache'))),
+                        stored_cfg)
+        print("total: %i connections, %i bytes up, %i bytes down" %
+              (node.stats['connections'], node.stats['bytes_in'],
+               node.stats['bytes_out']))
+    finally:
+        node.stop()
+        shutil.rmtree(test_root)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark':
+        benchmark_commands(archive='--archive' in sys.argv)
+    else:
+        unittest.main()
@@ -0,0 +1,365 @@
+""" Tests and benchmarks for RequestRunner, run against fcpstub.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+#pylint: disable-msg=C0111,C0103,R0904,W0201
+import random
+import sys
+import time
+import unittest
+
+from .fcpconnection import FCPConnection, SelectorSocket, IDataSource
+from .fcpmessage import GET_DEF, PUT_FILE_DEF
+from .fcpstub import FakeFCPNode
+from .requestqueue import RequestRunner, RequestQueue, QueueableRequest, \
+     QueueDelayTracer, DeadlineHeap, CANCELED_GET_CODE, FCP_PRIORITY_CLASSES, PRIORITY_TOP_KEY, \
+     PRIORITY_UPDATE_PATH, PRIORITY_NORMAL, PRIORITY_REDUNDANT
+
+CANCEL_TIME_SECS = 60
+
+class BytesDataSource(IDataSource):
+    """ IDataSource which returns data from a bytes instance. """
+    def __init__(self, data, block_size=16 * 1024):
+        IDataSource.__init__(self)
+        self.data = data
+        self.block_size = block_size
+        self.pos = 0
+
+    def initialize(self):
+        self.pos = 0
+
+    def data_length(self):
+        return len(self.data)
+
+    def release(self):
+        self.pos = len(self.data)
+
+    def read(self):
+        if self.pos >= len(self.data):
+            return None
+        block = self.data[self.pos:self.pos + self.block_size]
+        self.pos += len(block)
+        return block
+
+def make_get(queue, uri, priority=None):
+    request = QueueableRequest(queue)
+    request.priority = priority
+    request.in_params.definition = GET_DEF
+    request.in_params.fcp_params = {b'URI':uri, b'MaxRetries':b'0'}
+    request.cancel_time_secs = time.time() + CANCEL_TIME_SECS
+    return request
+
+def make_put(queue, data):
+    request = QueueableRequest(queue)
+    request.in_params.definition = PUT_FILE_DEF
+    request.in_params.fcp_params = {b'URI':b'CHK@'}
+    request.in_params.send_data = True
+    request.custom_data_source = BytesDataSource(data)
+    request.cancel_time_secs = time.time() + CANCEL_TIME_SECS
+    return request
+
+class ListQueue(RequestQueue):
+    """ RequestQueue which runs a fixed list of requests. """
+    def __init__(self, runner, requests=()):
+        RequestQueue.__init__(self, runner)
+        self.requests = list(requests)
+        self.finished = []
+
+    def next_runnable(self):
+        if not self.requests:
+            return None
+        return self.requests.pop(0)
+
+    def request_done(self, client, msg):
+        self.finished.append((time.time(), client, msg))
+
+def make_runner(node, concurrent, upload_connections=0):
+    runner = RequestRunner(
+        FCPConnection(SelectorSocket(node.host, node.port), True),
+        concurrent)
+    for dummy in range(upload_connections):
+        runner.add_connection(
+            FCPConnection(SelectorSocket(node.host, node.port), True), True)
+    return runner
+
+def run_queue(runner, queue, total, timeout_secs=60):
+    runner.add_queue(queue)
+    started = time.time()
+    try:
+        while len(queue.finished) < total:
+            assert time.time() - started < timeout_secs
+            assert runner.poll()
+            runner.kick()
+            runner.wait(0.1)
+    finally:
+        runner.close()
+    return time.time() - started
+
+def make_workload(node, queue, uploads, upload_bytes, fetches, fetch_bytes):
+    """ Make a list of interleaved upload and fetch requests. """
+    requests = []
+    for index in range(fetches):
+        uri = b'CHK@fake_%i' % index
+        node.insert(uri, bytes(bytearray([index % 256])) * fetch_bytes)
+        requests.append(make_get(queue, uri))
+    for index in range(uploads):
+        data = bytes(bytearray([index % 256])) * upload_bytes
+        requests.insert(index * (len(requests) // uploads + 1),
+                        make_put(queue, data))
+    return requests
+
+class PoolTests(unittest.TestCase):
+    def run_workload(self, upload_connections):
+        node = FakeFCPNode(latency_secs=0.01, bandwidth=4 * 1024 * 1024)
+        node.start()
+        try:
+            runner = make_runner(node, 8, upload_connections)
+            queue = ListQueue(runner)
+            queue.requests = make_workload(node, queue, 2, 1024 * 1024,
+                                           16, 16 * 1024)
+            run_queue(runner, queue, 18)
+        finally:
+            node.stop()
+        for dummy, client, msg in queue.finished:
+            self.assertTrue(msg[0] in (b'AllData', b'PutSuccessful'))
+            if msg[0] == b'PutSuccessful':
+                self.assertTrue(msg[1][b'URI'] in node.store)
+                self.assertEqual(node.store[msg[1][b'URI']],
+                                 client.custom_data_source.data)
+        return queue.finished
+
+    def test_single_connection(self):
+        self.run_workload(0)
+
+    def test_upload_lane(self):
+        finished = self.run_workload(1)
+        # Fetches didn't have to wait for the uploads.
+        fetches = [entry[0] for entry in finished if entry[2][0] == b'AllData']
+        uploads = [entry[0] for entry in finished
+                   if entry[2][0] == b'PutSuccessful']
+        self.assertTrue(max(fetches) < max(uploads))
+
+class SchedulingTests(unittest.TestCase):
+    def setUp(self):
+        self.node = FakeFCPNode().start()
+        for index in range(8):
+            self.node.insert(b'CHK@fake_%i' % index, b'data')
+
+    def tearDown(self):
+        self.node.stop()
+
+    def test_priority(self):
+        runner = make_runner(self.node, 1)
+        runner.lookahead = 8
+        runner.tracer = QueueDelayTracer()
+        queue = ListQueue(runner)
+        priorities = (PRIORITY_REDUNDANT, PRIORITY_NORMAL, None,
+                      PRIORITY_UPDATE_PATH, PRIORITY_TOP_KEY,
+                      PRIORITY_REDUNDANT)
+        queue.requests = [make_get(queue, b'CHK@fake_%i' % index, priority)
+                          for index, priority in enumerate(priorities)]
+        # Missed deadlines go first.
+        queue.requests[-1].deadline_secs = time.time() - 1
+        run_queue(runner, queue, len(priorities))
+
+        finished = [entry[1].in_params.fcp_params[b'URI']
+                    for entry in queue.finished]
+        self.assertEqual(finished, [b'CHK@fake_5', b'CHK@fake_4',
+                                    b'CHK@fake_3', b'CHK@fake_1',
+                                    b'CHK@fake_2', b'CHK@fake_0'])
+        for dummy, client, dummy_msg in queue.finished:
+            if client.priority is None:
+                self.assertFalse(b'PriorityClass' in client.in_params.fcp_params)
+            else:
+                self.assertEqual(client.in_params.fcp_params[b'PriorityClass'],
+                                 FCP_PRIORITY_CLASSES[client.priority])
+
+        stats = runner.tracer.stats()
+        self.assertEqual(stats['normal'][0], 2)
+        self.assertEqual(stats['redundant'][0], 2)
+        self.assertTrue(stats['redundant'][2] >= stats['top_key'][2])
+
+    def test_weights(self):
+        runner = make_runner(self.node, 1)
+        runner.lookahead = 0
+        heavy = ListQueue(runner)
+        light = ListQueue(runner)
+        # Both report into the same list.
+        light.finished = heavy.finished
+        heavy.requests = [make_get(heavy, b'CHK@fake_%i' % index)
+                          for index in range(6)]
+        light.requests = [make_get(light, b'CHK@fake_%i' % index)
+                          for index in range(6, 8)]
+        runner.add_queue(heavy, 3)
+        run_queue(runner, light, 8)
+        self.assertEqual([entry[1].queue for entry in heavy.finished],
+                         [heavy] * 3 + [light] + [heavy] * 3 + [light])
+
+class Deadline:
+    def __init__(self, when):
+        self.when = when
+
+class TimeoutTests(unittest.TestCase):
+    def test_deadline_heap(self):
+        items = [Deadline(when) for when in (5, 1, 3, 2, 4)]
+        heap = DeadlineHeap(lambda item: item.when)
+        for item in items:
+            heap.push(item)
+        self.assertEqual(heap.next_deadline(), 1)
+
+        items[1].when = 10 # Moved later, picked up lazily.
+        heap.remove(items[3])
+        items[0].when = 0
+        heap.push(items[0]) # Moved earlier, must push again.
+        self.assertEqual(len(heap), 4)
+        self.assertEqual(heap.pop_expired(3), [items[0], items[2]])
+        self.assertEqual(heap.pop_expired(9), [items[4]])
+        self.assertEqual(heap.next_deadline(), 10)
+        self.assertEqual(heap.pop_expired(10), [items[1]])
+        self.assertEqual(heap.next_deadline(), None)
+
+    def test_timeouts(self):
+        node = FakeFCPNode(latency_secs=0.3).start()
+        try:
+            for index in range(4):
+                node.insert(b'CHK@fake_%i' % index, b'data')
+            runner = make_runner(node, 2)
+            runner.lookahead = 2
+            queue = ListQueue(runner)
+            queue.requests = [make_get(queue, b'CHK@fake_%i' % index)
+                              for index in range(4)]
+            for request in queue.requests:
+                request.cancel_time_secs = time.time() + 0.1
+            run_queue(runner, queue, 4)
+        finally:
+            node.stop()
+
+        # The deferred requests were started before they timed out ...
+        self.assertEqual(node.stats['requests'][b'ClientGet'], 4)
+        # ... and each one was sent exactly one RemoveRequest.
+        self.assertEqual(node.stats['requests'][b'RemoveRequest'], 4)
+        self.assertEqual(len(runner.timeouts), 0)
+
+    def test_deferred_wait(self):
+        node = FakeFCPNode(latency_secs=0.3).start()
+        try:
+            for index in range(6):
+                node.insert(b'CHK@fake_%i' % index, b'data')
+            runner = make_runner(node, 2)
+            runner.lookahead = 4
+            queue = ListQueue(runner)
+            queue.requests = [make_get(queue, b'CHK@fake_%i' % index)
+                              for index in range(6)]
+            for request in queue.requests:
+                request.cancel_time_secs = time.time() + 0.5
+            run_queue(runner, queue, 6)
+        finally:
+            node.stop()
+
+        # Waiting to be started didn't count against the cancel time.
+        self.assertEqual([msg[0] for dummy, dummy, msg in queue.finished],
+                         [b'AllData'] * 6)
+        self.assertEqual(node.stats['requests'].get(b'RemoveRequest', 0), 0)
+
+    def test_cancel_deferred(self):
+        node = FakeFCPNode(latency_secs=0.3).start()
+        try:
+            for index in range(4):
+                node.insert(b'CHK@fake_%i' % index, b'data')
+            runner = make_runner(node, 2)
+            runner.lookahead = 2
+            queue = ListQueue(runner)
+            requests = [make_get(queue, b'CHK@fake_%i' % index)
+                        for index in range(4)]
+            queue.requests = requests[:]
+            runner.add_queue(queue)
+            runner.kick()
+            for client in requests[2:]:
+                self.assertTrue(runner.is_deferred(client))
+                runner.cancel_request(client)
+            run_queue(runner, queue, 4)
+        finally:
+            node.stop()
+
+        # The canceled requests were failed without being started.
+        failed = [msg for dummy, dummy, msg in queue.finished
+                  if msg[0] == b'GetFailed']
+        self.assertEqual(len(failed), 2)
+        for msg in failed:
+            self.assertEqual(msg[1][b'Code'], b'%i' % CANCELED_GET_CODE)
+        self.assertEqual(node.stats['requests'][b'ClientGet'], 2)
+        self.assertEqual(len(runner.timeouts), 0)
+
+def benchmark_timeouts(counts=(1000, 4000, 16000), latency_secs=2.0):
+    """ Run thousands of concurrent requests, some of which time out,
+        and print how long kick() takes. """
+    rand = random.Random(0)
+    for count in counts:
+        node = FakeFCPNode(latency_secs=latency_secs)
+        node.start()
+        try:
+            runner = make_runner(node, count)
+            queue = ListQueue(runner)
+            for index in range(count):
+                node.insert(b'CHK@fake_%i' % index, b'data')
+                request = make_get(queue, b'CHK@fake_%i' % index)
+                # A few time out while they are running.
+                if rand.random() < .05:
+                    request.cancel_time_secs = (time.time() +
+                                                latency_secs / 2)
+                queue.requests.append(request)
+            kicks = [0, 0.0]
+            kick = runner.kick
+            def timed_kick():
+                start = time.time()
+                kick()
+                kicks[0] += 1
+                kicks[1] += time.time() - start
+            runner.kick = timed_kick
+            elapsed = run_queue(runner, queue, count, 600)
+        finally:
+            node.stop()
+        print("%i concurrent requests in %.2fs, %i kicks, %.1f usec/kick" %
+              (count, elapsed, kicks[0], kicks[1] * 1e6 / kicks[0]))
+
+def benchmark_pool(uploads=4, upload_mb=4, fetches=256, fetch_kb=32):
+    """ Compare one FCPConnection with a pool with an upload lane. """
+    for upload_connections in (0, 1, 2):
+        node = FakeFCPNode(latency_secs=0.05, bandwidth=8 * 1024 * 1024)
+        node.start()
+        try:
+            runner = make_runner(node, 8, upload_connections)
+            queue = ListQueue(runner)
+            queue.requests = make_workload(node, queue, uploads,
+                                           upload_mb * 1024 * 1024,
+                                           fetches, fetch_kb * 1024)
+            elapsed = run_queue(runner, queue, uploads + fetches, 600)
+            total = node.stats['bytes_in'] + node.stats['bytes_out']
+        finally:
+            node.stop()
+        print("upload connections: %i, %i requests in %.2fs -> %.2f MB/s" %
+              (upload_connections, uploads + fetches, elapsed,
+               total / 1048576.0 / elapsed))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark':
+        benchmark_pool()
+        benchmark_timeouts()
+    else:
+        unittest.main()
@@ -0,0 +1,163 @@
+""" Tests for RetryingRequestList, run against fcpstub.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+#pylint: disable-msg=C0111,C0103,R0904,W0201
+import time
+import unittest
+
+from . import statemachine
+from .fcpmessage import GET_DEF
+from .fcpstub import FakeFCPNode
+from .requestqueue import RequestQueue
+from .statemachine import StateMachine, RetryingRequestList, \
+     CandidateRequest, Quiescent
+from .test_requestqueue import make_runner, run_queue, CANCEL_TIME_SECS
+
+SLOW_SECS = 1.5
+
+class FetchingList(RetryingRequestList):
+    """ Fetches a list of URIs and retries the ones which fail.
+
+        candidate is [uri, tries]
+    """
+    def __init__(self, parent, name):
+        RetryingRequestList.__init__(self, parent, name)
+        self.max_tries = 3
+
+    def make_request(self, candidate):
+        candidate[1] += 1
+        request = CandidateRequest(self.parent)
+        request.tag = candidate[0]
+        request.candidate = candidate
+        request.in_params.definition = GET_DEF
+        request.in_params.fcp_params = {b'URI':candidate[0],
+                                        b'MaxRetries':b'0'}
+        request.cancel_time_secs = time.time() + CANCEL_TIME_SECS
+        self.parent.started.append((time.time(), candidate[0]))
+        return request
+
+    def candidate_done(self, client, msg, candidate):
+        if msg[0] != b'AllData' and candidate[1] < self.max_tries:
+            self.parent.on_failure(candidate[0])
+            self.next_candidates.insert(0, candidate)
+            return
+        self.finished_candidates.append(candidate)
+        self.parent.finished.append((time.time(), candidate[0]))
+
+class FetchingMachine(RequestQueue, StateMachine):
+    def __init__(self, runner, node):
+        RequestQueue.__init__(self, runner)
+        StateMachine.__init__(self)
+        self.node = node
+        self.started = []
+        self.finished = []
+        self.states = {'QUIESCENT':Quiescent(self, 'QUIESCENT'),
+                       'FETCHING':FetchingList(self, 'FETCHING')}
+        self.current_state = self.states['QUIESCENT']
+
+    def on_failure(self, uri):
+        # Succeeds the next time.
+        self.node.insert(uri, b'data')
+
+    def next_runnable(self):
+        return self.current_state.next_runnable()
+
+    def request_done(self, client, msg):
+        self.current_state.request_done(client, msg)
+
+class PipelineTests(unittest.TestCase):
+    def setUp(self):
+        self.backoff_secs = statemachine.RETRY_BACKOFF_SECS
+        statemachine.RETRY_BACKOFF_SECS = 0.05
+
+    def tearDown(self):
+        statemachine.RETRY_BACKOFF_SECS = self.backoff_secs
+
+    def run_failing(self, pipeline_depth, fail_secs):
+        node = FakeFCPNode(latency_secs=0.01).start()
+        try:
+            node.slow[b'CHK@missing'] = fail_secs
+            runner = make_runner(node, 8)
+            machine = FetchingMachine(runner, node)
+            # Fails every time.
+            machine.on_failure = lambda uri: None
+            state = machine.states['FETCHING']
+            state.pipeline_depth = pipeline_depth
+            state.current_candidates = [[b'CHK@missing', 0]]
+            machine.transition('FETCHING')
+            machine.finished = []
+            run_queue(runner, machine, 1)
+        finally:
+            node.stop()
+        return [when for when, dummy in machine.started]
+
+    def run_fetches(self, pipeline_depth):
+        node = FakeFCPNode(latency_secs=0.01).start()
+        try:
+            node.insert(b'CHK@slow', b'data')
+            node.slow[b'CHK@slow'] = SLOW_SECS
+            for index in range(4):
+                node.insert(b'CHK@fake_%i' % index, b'data')
+
+            runner = make_runner(node, 8)
+            machine = FetchingMachine(runner, node)
+            state = machine.states['FETCHING']
+            state.pipeline_depth = pipeline_depth
+            # The missing ones fail once.
+            state.current_candidates = (
+                [[b'CHK@missing_%i' % index, 0] for index in range(3)] +
+                [[b'CHK@fake_%i' % index, 0] for index in range(4)] +
+                [[b'CHK@slow', 0]])
+            machine.transition('FETCHING')
+            machine.finished = []
+            run_queue(runner, machine, 8)
+        finally:
+            node.stop()
+        times = dict([(uri, when) for when, uri in machine.finished])
+        return times, state.generation_stats()
+
+    def test_sequential(self):
+        times, stats = self.run_fetches(None)
+        for index in range(3):
+            self.assertTrue(times[b'CHK@missing_%i' % index] >
+                            times[b'CHK@slow'])
+        self.assertEqual([entry[:2] for entry in stats], [(0, 8), (1, 3)])
+        self.assertTrue(stats[0][4] >= SLOW_SECS)
+
+    def test_pipelined(self):
+        times, stats = self.run_fetches(8)
+        # The retries didn't wait for the slow request.
+        for index in range(3):
+            self.assertTrue(times[b'CHK@missing_%i' % index] <
+                            times[b'CHK@slow'])
+        self.assertEqual([entry[:2] for entry in stats], [(0, 8), (1, 3)])
+        self.assertTrue(stats[1][4] < SLOW_SECS)
+
+    def test_backoff(self):
+        statemachine.RETRY_BACKOFF_SECS = 0.3
+        started = self.run_failing(8, 0.4)
+        self.assertEqual(len(started), 3)
+        # The backoff, which doubles, starts when the request fails,
+        # not when it is sent.
+        self.assertTrue(started[1] - started[0] >= 0.4 + 0.3)
+        self.assertTrue(started[2] - started[1] >= 0.4 + 0.6)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,1234 @@
+""" Tests and benchmarks for UpdateGraph which run against synthetic
+    graphs, without an hg repository.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+#pylint: disable-msg=C0111,C0103,R0904,W0201
+import copy
+import functools
+import itertools
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest
+
+from binascii import unhexlify
+
+from .graph import UpdateGraph, FIRST_INDEX, NULL_REV, FREENET_BLOCK_LEN, \
+     MAX_REDUNDANT_LENGTH, PENDING_INSERT, MAX_PATH_LEN, get_heads, \
+     latest_index, edges_containing, canonical_path_itr, \
+     build_version_table, load_version_table, VERSION_TABLE_FILE, \
+     PathSolver, block_cost, INVARIANT_STRUCTURAL, INVARIANT_INCREMENTAL, \
+     INVARIANT_FULL
+from .graphutil import parse_graph, graph_to_string, subgraph, \
+     minimal_graph, important_edge_itr, GraphSizer, graph_to_binary, \
+     parse_binary_graph, parse_graph_data
+from .choose import low_block_cost_edges, MAX_COST_RATIO, get_update_edges, \
+     pack_top_key_edges, simulate_pulls, pull_weights, graph_pull_steps, \
+     top_key_chks, top_key_edge_len
+from .topkey import top_key_tuple_to_bytes, top_key_update_len, BASE_LEN
+from .chk import freenet_base64_encode, CHK_SIZE
+from .costmodel import CostModel, make_cost_model, latency_edge_cost, \
+     redundancy_edge_cost, cost_model_report
+from .cowdict import CowDict
+
+def random_rev(rand):
+    return b'%040x' % rand.getrandbits(160)
+
+def random_chk(rand):
+    """ Returns a CHK with random keys like the ones the node returns. """
+    return (b'CHK@' + freenet_base64_encode(rand.randbytes(32)).rstrip(b'=')
+            + b',' + freenet_base64_encode(rand.randbytes(32)).rstrip(b'=')
+            + b',AAIC--8')
+
+def set_random_chks(graph, rand):
+    """ Replace the pending CHKs in graph with random ones. """
+    for edge in list(graph.edge_table.keys()):
+        length = graph.edge_table[edge][0]
+        graph.edge_table[edge] = (length, ) + tuple([
+            random_chk(rand) for dummy in graph.edge_table[edge][1:]])
+
+class FakeBundleCache:
+    """ Stands in for BundleCache.
+
+        Every index has a fixed size and the length of a bundle is
+        the sum of the sizes of the indices in it.
+    """
+    def __init__(self, rand):
+        self.rand = rand
+        # index -> sum of the sizes of the indices up to index
+        self.sums = {FIRST_INDEX:0}
+
+    def add_index(self, index):
+        length = self.rand.choice((200, 1000, 4000, 20000, 100000))
+        self.sums[index] = self.sums[index - 1] + length
+
+    def make_bundle(self, dummy_graph, dummy_version_table, index_pair):
+        return (self.sums[index_pair[1]] - self.sums[index_pair[0]], None,
+                tuple(index_pair))
+
+    def make_redundant_bundle(self, graph, version_table, last_index):
+        """ Roll up earlier indices as long as the bundle stays in the
+            same number of 32K blocks, like BundleCache does. """
+        earliest_index = last_index - 1
+        bundle = self.make_bundle(graph, version_table,
+                                  (earliest_index, last_index))
+        if (bundle[0] % FREENET_BLOCK_LEN == 0 or
+            bundle[0] > MAX_REDUNDANT_LENGTH):
+            return bundle
+        size_boundry = (bundle[0] // FREENET_BLOCK_LEN + 1) * FREENET_BLOCK_LEN
+        while earliest_index > FIRST_INDEX:
+            next_bundle = self.make_bundle(graph, version_table,
+                                           (earliest_index - 1, last_index))
+            if next_bundle[0] > size_boundry:
+                break
+            bundle = next_bundle
+            earliest_index -= 1
+        return bundle
+
+def make_synthetic_graph(count, rand=None, branch_rate=0.1, merge_rate=0.3,
+                         plan_edges=True):
+    """ Make a graph with count indices the way update() would.
+
+        If plan_edges is False only the rolled up edge for each index
+        and a short cut edge every 16 indices are added instead of
+        asking update() which edges are required, which is much faster.
+
+        Returns (graph, cache, heads) where heads is the list of
+        tip revs. """
+    if rand is None:
+        rand = random.Random(0)
+    graph = UpdateGraph()
+    cache = FakeBundleCache(rand)
+    heads = [NULL_REV]
+    for dummy in range(count):
+        if heads == [NULL_REV]:
+            bases, new_heads = [NULL_REV], [random_rev(rand)]
+        elif len(heads) > 1 and rand.random() < merge_rate:
+            # Merge two heads.
+            bases = rand.sample(heads, 2)
+            new_heads = [random_rev(rand)]
+        elif rand.random() < branch_rate:
+            # Add a second head on top of one of the existing ones.
+            bases = [rand.choice(heads)]
+            new_heads = [random_rev(rand), random_rev(rand)]
+        else:
+            bases = [rand.choice(heads)]
+            new_heads = [random_rev(rand)]
+        heads = [head for head in heads if not head in bases] + new_heads
+        cache.add_index(graph.latest_index + 1)
+        if plan_edges:
+            graph.add_changes(bases, new_heads, None, cache)
+            continue
+        index = graph.add_index(bases, new_heads)
+        for bundle in (cache.make_redundant_bundle(graph, None, index),
+                       cache.make_bundle(graph, None,
+                                         (max(index - 16, FIRST_INDEX),
+                                          index))):
+            if index % 16 == 0 or bundle[2][1] - bundle[2][0] < 16:
+                graph.add_edge(bundle[2], (bundle[0], PENDING_INSERT))
+    return graph, cache, sorted(heads)
+
+def contain_scan(graph, contains_index):
+    """ The linear scan UpdateGraph.contain() used to do. """
+    ret = []
+    for pair in graph.edge_table:
+        if pair[0] >= contains_index:
+            continue
+        if pair[1] < contains_index:
+            continue
+        for index in range(0, len(graph.edge_table[pair]) - 1):
+            ret.append(pair + (index,))
+    return ret
+
+def heads_scan(graph, to_index):
+    """ The linear scan get_heads() used to do. """
+    heads = set([])
+    bases = set([])
+    for index in range(FIRST_INDEX, to_index + 1):
+        bases.update(graph.index_table[index][0])
+        heads.update(graph.index_table[index][1])
+    return tuple(sorted(heads - bases))
+
+def canonical_path_scan(graph, from_index, to_index, max_search_len):
+    """ The depth first search canonical_path_itr() used to do. """
+    returned = set([])
+    min_search_len = -1
+    while min_search_len <= max_search_len:
+        visited = set([])
+        steps = [edges_containing(graph, from_index), ]
+        current_search_len = max_search_len
+        while len(steps) > 0:
+            while len(steps[-1]) > 0:
+                if steps[-1][-1][1] >= to_index:
+                    value = [step[-1] for step in steps]
+                    if min_search_len == -1:
+                        min_search_len = len(steps)
+                    current_search_len = max(len(steps), min_search_len)
+                    tag = str(value)
+                    if not tag in returned:
+                        returned.add(tag)
+                        yield value
+                    steps[-1].pop()
+                elif len(steps) < current_search_len:
+                    tag = str([step[-1] for step in steps])
+                    if not tag in visited:
+                        visited.add(tag)
+                        steps.append(edges_containing(graph,
+                                                      steps[-1][-1][1] + 1))
+                    else:
+                        steps[-1].pop()
+                else:
+                    steps[-1].pop()
+            steps.pop()
+        if min_search_len == -1:
+            return
+        min_search_len += 1
+
+def update_paths_scan(graph, containing_start, to_end, max_len,
+                      partial_path=()):
+    """ The recursion enumerate_update_paths() used to do. """
+    if max_len <= 0:
+        return []
+    ret = []
+    for candidate in graph.contain(containing_start):
+        if candidate[1] >= to_end:
+            ret.append(partial_path + (candidate,))
+        else:
+            ret += update_paths_scan(graph, candidate[1] + 1, to_end,
+                                     max_len - 1, partial_path + (candidate,))
+    return ret
+
+def low_block_cost_edges_scan(graph, known_edges, from_index, allowed):
+    """ What low_block_cost_edges() used to do. """
+    paths = graph.enumerate_update_paths(from_index + 1,
+                                         graph.latest_index, MAX_PATH_LEN - 1)
+    if len(paths) == 0:
+        return []
+    with_cost = []
+    for path in paths:
+        total = 0
+        for step in path:
+            total += block_cost(graph.insert_length(step))
+        with_cost.append((total, path))
+    with_cost.sort()
+    allowed_cost = int(with_cost[0][0] * MAX_COST_RATIO)
+    first_steps = [[value[1][0], ] for value in with_cost if value[0]
+                   <= allowed_cost]
+    first_steps.sort(key=functools.cmp_to_key(graph.cmp_recency))
+    first = []
+    for path in first_steps:
+        step = path[0]
+        if step in known_edges:
+            continue
+        first.append(step)
+        known_edges.add(step)
+        allowed -= 1
+        if allowed <= 0:
+            break
+    return first
+
+# Room for updates in a 1024 byte top key with two graph CHKs.
+TOP_KEY_UPDATES_LEN = 1024 - 1 - BASE_LEN - 2 * CHK_SIZE
+
+def current_top_key_edges(graph):
+    """ Returns the (start, end, chk_count) tuples for the updates
+        get_top_key_updates() makes without max_len. """
+    ret = []
+    for edge in graph.get_top_key_edges():
+        if not edge[:2] in [update[:2] for update in ret]:
+            ret.append(edge[:2] + (len(top_key_chks(graph, edge[:2])), ))
+    return ret
+
+def trim_top_key_edges(graph, top_key_edges, max_len):
+    """ Drops the updates which InsertingGraph.get_top_key_tuple()
+        would leave without a full list of revs to fit max_len. """
+    head_count = len(get_heads(graph))
+    counts = [(len(graph.index_table[update[0] + 1][0]),
+               len(graph.index_table[update[1]][1])) + update[2:]
+              for update in top_key_edges]
+    if len(counts) > 0:
+        counts[0] = counts[0][:1] + (head_count, ) + counts[0][2:]
+    total = sum([top_key_update_len(*count) for count in counts])
+    index = len(top_key_edges)
+    while total > max_len and index > 0:
+        # Cut down to one parent and one head rev.
+        index -= 1
+        total -= (top_key_update_len(*counts[index]) -
+                  top_key_update_len(1, 1, counts[index][2]))
+    # Pulls stop at the first update without all its revs.
+    return top_key_edges[:index]
+
+def add_random_edges(graph, cache, rand, count, max_span=8):
+    """ Add count random, possibly redundant, edges. """
+    for dummy in range(count):
+        start = rand.randint(FIRST_INDEX, graph.latest_index - 1)
+        end = min(start + rand.randint(1, max_span), graph.latest_index)
+        graph.add_edge((start, end), (cache.make_bundle(graph, None,
+                                                        (start, end))[0],
+                                      PENDING_INSERT))
+
+class FakeChangeCtx:
+    def __init__(self, repo, version):
+        self.repo = repo
+        self.version = version
+
+    def node(self):
+        return unhexlify(self.version)
+
+    def children(self):
+        return [FakeChangeCtx(self.repo, child) for child in
+                self.repo.children.get(self.version, ())]
+
+    def parents(self):
+        return [FakeChangeCtx(self.repo, parent) for parent in
+                self.repo.parents.get(self.version, ())]
+
+    def ancestors(self):
+        seen = set([])
+        pending = list(self.repo.parents.get(self.version, ()))
+        while pending:
+            version = pending.pop()
+            if not version in seen:
+                seen.add(version)
+                yield FakeChangeCtx(self.repo, version)
+                pending += self.repo.parents.get(version, ())
+
+class FakeRepo:
+    """ Just enough of a repo for has_version(),
+        get_rollup_bounds() and the version tables. """
+    def __init__(self, versions, children=None, parents=None, path=None):
+        self.versions = set(versions)
+        # version -> child versions
+        self.children = children or {}
+        # version -> parent versions
+        self.parents = parents or {}
+        # Where load_version_table() saves the table.
+        self.path = path
+        self.lookups = 0
+
+    def __getitem__(self, version):
+        self.lookups += 1
+        if not version in self.versions:
+            raise KeyError(version)
+        return FakeChangeCtx(self, version)
+
+def make_repo(graph):
+    """ Returns (repo, version_table) for a synthetic graph, with one
+        changeset for each head in it. """
+    children = {}
+    version_table = {NULL_REV:FIRST_INDEX}
+    for index in range(0, graph.latest_index + 1):
+        bases, heads = graph.index_table[index]
+        for head in heads:
+            version_table[head] = index
+            for base in bases:
+                children.setdefault(base, []).append(head)
+    return FakeRepo(version_table.keys(), children), version_table
+
+def make_history(count, rand, merge_rate=0.05, branch_rate=0.05):
+    """ Returns (versions, parents) for a random history of count
+        changesets. versions is in commit order. """
+    versions = []
+    parents = {}
+    heads = [NULL_REV]
+    for dummy in range(count):
+        version = random_rev(rand)
+        if len(heads) > 1 and rand.random() < merge_rate:
+            parents[version] = rand.sample(heads, 2)
+        elif rand.random() < branch_rate:
+            parents[version] = [rand.choice(versions or [NULL_REV])]
+        else:
+            parents[version] = [rand.choice(heads)]
+        heads = [head for head in heads if not head in parents[version]]
+        heads.append(version)
+        versions.append(version)
+    parents[NULL_REV] = []
+    return versions, parents
+
+def make_history_graph(versions, parents, ends):
+    """ Returns a graph with an index for each of the versions[:end]
+        in ends. """
+    graph = UpdateGraph()
+    heads = set([])
+    start = 0
+    for end in ends:
+        bases = set([])
+        for version in versions[start:end]:
+            for parent in parents[version]:
+                if parent in heads:
+                    heads.remove(parent)
+                    bases.add(parent)
+            heads.add(version)
+        graph.add_index(sorted(bases) or [NULL_REV], sorted(heads))
+        start = end
+    return graph
+
+def version_table_scan(graph, repo):
+    """ What build_version_table() used to do. """
+    table = {NULL_REV:FIRST_INDEX}
+    for index in range(0, graph.latest_index + 1):
+        for head in graph.index_table[index][1]:
+            if not head in table:
+                table[head] = index
+            for ancestor in repo[head].ancestors():
+                version = ancestor.node().hex().encode('utf8')
+                if not version in table:
+                    table[version] = index
+    return table
+
+class IndexTests(unittest.TestCase):
+    def assertIndexed(self, graph):
+        for index in range(FIRST_INDEX, graph.latest_index + 2):
+            self.assertEqual(graph.contain(index),
+                             contain_scan(graph, index))
+            self.assertEqual(graph.edges_from(index),
+                             sorted([pair for pair in graph.edge_table
+                                     if pair[0] == index]))
+            self.assertEqual(graph.edges_to(index),
+                             sorted([pair for pair in graph.edge_table
+                                     if pair[1] == index]))
+            self.assertEqual(graph.edge_table.furthest_end(index),
+                             max([pair[1] for pair in graph.edge_table
+                                  if pair[0] < index] or [None]))
+        for index in range(FIRST_INDEX, graph.latest_index + 1):
+            self.assertEqual(get_heads(graph, index),
+                             heads_scan(graph, index))
+            for head in graph.index_table[index][1]:
+                self.assertEqual(graph.head_index(head), index)
+
+    def test_indexes(self):
+        graph, dummy, heads = make_synthetic_graph(150)
+        graph.rep_invariant()
+        self.assertEqual(get_heads(graph), tuple(heads))
+        self.assertIndexed(graph)
+
+    def test_mutations(self):
+        rand = random.Random(1)
+        graph, cache, heads = make_synthetic_graph(100, rand)
+        self.assertIndexed(graph)
+
+        # Callers may modify what contain() returns.
+        graph.contain(50).pop()
+        self.assertEqual(graph.contain(50), contain_scan(graph, 50))
+
+        # Setting CHKs.
+        for pair, edge_info in list(graph.edge_table.items()):
+            graph.set_chk(pair, 0, edge_info[0], b'CHK@%i,%i' % pair)
+        self.assertIndexed(graph)
+
+        # Adding and removing edges.
+        graph.add_edge((10, 90), (cache.make_bundle(graph, None,
+                                                    (10, 90))[0], b'CHK@'))
+        self.assertIndexed(graph)
+        del graph.edge_table[(10, 90)]
+        graph.edge_table.pop(graph.edges_from(FIRST_INDEX)[0])
+        self.assertIndexed(graph)
+
+        # Overwriting an index.
+        graph.index_table[99] = (graph.index_table[99][0],
+                                  (random_rev(rand),))
+        self.assertIndexed(graph)
+
+        # What graphutil does.
+        for copied in (parse_graph(graph_to_string(graph)), graph.clone()):
+            self.assertEqual(copied.index_table, graph.index_table)
+            self.assertEqual(copied.edge_table, graph.edge_table)
+            self.assertIndexed(copied)
+        # Like coalesce_indices().
+        new_indices = dict(graph.index_table)
+        new_edges = dict([(pair, edge_info) for pair, edge_info
+                          in graph.edge_table.items() if pair[1] < 50])
+        del new_indices[graph.latest_index]
+        graph.index_table.clear()
+        graph.edge_table.clear()
+        graph.index_table.update(new_indices)
+        graph.edge_table.update(new_edges)
+        graph.latest_index -= 1
+        self.assertIndexed(graph)
+
+    def test_latest_index(self):
+        graph, dummy, heads = make_synthetic_graph(200, random.Random(2))
+        repo = FakeRepo(heads)
+        self.assertEqual(latest_index(graph, repo), graph.latest_index)
+        self.assertEqual(repo.lookups, len(heads))
+
+        versions = set([])
+        for index in range(FIRST_INDEX, 101):
+            versions.update(graph.index_table[index][1])
+        repo = FakeRepo(versions)
+        self.assertEqual(latest_index(graph, repo), 100)
+
+class PathTests(unittest.TestCase):
+    def assertSamePaths(self, graph, max_len, limit=200):
+        for to_index in range(0, graph.latest_index + 1):
+            self.assertEqual(
+                list(itertools.islice(canonical_path_itr(graph, 0, to_index,
+                                                         max_len), limit)),
+                list(itertools.islice(canonical_path_scan(graph, 0, to_index,
+                                                          max_len), limit)))
+        for from_index in range(0, graph.latest_index + 1):
+            for length in range(1, 4):
+                self.assertEqual(graph.enumerate_update_paths(
+                    from_index, graph.latest_index, length),
+                                 update_paths_scan(graph, from_index,
+                                                   graph.latest_index,
+                                                   length))
+
+    def test_planned(self):
+        graph = make_synthetic_graph(60, random.Random(3))[0]
+        self.assertSamePaths(graph, MAX_PATH_LEN)
+        self.assertSamePaths(graph, MAX_PATH_LEN + 1)
+
+    def test_random_edges(self):
+        for seed in range(4):
+            rand = random.Random(seed)
+            graph, cache = make_synthetic_graph(40, rand, plan_edges=False)[:2]
+            add_random_edges(graph, cache, rand, 40)
+            self.assertSamePaths(graph, 5)
+
+    def test_no_path(self):
+        graph, cache = make_synthetic_graph(30, random.Random(4),
+                                            plan_edges=False)[:2]
+        for edge in graph.contain(20):
+            graph.edge_table.pop(edge[:2], None)
+        self.assertEqual(list(canonical_path_itr(graph, 0, 25, 5)), [])
+        self.assertEqual(list(canonical_path_scan(graph, 0, 25, 5)), [])
+
+class CostTests(unittest.TestCase):
+    def make_redundant_graph(self, seed, count=40, edge_count=120):
+        rand = random.Random(seed)
+        graph, cache = make_synthetic_graph(count, rand, plan_edges=False)[:2]
+        add_random_edges(graph, cache, rand, edge_count, 6)
+        # Second CHKs for some of them.
+        for edge in rand.sample(sorted(graph.edge_table.keys()), count):
+            graph.edge_table[edge] = graph.edge_table[edge] + (PENDING_INSERT,)
+        return graph
+
+    def test_cheapest_paths(self):
+        graph = self.make_redundant_graph(13)
+        cost_func = lambda step: block_cost(graph.insert_length(step))
+        for from_index in range(0, graph.latest_index + 1, 3):
+            for max_len in (1, 2, 3):
+                expected = [(sum([cost_func(step) for step in path]),
+                             list(path)) for path in
+                            update_paths_scan(graph, from_index,
+                                              graph.latest_index, max_len)]
+                solver = PathSolver(graph, from_index, graph.latest_index,
+                                    cost_func)
+                paths = list(solver.cheapest_paths(max_len))
+                self.assertEqual(sorted(paths), sorted(expected))
+                self.assertEqual([value[0] for value in paths],
+                                 sorted([value[0] for value in expected]))
+                if expected:
+                    self.assertEqual(solver.min_costs(max_len)[
+                        (from_index, max_len)], paths[0][0])
+
+    def test_low_block_cost_edges(self):
+        for seed in range(14, 18):
+            graph = self.make_redundant_graph(seed)
+            for from_index in range(FIRST_INDEX, graph.latest_index):
+                for allowed in (1, 2, 5):
+                    known = set(graph.contain(from_index + 1)[:1])
+                    self.assertEqual(
+                        low_block_cost_edges(graph, known.copy(), from_index,
+                                             allowed),
+                        low_block_cost_edges_scan(graph, known.copy(),
+                                                  from_index, allowed))
+
+    def test_cost_model(self):
+        graph = self.make_redundant_graph(18)
+        model = CostModel(graph)
+        edge = sorted(graph.contain(10))[0]
+        self.assertEqual(model.cost(edge), block_cost(graph.insert_length(edge)))
+        self.assertEqual(model.path_cost([edge, edge]), 2 * model.cost(edge))
+        self.assertEqual((model.hits, model.misses), (3, 1))
+        # Changed edges are costed again.
+        graph.edge_table[edge[:2]] = (100 * FREENET_BLOCK_LEN, ) + \
+                                     graph.edge_table[edge[:2]][1:]
+        self.assertEqual(model.cost(edge), 100)
+        self.assertEqual(model.misses, 2)
+
+        # Shared solvers give the same answers as new ones.
+        for from_index in range(graph.latest_index, FIRST_INDEX, -1):
+            for max_len in (1, 3):
+                self.assertEqual(
+                    model.solver(from_index).first_step_costs(max_len),
+                    PathSolver(graph, from_index, graph.latest_index,
+                               model.cost).first_step_costs(max_len))
+        solver = model.solver(0)
+        self.assertTrue(model.solver(5).costs is solver.costs)
+        graph.add_edge((0, graph.latest_index), (FREENET_BLOCK_LEN,
+                                                 PENDING_INSERT))
+        self.assertFalse(model.solver(5).costs is solver.costs)
+        self.assertTrue((block_cost(FREENET_BLOCK_LEN),
+                         (0, graph.latest_index, 0)) in
+                        model.solver(1).first_step_costs(1))
+
+        self.assertEqual(sum(model.block_histogram().values()),
+                         sum([len(entry) - 1 for entry in
+                              graph.edge_table.values()]))
+        lines = cost_model_report(graph)
+        self.assertTrue(lines[0].startswith('Edges: %i,' %
+                                            len(graph.edge_table)))
+        self.assertRaises(ValueError, make_cost_model, graph, 'bytes')
+
+    def test_cost_funcs(self):
+        graph = self.make_redundant_graph(19)
+        # Expensive fetches mean the fewest fetches.
+        model = CostModel(graph, latency_edge_cost(1000))
+        for from_index in range(0, graph.latest_index):
+            shortest = PathSolver(graph, from_index,
+                                  graph.latest_index).shortest_length(4)
+            if shortest is None:
+                continue
+            path = next(model.solver(from_index).cheapest_paths(4))[1]
+            self.assertEqual(len(path), shortest)
+
+        # Redundant CHKs are cheaper.
+        cost_func = redundancy_edge_cost(0.5)
+        redundant = [edge for edge in graph.edge_table
+                     if len(graph.edge_table[edge]) > 2][0]
+        single = graph.edge_table[redundant][:2]
+        blocks = block_cost(single[0])
+        self.assertEqual(cost_func(graph, redundant + (0, )),
+                         blocks / (1 - .5 ** (len(graph.edge_table[redundant])
+                                              - 1)))
+        graph.edge_table[redundant] = single
+        self.assertEqual(cost_func(graph, redundant + (0, )), blocks / .5)
+
+class CloneTests(unittest.TestCase):
+    def test_cow_dict(self):
+        rand = random.Random(5)
+        first = CowDict()
+        expected = {}
+        for dummy in range(2000):
+            key = rand.randint(0, 500)
+            if key in expected and rand.random() < .3:
+                del first[key]
+                del expected[key]
+            else:
+                first[key] = key * 2
+                expected[key] = key * 2
+        second = first.copy()
+        second_expected = dict(expected)
+        for dummy in range(200):
+            key = rand.randint(0, 600)
+            second[key] = -key
+            second_expected[key] = -key
+            if rand.random() < .5:
+                first[key + 1000] = key
+                expected[key + 1000] = key
+            if key in second_expected and rand.random() < .1:
+                del second[key]
+                del second_expected[key]
+        for table, values in ((first, expected), (second, second_expected)):
+            self.assertEqual(list(table.items()), list(values.items()))
+            self.assertEqual(len(table), len(values))
+            self.assertEqual(table, values)
+
+    def test_clone(self):
+        rand = random.Random(6)
+        graph, cache, heads = make_synthetic_graph(80, rand)
+        text = graph_to_string(graph)
+        cloned = graph.clone()
+        cache.add_index(graph.latest_index + 1)
+        cloned.add_changes([heads[0]], [random_rev(rand)], None, cache)
+        cloned.set_chk(cloned.edges_to(0)[0], 0,
+                       cloned.get_length(cloned.edges_to(0)[0] + (0,)),
+                       b'CHK@cloned')
+        self.assertEqual(graph_to_string(graph), text)
+        self.assertNotEqual(graph_to_string(cloned), text)
+
+        # Changing the original doesn't change the clone.
+        text = graph_to_string(cloned)
+        graph.add_changes([heads[-1]], [random_rev(rand)], None, cache)
+        del graph.edge_table[graph.edges_to(2)[0]]
+        self.assertEqual(graph_to_string(cloned), text)
+
+        for value in (graph, cloned):
+            value.rep_invariant()
+            IndexTests.assertIndexed(self, value)
+
+class MinimalGraphTests(unittest.TestCase):
+    def test_sizer(self):
+        rand = random.Random(7)
+        graph = make_synthetic_graph(150, rand)[0]
+        repo, version_table = make_repo(graph)
+        paths = [[edge, ] for edge in graph.get_top_key_edges()]
+        sizer = GraphSizer(graph, repo, version_table)
+        for path in paths:
+            sizer.add_edge(path[0])
+        for edge in itertools.islice(important_edge_itr(graph, list(paths)),
+                                     60):
+            paths.append([edge, ])
+            sizer.add_edge(edge)
+            self.assertEqual(sizer.total(), len(graph_to_string(
+                subgraph(graph, repo, version_table, paths))))
+
+    def test_important_edges(self):
+        rand = random.Random(9)
+        graph, cache = make_synthetic_graph(60, rand, plan_edges=False)[:2]
+        add_random_edges(graph, cache, rand, 60, 24)
+        graph.add_edge((FIRST_INDEX, graph.latest_index),
+                       (cache.make_bundle(graph, None,
+                                          (FIRST_INDEX,
+                                           graph.latest_index))[0],
+                        PENDING_INSERT))
+        expected = []
+        known_edges = set([])
+        for index in [graph.latest_index, ] + list(range(graph.latest_index
+                                                         - 1, FIRST_INDEX,
+                                                         -1)):
+            for path in canonical_path_itr(graph, 0, index, MAX_PATH_LEN):
+                for edge in path:
+                    if not edge in known_edges:
+                        known_edges.add(edge)
+                        expected.append(edge)
+        self.assertEqual(list(important_edge_itr(graph, [])), expected)
+
+    def test_same_as_formatted(self):
+        rand = random.Random(8)
+        graph = make_synthetic_graph(150, rand)[0]
+        repo, version_table = make_repo(graph)
+        for max_size in (2048, 4096, 8192, 16 * 1024, 32 * 1024):
+            text = graph_to_string(minimal_graph(graph, repo, version_table,
+                                                 max_size))
+            self.assertTrue(len(text) <= max_size)
+            # Any other formatter uses the old code.
+            self.assertEqual(text, graph_to_string(
+                minimal_graph(graph, repo, version_table, max_size,
+                              lambda value: graph_to_string(value))))
+
+class VersionTableTests(unittest.TestCase):
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp(prefix='version_table_')
+        versions, parents = make_history(300, random.Random(12))
+        self.versions = versions
+        self.repo = FakeRepo(versions + [NULL_REV], None, parents,
+                             self.repo_dir.encode('utf8'))
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_dir)
+
+    def assertSameTable(self, graph):
+        self.repo.lookups = 0
+        table = load_version_table(graph, self.repo)
+        lookups = self.repo.lookups
+        expected = version_table_scan(graph, self.repo)
+        self.assertEqual(table, expected)
+        self.assertEqual(build_version_table(graph, self.repo), expected)
+        return lookups
+
+    def test_extend(self):
+        ends = list(range(10, 301, 10))
+        self.assertSameTable(make_history_graph(self.versions,
+                                                self.repo.parents, ends[:15]))
+        for count in range(16, len(ends) + 1):
+            lookups = self.assertSameTable(make_history_graph(
+                self.versions, self.repo.parents, ends[:count]))
+            # Only the 10 new changesets and the shared index check.
+            self.assertTrue(lookups <= 11)
+        # Nothing new.
+        self.assertTrue(self.assertSameTable(make_history_graph(
+            self.versions, self.repo.parents, ends)) <= 1)
+
+    def test_changed_indices(self):
+        self.assertSameTable(make_history_graph(self.versions,
+                                                self.repo.parents,
+                                                range(10, 301, 10)))
+        # Like minimal_graph() coalescing indices.
+        self.assertSameTable(make_history_graph(self.versions,
+                                                self.repo.parents,
+                                                list(range(10, 150, 10))
+                                                + list(range(180, 301, 20))))
+        # Fewer indices.
+        self.assertSameTable(make_history_graph(self.versions,
+                                                self.repo.parents,
+                                                range(10, 100, 10)))
+
+    def test_bad_file(self):
+        graph = make_history_graph(self.versions, self.repo.parents,
+                                   range(10, 301, 10))
+        file_name = os.path.join(self.repo_dir.encode('utf8'),
+                                 VERSION_TABLE_FILE)
+        self.assertSameTable(graph)
+        in_file = open(file_name, 'rb')
+        data = in_file.read()
+        in_file.close()
+        for bad in (b'', data[:40], data[:-1], b'x' + data[1:]):
+            out_file = open(file_name, 'wb')
+            out_file.write(bad)
+            out_file.close()
+            self.assertSameTable(graph)
+
+class InvariantTests(unittest.TestCase):
+    def assertDetected(self, graph, modes, repo=None):
+        for mode in (INVARIANT_STRUCTURAL, INVARIANT_INCREMENTAL,
+                     INVARIANT_FULL):
+            if mode in modes:
+                self.assertRaises(AssertionError, graph.clone().rep_invariant,
+                                  repo, False, mode)
+            elif repo is None or mode != INVARIANT_FULL:
+                graph.clone().rep_invariant(repo, False, mode)
+
+    def test_modes(self):
+        graph = make_synthetic_graph(100, random.Random(19))[0]
+        graph.rep_invariant(None, True, INVARIANT_INCREMENTAL)
+        self.assertEqual((graph.index_table.touched, graph.edge_table.touched),
+                         (set([]), set([])))
+        latest = graph.latest_index
+        all_modes = (INVARIANT_STRUCTURAL, INVARIANT_INCREMENTAL,
+                     INVARIANT_FULL)
+
+        broken = graph.clone()
+        broken.index_table[40] = (graph.index_table[40][0], ())
+        self.assertDetected(broken, all_modes[1:])
+
+        broken = graph.clone()
+        broken.add_edge((50, latest + 2), (1000, PENDING_INSERT))
+        self.assertDetected(broken, all_modes[1:])
+        broken = graph.clone()
+        broken.add_edge((50, 50), (1000, PENDING_INSERT))
+        self.assertDetected(broken, all_modes[1:])
+
+        # Missing index in the middle.
+        broken = graph.clone()
+        del broken.index_table[30]
+        self.assertDetected(broken, all_modes)
+
+        # Dropped the latest index, but not the edges to it.
+        broken = graph.clone()
+        del broken.index_table[latest]
+        broken.latest_index -= 1
+        self.assertDetected(broken, all_modes[1:])
+
+        # Only the clone changed.
+        graph.rep_invariant(None, True, INVARIANT_INCREMENTAL)
+        # Structural checks leave the changes to check later.
+        broken = graph.clone()
+        broken.index_table[40] = (graph.index_table[40][0], ())
+        broken.rep_invariant(None, True, INVARIANT_STRUCTURAL)
+        self.assertRaises(AssertionError, broken.rep_invariant)
+
+    def test_repo(self):
+        graph = make_synthetic_graph(60, random.Random(20))[0]
+        repo = make_repo(graph)[0]
+        graph.rep_invariant(repo, False, INVARIANT_INCREMENTAL)
+        graph.add_index([graph.index_table[graph.latest_index][1][0]],
+                        [random_rev(random.Random(21))])
+        self.assertDetected(graph, (INVARIANT_INCREMENTAL, ), repo)
+        repo.versions.add(graph.index_table[graph.latest_index][1][0])
+        graph.rep_invariant(repo, False, INVARIANT_INCREMENTAL)
+
+        # The same head in two indices.
+        graph.add_index([graph.index_table[graph.latest_index][1][0]],
+                        list(graph.index_table[5][1]))
+        self.assertDetected(graph, (INVARIANT_INCREMENTAL, ), repo)
+
+class TopKeyTests(unittest.TestCase):
+    def test_pack(self):
+        for branch_rate in (0.1, 0.6):
+            rand = random.Random(23)
+            graph = make_synthetic_graph(80, rand, branch_rate, 0.1)[0]
+            set_random_chks(graph, rand)
+            value, packed = pack_top_key_edges(graph, TOP_KEY_UPDATES_LEN)
+            self.assertEqual(packed[0][1], graph.latest_index)
+            for index, update in enumerate(packed):
+                self.assertTrue(0 < update[2] <= len(top_key_chks(
+                    graph, update[:2])))
+                if index > 0:
+                    # Each update leads to the one before.
+                    self.assertTrue(update[0] < packed[index - 1][0] <=
+                                    update[1])
+
+            # It fits when serialized.
+            heads = get_heads(graph)
+            updates = [(graph.get_length(update[:2]),
+                        tuple([random_rev(rand) for dummy in
+                               graph.index_table[update[0] + 1][0]]),
+                        tuple([random_rev(rand) for dummy in
+                               graph.index_table[update[1]][1]]),
+                        tuple(top_key_chks(graph, update[:2])[:update[2]]),
+                        True, True) for update in packed]
+            updates[0] = updates[0][:2] + (heads, ) + updates[0][3:]
+            self.assertTrue(len(top_key_tuple_to_bytes(
+                ((random_chk(rand), random_chk(rand)), updates))) < 1024)
+
+            # Never worse than the current choice.
+            self.assertAlmostEqual(simulate_pulls(graph, packed)[1], value)
+            current = trim_top_key_edges(graph, current_top_key_edges(graph),
+                                         TOP_KEY_UPDATES_LEN)
+            self.assertTrue(value >= simulate_pulls(graph, current)[1] - 1e-9)
+
+    def test_simulate(self):
+        graph = make_synthetic_graph(40, random.Random(24))[0]
+        weights = pull_weights(graph)
+        self.assertAlmostEqual(sum(weights.values()), 1.0)
+        steps = graph_pull_steps(graph, weights)
+        without = sum([weight * (2 + steps[index])
+                       for index, weight in weights.items()])
+        self.assertAlmostEqual(simulate_pulls(graph, [])[0], without)
+        self.assertEqual(simulate_pulls(graph, [])[1], 0.0)
+
+        # Everyone can pull everything in one fetch.
+        latest = graph.latest_index
+        round_trips, saved = simulate_pulls(graph, [(FIRST_INDEX, latest, 2)],
+                                            weights, 0.0)
+        self.assertAlmostEqual(round_trips, 2.0)
+        self.assertAlmostEqual(saved, without - 2.0)
+        # Half the time it fails.
+        self.assertAlmostEqual(simulate_pulls(graph,
+                                              [(FIRST_INDEX, latest, 1)],
+                                              weights, 0.5)[1],
+                               (without - 2.0) / 2)
+        # Nobody behind the start.
+        self.assertTrue(simulate_pulls(graph, [(latest - 1, latest, 1)])[1] <
+                        saved)
+
+class CodecTests(unittest.TestCase):
+    def assertSameGraph(self, graph, parsed):
+        self.assertEqual(parsed.latest_index, graph.latest_index)
+        self.assertEqual(dict(parsed.index_table.items()),
+                         dict(graph.index_table.items()))
+        self.assertEqual(dict(parsed.edge_table.items()),
+                         dict(graph.edge_table.items()))
+
+    def test_round_trip(self):
+        rand = random.Random(10)
+        graph = make_synthetic_graph(200, rand)[0]
+        # Pending and odd CHKs go into the table as is.
+        set_random_chks(graph, rand)
+        edge = sorted(graph.edge_table.keys())[1]
+        graph.edge_table[edge] = (graph.edge_table[edge][0], PENDING_INSERT,
+                                  b'CHK@padded==,key,AAIC--8',
+                                  b'CHK@abcdeQ,AAAA,A')
+        data = graph_to_binary(graph)
+        self.assertSameGraph(graph, parse_binary_graph(data))
+        self.assertEqual(graph_to_binary(parse_binary_graph(data)), data)
+        self.assertTrue(len(data) < len(graph_to_string(graph)))
+
+        # Both formats, with the header InsertingGraph adds.
+        self.assertSameGraph(graph, parse_graph_data(b'#A\n' + data))
+        self.assertSameGraph(graph, parse_graph_data(
+            b'#B\n' + graph_to_string(graph)))
+
+        empty = UpdateGraph()
+        self.assertSameGraph(empty, parse_graph_data(graph_to_binary(empty)))
+
+    def test_bad_data(self):
+        graph = make_synthetic_graph(20, random.Random(11))[0]
+        data = graph_to_binary(graph)
+        for bad in (data[:-1], data + b'\x00', data[:4] + b'\x02' + data[5:],
+                    b'\x89IGX' + data[4:]):
+            self.assertRaises(ValueError, parse_binary_graph, bad)
+
+def time_secs(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+def benchmark_indexes(counts=(1000, 4000, 16000)):
+    """ Print how long contain() and get_heads() take for every index
+        of large synthetic graphs, against the old linear scans. """
+    for count in counts:
+        start = time.time()
+        graph, dummy, heads = make_synthetic_graph(count, plan_edges=False)
+        print("%i indices, %i edges: built in %.2fs" %
+              (count, len(graph.edge_table), time.time() - start))
+        samples = random.Random(0).sample(range(FIRST_INDEX,
+                                                graph.latest_index + 1), 200)
+
+        def run(func):
+            for index in samples:
+                func(graph, index)
+
+        for label, indexed, scanned in (('contain', UpdateGraph.contain,
+                                         contain_scan),
+                                        ('get_heads', get_heads, heads_scan)):
+            cold = time_secs(run, indexed)
+            warm = time_secs(run, indexed)
+            print("   %s: %.1fus first, %.1fus cached, %.1fus scanned" %
+                  (label, cold * 1e6 / len(samples),
+                   warm * 1e6 / len(samples),
+                   time_secs(run, scanned) * 1e6 / len(samples)))
+        print("   latest_index: %.2fms" %
+              (time_secs(latest_index, graph, FakeRepo(heads)) * 1e3))
+
+def benchmark_paths(counts=(250, 1000, 4000)):
+    """ Print how long building graphs with update() and finding
+        canonical paths take, against the old depth first search. """
+    def first_paths(itr_func, graph, max_len, count=20):
+        for to_index in range(graph.latest_index - 9, graph.latest_index + 1):
+            list(itertools.islice(itr_func(graph, 0, to_index, max_len),
+                                  count))
+
+    for count in counts:
+        start = time.time()
+        graph = make_synthetic_graph(count)[0]
+        print("%i indices, %i edges: built in %.2fs" %
+              (count, len(graph.edge_table), time.time() - start))
+        for max_len in (MAX_PATH_LEN, MAX_PATH_LEN + 1):
+            print("   20 paths to the last 10 indices, max length %i: "
+                  "%.2fms solver, %.2fms scanned" %
+                  (max_len,
+                   time_secs(first_paths, canonical_path_itr, graph,
+                             max_len) * 1e3,
+                   time_secs(first_paths, canonical_path_scan, graph,
+                             max_len) * 1e3))
+
+def benchmark_costs(counts=(100, 400), edge_counts=(300, 700)):
+    """ Print how long low_block_cost_edges() and getting the 10
+        cheapest paths take on graphs with many redundant edges,
+        against enumerating and sorting every path. """
+    for count in counts:
+        for edge_count in edge_counts:
+            rand = random.Random(0)
+            graph, cache = make_synthetic_graph(count, rand,
+                                                plan_edges=False)[:2]
+            add_random_edges(graph, cache, rand, edge_count, 16)
+            from_indices = range(count - 40, count - 1)
+            cost_func = lambda step: block_cost(graph.insert_length(step))
+
+            def all_cheap_edges(func):
+                for from_index in from_indices:
+                    func(graph, set([]), from_index, 2)
+
+            def top_paths():
+                for from_index in from_indices:
+                    solver = PathSolver(graph, from_index, graph.latest_index,
+                                        cost_func)
+                    list(itertools.islice(solver.cheapest_paths(3), 10))
+
+            def sorted_paths():
+                for from_index in from_indices:
+                    sorted([(sum([cost_func(step) for step in path]), path)
+                            for path in graph.enumerate_update_paths(
+                                from_index, graph.latest_index,
+                                3)])[:10]
+
+            print("%i indices, %i edges:" % (count, len(graph.edge_table)))
+            print("   low_block_cost_edges: %.3fs, scanned %.3fs" %
+                  (time_secs(all_cheap_edges, low_block_cost_edges),
+                   time_secs(all_cheap_edges, low_block_cost_edges_scan)))
+            print("   10 cheapest paths: %.3fs, sorted %.3fs" %
+                  (time_secs(top_paths), time_secs(sorted_paths)))
+
+def benchmark_cost_model(counts=(1000, 4000), edge_counts=(2000, 8000)):
+    """ Print how long planning the next fetches after each bundle of
+        a pull takes with a new CostModel each time and with one
+        CostModel for the whole pull. """
+    for count, edge_count in zip(counts, edge_counts):
+        rand = random.Random(0)
+        graph, cache = make_synthetic_graph(count, rand,
+                                            plan_edges=False)[:2]
+        add_random_edges(graph, cache, rand, edge_count, 16)
+        # A pull from 200 indices back, one index at a time.
+        from_indices = range(count - 200, count - 1)
+
+        def plan(model):
+            for from_index in from_indices:
+                get_update_edges(graph, from_index, 4, False, set([]),
+                                 model or CostModel(graph))
+
+        print("%i indices, %i edges:" % (count, len(graph.edge_table)))
+        print("   new CostModel per fetch: %.3fs" % time_secs(plan, None))
+        for name in ('blocks', 'latency', 'redundancy'):
+            print("   shared %s CostModel: %.3fs" %
+                  (name, time_secs(plan, make_cost_model(graph, name))))
+
+def benchmark_invariants(counts=(1000, 16000)):
+    """ Print how long each rep_invariant() mode takes after adding
+        an index, with and without a repo. """
+    for count in counts:
+        graph, cache = make_synthetic_graph(count, plan_edges=False)[:2]
+        repo = make_repo(graph)[0]
+        rand = random.Random(0)
+        # Only count the changes below.
+        graph.rep_invariant()
+        print("%i indices, %i edges:" % (count, len(graph.edge_table)))
+        for mode, name in ((INVARIANT_STRUCTURAL, 'structural'),
+                           (INVARIANT_INCREMENTAL, 'incremental'),
+                           (INVARIANT_FULL, 'full')):
+            for with_repo in (None, repo):
+                if mode == INVARIANT_FULL and not with_repo is None:
+                    # Needs a real repo.
+                    continue
+                head = random_rev(rand)
+                repo.versions.add(head)
+                graph.add_index([graph.index_table[graph.latest_index][1][0]],
+                                [head])
+                graph.add_edge((graph.latest_index - 1, graph.latest_index),
+                               (1000, PENDING_INSERT))
+                print("   %s%s: %.3fms" % (name, ('', ' with repo')
+                                           [with_repo is repo],
+                                           time_secs(graph.rep_invariant,
+                                                     with_repo, False, mode)
+                                           * 1e3))
+
+def benchmark_clones(counts=(1000, 4000, 16000), cycles=20):
+    """ Print the time and memory used by cycles of cloning a graph
+        and adding an index to the clone, like a push does. Compares
+        against a deepcopy of the same graph with plain dict tables,
+        which is what clone() used to do. """
+    def add_index(graph, cache, rand):
+        cache.add_index(graph.latest_index + 1)
+        index = graph.add_index([get_heads(graph)[0]], [random_rev(rand)])
+        bundle = cache.make_redundant_bundle(graph, None, index)
+        graph.add_edge(bundle[2], (bundle[0], PENDING_INSERT))
+
+    def measure(func, *args):
+        tracemalloc.start()
+        start = time.time()
+        for dummy in range(cycles):
+            func(*args)
+        elapsed = time.time() - start
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return elapsed * 1e3 / cycles, used / 1024.0 / cycles
+
+    for count in counts:
+        graph, cache = make_synthetic_graph(count, plan_edges=False)[:2]
+        # Pushing looks at the heads before cloning.
+        get_heads(graph)
+        print("%i indices, %i edges:" % (count, len(graph.edge_table)))
+
+        rand = random.Random(0)
+        clones = []
+        def clone_and_add():
+            cloned = graph.clone()
+            add_index(cloned, cache, rand)
+            clones.append(cloned)
+        print("   clone() + add_index(): %.2fms, %.1fK" %
+              measure(clone_and_add))
+
+        plain = copy.copy(graph)
+        plain.index_table = dict(graph.index_table.items())
+        plain.edge_table = dict(graph.edge_table.items())
+        copies = []
+        print("   deepcopy with dict tables: %.2fms, %.1fK" %
+              measure(lambda: copies.append(copy.deepcopy(plain))))
+
+def benchmark_minimal_graph(counts=(1000, 10000), sizes=(8 * 1024, 31 * 1024)):
+    """ Print how long minimal_graph() takes with the size accounting
+        and when it formats every candidate subgraph. """
+    for count in counts:
+        graph, cache = make_synthetic_graph(count, plan_edges=False)[:2]
+        # A full rollup so that there is a short canonical path.
+        graph.add_edge((FIRST_INDEX, graph.latest_index),
+                       (cache.make_bundle(graph, None,
+                                          (FIRST_INDEX,
+                                           graph.latest_index))[0],
+                        PENDING_INSERT))
+        repo, version_table = make_repo(graph)
+        print("%i indices, %i edges, %i bytes:" %
+              (count, len(graph.edge_table), len(graph_to_string(graph))))
+        for max_size in sizes:
+            sized = time_secs(minimal_graph, graph, repo, version_table,
+                              max_size)
+            formatted = time_secs(minimal_graph, graph, repo, version_table,
+                                  max_size, lambda value:
+                                  graph_to_string(value))
+            print("   max %iK: %.2fs sized, %.2fs formatted" %
+                  (max_size // 1024, sized, formatted))
+
+def benchmark_codec(counts=(150, 1000, 10000)):
+    """ Print the sizes of the text and binary formats and how long
+        it takes to parse them. """
+    for count in counts:
+        rand = random.Random(0)
+        graph = make_synthetic_graph(count, rand, plan_edges=count <= 1000)[0]
+        set_random_chks(graph, rand)
+        text = graph_to_string(graph)
+        data = graph_to_binary(graph)
+        text_secs = min([time_secs(parse_graph, text)
+                         for dummy in range(5)])
+        binary_secs = min([time_secs(parse_binary_graph, data)
+                           for dummy in range(5)])
+        print(("%i indices, %i edges: text %i bytes %.3fs, "
+               + "binary %i bytes %.3fs (%i%% smaller)") %
+              (count, len(graph.edge_table), len(text), text_secs,
+               len(data), binary_secs, 100 - 100 * len(data) // len(text)))
+
+def benchmark_top_key(counts=(100, 1000), branch_rates=(0.1, 0.6)):
+    """ Print the simulated FCP round trips per pull for the current
+        top key updates and the ones pack_top_key_edges() chooses. """
+    for count in counts:
+        for branch_rate in branch_rates:
+            rand = random.Random(0)
+            graph = make_synthetic_graph(count, rand, branch_rate, 0.1)[0]
+            set_random_chks(graph, rand)
+            start = time.time()
+            packed = pack_top_key_edges(graph, TOP_KEY_UPDATES_LEN)[1]
+            secs = time.time() - start
+            current = current_top_key_edges(graph)
+            trimmed = trim_top_key_edges(graph, current, TOP_KEY_UPDATES_LEN)
+            print("%i indices, %i heads:" % (count, len(get_heads(graph))))
+            for name, edges in (('current', trimmed), ('packed', packed)):
+                round_trips, saved = simulate_pulls(graph, edges)
+                print("   %s: %i of %i updates usable, %.3f round trips, "
+                      "%.3f saved" % (name, len(edges),
+                                      len((current, packed)
+                                          [name == 'packed']),
+                                      round_trips, saved))
+            print("   packed in %.3fs" % secs)
+
+def benchmark_version_tables(count=100000, index_size=50):
+    """ Print how long it takes to build the version table for a
+        repo with count changesets from scratch, and to extend it
+        after adding one index. """
+    versions, parents = make_history(count, random.Random(0))
+    repo_dir = tempfile.mkdtemp(prefix='version_table_bench_')
+    try:
+        repo = FakeRepo(versions + [NULL_REV], None, parents,
+                        repo_dir.encode('utf8'))
+        ends = list(range(index_size, count + 1, index_size))
+        graph = make_history_graph(versions, parents, ends[:-1])
+        print("%i changesets, %i indices:" % (count, len(ends)))
+        if count <= 20000:
+            print("   ancestor scan: %.2fs" %
+                  time_secs(version_table_scan, graph, repo))
+        print("   build: %.2fs" % time_secs(build_version_table, graph, repo))
+        print("   first load: %.2fs" % time_secs(load_version_table, graph,
+                                                repo))
+        graph = make_history_graph(versions, parents, ends)
+        print("   load after adding an index: %.2fs" %
+              time_secs(load_version_table, graph, repo))
+    finally:
+        shutil.rmtree(repo_dir)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark':
+        benchmark_indexes()
+        benchmark_paths()
+        benchmark_costs()
+        benchmark_cost_model()
+        benchmark_clones()
+        benchmark_invariants()
+        benchmark_minimal_graph()
+        benchmark_codec()
+        benchmark_top_key()
+        benchmark_version_tables(20000)
+        benchmark_version_tables()
+    else:
+        unittest.main()
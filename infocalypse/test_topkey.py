@@ -20,32 +20,45 @@
 """
 
 
+import random
+import struct
+import sys
+import time
+
+from binascii import hexlify, unhexlify
+
+from .chk import CHK_SIZE, bytes_to_chk, chk_to_bytes, freenet_base64_encode
 from .topkey import top_key_tuple_to_bytes, bytes_to_top_key_tuple, \
-     dump_top_key_tuple
-
-BAD_CHK1 = ('CHK@badroutingkey155JblbGup0yNSpoDJgVPnL8E5WXoc,'
-            +'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
-BAD_CHK2 = ('CHK@badroutingkey255JblbGup0yNSpoDJgVPnL8E5WXoc,'
-            +'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
-BAD_CHK3 = ('CHK@badroutingkey355JblbGup0yNSpoDJgVPnL8E5WXoc,'
-            +'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
-BAD_CHK4 = ('CHK@badroutingkey455JblbGup0yNSpoDJgVPnL8E5WXoc,'
-            +'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
-BAD_CHK5 = ('CHK@badroutingkey555JblbGup0yNSpoDJgVPnL8E5WXoc,'
-            +'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
-BAD_CHK6 = ('CHK@badroutingkey655JblbGup0yNSpoDJgVPnL8E5WXoc,'
-            +'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
-BAD_CHK7 = ('CHK@badroutingkey755JblbGup0yNSpoDJgVPnL8E5WXoc,'
-            +'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
+     dump_top_key_tuple, pack_top_key_tuple, top_key_tuple_len, \
+     BASE_FMT, BASE_LEN, BASE_UPDATE_FMT, BASE_UPDATE_LEN, HAS_PARENTS, \
+     HAS_HEADS, HDR_BYTES, HGVER_SIZE
+
+# The largest top key that fits in an SSK. See updatesm.MAX_SSK_LEN.
+MAX_TOP_KEY_LEN = 1023
+
+BAD_CHK1 = (b'CHK@badroutingkey155JblbGup0yNSpoDJgVPnL8E5WXoc,'
+            + b'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
+BAD_CHK2 = (b'CHK@badroutingkey255JblbGup0yNSpoDJgVPnL8E5WXoc,'
+            + b'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
+BAD_CHK3 = (b'CHK@badroutingkey355JblbGup0yNSpoDJgVPnL8E5WXoc,'
+            + b'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
+BAD_CHK4 = (b'CHK@badroutingkey455JblbGup0yNSpoDJgVPnL8E5WXoc,'
+            + b'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
+BAD_CHK5 = (b'CHK@badroutingkey555JblbGup0yNSpoDJgVPnL8E5WXoc,'
+            + b'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
+BAD_CHK6 = (b'CHK@badroutingkey655JblbGup0yNSpoDJgVPnL8E5WXoc,'
+            + b'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
+BAD_CHK7 = (b'CHK@badroutingkey755JblbGup0yNSpoDJgVPnL8E5WXoc,'
+            + b'KZ6azHOwEm4ga6dLy6UfbdSzVhJEz3OvIbSS4o5BMKU,AAIC--8')
 
 TOP = ((BAD_CHK6,),
-       ((10, ('0' * 40, '1' * 40, '2' * 40), ('a' * 40, 'b' * 40,),
+       ((10, (b'0' * 40, b'1' * 40, b'2' * 40), (b'a' * 40, b'b' * 40,),
         (BAD_CHK1,), True, True),
-       (20, ('3' * 40,), ('c' * 40,),
+       (20, (b'3' * 40,), (b'c' * 40,),
         (BAD_CHK2,), False, True),
-       (30, ('3' * 40,), ('d' * 40,),
+       (30, (b'3' * 40,), (b'd' * 40,),
          (BAD_CHK3, BAD_CHK4), True, False),
-       (40, ('2' * 40,), ('e' * 40,),
+       (40, (b'2' * 40,), (b'e' * 40,),
         (BAD_CHK5,), False, False),
        ))
 
@@ -63,7 +76,163 @@ def smoke_test_topkey():
     assert bytes_to_top_key_tuple(bytes0)[0] == TOP
     assert bytes_to_top_key_tuple(bytes1)[0] == TOP
 
-    dump_top_key_tuple(TOP)
+    dump_top_key_tuple(TOP, lambda text: None)
+
+# The += and slicing codec topkey used before it packed into a
+# bytearray and read from a memoryview.
+def reference_to_bytes(top_key_tuple, salt_byte=0):
+    ret = struct.pack(BASE_FMT, HDR_BYTES, salt_byte,
+                      len(top_key_tuple[0]), len(top_key_tuple[1]))
+    for graph_chk in top_key_tuple[0]:
+        ret += chk_to_bytes(graph_chk)
+    for update in top_key_tuple[1]:
+        flags = (((int(update[4]) * 0xff) & HAS_PARENTS)
+                 | ((int(update[5]) * 0xff) & HAS_HEADS))
+        ret += struct.pack(BASE_UPDATE_FMT, update[0], flags,
+                           len(update[1]), len(update[2]), len(update[3]))
+        for version in update[1] + update[2]:
+            ret += unhexlify(version)
+        for chk in update[3]:
+            ret += chk_to_bytes(chk)
+    return ret
+
+def reference_versions(version_bytes):
+    return tuple([hexlify(version_bytes[count * HGVER_SIZE:
+                                        (count + 1) * HGVER_SIZE])
+                  for count in range(0, len(version_bytes) // HGVER_SIZE)])
+
+def reference_update(bytes):
+    length, flags, parent_count, head_count, chk_count = struct.unpack(
+        BASE_UPDATE_FMT, bytes[:BASE_UPDATE_LEN])
+    bytes = bytes[BASE_UPDATE_LEN:]
+    parents = reference_versions(bytes[:HGVER_SIZE * parent_count])
+    bytes = bytes[HGVER_SIZE * parent_count:]
+    heads = reference_versions(bytes[:HGVER_SIZE * head_count])
+    bytes = bytes[HGVER_SIZE * head_count:]
+    chks = []
+    for dummy in range(0, chk_count):
+        chks.append(bytes_to_chk(bytes[:CHK_SIZE]))
+        bytes = bytes[CHK_SIZE:]
+    return ((length, parents, heads, tuple(chks),
+             bool(flags & HAS_PARENTS), bool(flags & HAS_HEADS)),
+            bytes)
+
+def reference_from_bytes(bytes):
+    hdr, salt, graph_chk_count, update_count = struct.unpack(BASE_FMT,
+                                                             bytes[:BASE_LEN])
+    bytes = bytes[BASE_LEN:]
+    graph_chks = []
+    for dummy in range(0, graph_chk_count):
+        graph_chks.append(bytes_to_chk(bytes[:CHK_SIZE]))
+        bytes = bytes[CHK_SIZE:]
+    updates = []
+    for dummy in range(0, update_count):
+        update, bytes = reference_update(bytes)
+        updates.append(update)
+    return ((tuple(graph_chks), tuple(updates)), hdr, salt)
+
+def random_rev(rand):
+    return b'%040x' % rand.getrandbits(160)
+
+def random_chk(rand):
+    """ Returns a CHK with random keys like the ones the node returns. """
+    return (b'CHK@' + freenet_base64_encode(rand.randbytes(32)) + b','
+            + freenet_base64_encode(rand.randbytes(32)) + b','
+            + freenet_base64_encode(rand.randbytes(5)))
+
+def random_update(rand, max_revs, max_chks):
+    return (rand.randrange(-2**63, 2**63),
+            tuple([random_rev(rand)
+                   for dummy in range(rand.randint(0, max_revs))]),
+            tuple([random_rev(rand)
+                   for dummy in range(rand.randint(0, max_revs))]),
+            tuple([random_chk(rand)
+                   for dummy in range(rand.randint(0, max_chks))]),
+            rand.random() < .5, rand.random() < .5)
+
+def random_top_key(rand):
+    return (tuple([random_chk(rand) for dummy in range(rand.randint(1, 3))]),
+            tuple([random_update(rand, 5, 3)
+                   for dummy in range(rand.randint(0, 8))]))
+
+def fuzz_test_topkey(count=2000, seed=0):
+    """ Check the codec against the reference one on random top keys. """
+    rand = random.Random(seed)
+    for dummy in range(count):
+        top = random_top_key(rand)
+        salt = rand.randint(0, 255)
+        raw = top_key_tuple_to_bytes(top, salt)
+        assert raw == reference_to_bytes(top, salt)
+        assert len(raw) == top_key_tuple_len(top)
+        assert bytes_to_top_key_tuple(raw) == (top, HDR_BYTES, salt)
+        assert reference_from_bytes(raw) == (top, HDR_BYTES, salt)
+
+        # Packing into the middle of a bigger buffer.
+        buf = bytearray(b'x' * (len(raw) + 10))
+        assert pack_top_key_tuple(buf, 5, top, salt) == len(raw) + 5
+        assert buf == b'x' * 5 + raw + b'x' * 5
+
+        # Truncated data.
+        if len(raw) > BASE_LEN:
+            try:
+                bytes_to_top_key_tuple(raw[:rand.randint(BASE_LEN,
+                                                         len(raw) - 1)])
+                assert False
+            except ValueError:
+                pass
+
+def max_top_key(rand, max_len, max_revs):
+    """ Returns a top key with updates with up to max_revs parent and
+        head revs which is as close to max_len bytes as it can get. """
+    graph_chks = (random_chk(rand), random_chk(rand))
+    updates = []
+    while True:
+        if len(updates) == 255: # The most the format allows.
+            return (graph_chks, tuple(updates))
+        update = random_update(rand, max_revs, 2)
+        if top_key_tuple_len((graph_chks, updates + [update, ])) > max_len:
+            if len(updates) > 0:
+                return (graph_chks, tuple(updates))
+            continue
+        updates.append(update)
+
+def best_secs(func, arg, count, repeats=3):
+    """ Returns the least average time func(arg) took over repeats
+        runs of count calls. """
+    best = None
+    for dummy in range(repeats):
+        start = time.time()
+        for dummy in range(count):
+            func(arg)
+        secs = (time.time() - start) / count
+        if best is None or secs < best:
+            best = secs
+    return best
+
+def benchmark_topkey(runs=2000):
+    """ Time encoding and decoding big top keys with the codec and the
+        reference one. """
+    rand = random.Random(0)
+    for label, top in (('ssk', max_top_key(rand, MAX_TOP_KEY_LEN, 2)),
+                       ('32K', max_top_key(rand, 32 * 1024, 16)),
+                       ('max', max_top_key(rand, 1024 * 1024, 64))):
+        raw = top_key_tuple_to_bytes(top)
+        count = max(10, runs * MAX_TOP_KEY_LEN // len(raw))
+        times = []
+        for encode, decode in ((reference_to_bytes, reference_from_bytes),
+                               (top_key_tuple_to_bytes,
+                                bytes_to_top_key_tuple)):
+            times.append((best_secs(encode, top, count),
+                          best_secs(decode, raw, count)))
+        print("%-4s %8i bytes, %3i updates: encode %9.1f -> %9.1f usec, "
+              "decode %9.1f -> %9.1f usec" %
+              (label, len(raw), len(top[1]),
+               times[0][0] * 1e6, times[1][0] * 1e6,
+               times[0][1] * 1e6, times[1][1] * 1e6))
 
 if __name__ == "__main__":
-    smoke_test_topkey()
+    if '--benchmark' in sys.argv:
+        benchmark_topkey()
+    else:
+        smoke_test_topkey()
+        fuzz_test_topkey()
@@ -0,0 +1,144 @@
+""" Tests for request tracing, run against fcpstub.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+#pylint: disable-msg=C0111,C0103,R0904,W0201
+import io
+import unittest
+
+from .fcpconnection import FCPConnection, IAsyncSocket
+from .fcpstub import FakeFCPNode
+from .requestqueue import QueueDelayTracer
+from .tracing import RequestTracer, read_trace, summarize_trace, \
+     format_summary, redact_uri
+from .test_requestqueue import ListQueue, make_runner, make_get, make_put, \
+     run_queue
+from .test_statemachine import FetchingMachine
+
+class Unclosed(io.StringIO):
+    def close(self):
+        pass
+
+class SentTracer(QueueDelayTracer):
+    def __init__(self):
+        QueueDelayTracer.__init__(self)
+        self.sent = []
+
+    def request_sent(self, client, byte_count):
+        self.sent.append((client, byte_count))
+
+class TracingTests(unittest.TestCase):
+    def test_sent_bytes(self):
+        socket_ = IAsyncSocket()
+        connection = FCPConnection(socket_)
+        connection.tracer = SentTracer()
+        hello_bytes = connection.written[0][1]
+        connection.write_bytes('first', b'x' * 10)
+        connection.write_bytes('second', b'y' * 5)
+        # Nothing is reported until the socket writes it ...
+        self.assertEqual(connection.tracer.sent, [])
+        # ... and partial writes are charged to the right requests.
+        socket_.sent_callback(hello_bytes + 4)
+        self.assertEqual(connection.tracer.sent, [('first', 4)])
+        socket_.sent_callback(8)
+        socket_.sent_callback(3)
+        self.assertEqual(connection.tracer.sent, [('first', 4), ('first', 6),
+                                                  ('second', 2),
+                                                  ('second', 3)])
+        self.assertEqual(len(connection.written), 0)
+
+    def test_requests(self):
+        node = FakeFCPNode(latency_secs=0.01).start()
+        try:
+            node.insert(b'CHK@fake', b'x' * 1000)
+            runner = make_runner(node, 4)
+            out_file = Unclosed()
+            runner.set_tracer(RequestTracer(out_file, 'test'))
+            queue = ListQueue(runner)
+            queue.requests = [make_get(queue, b'CHK@fake'),
+                              make_get(queue, b'CHK@fake'),
+                              make_put(queue, b'y' * 5000)]
+            run_queue(runner, queue, 3)
+        finally:
+            node.stop()
+
+        entries = read_trace(io.StringIO(out_file.getvalue()))
+        self.assertEqual(entries[0]['type'], 'run')
+        requests = [entry for entry in entries if entry['type'] == 'request']
+        self.assertEqual(len(requests), 3)
+        for entry in requests:
+            self.assertTrue(entry['queued'] <= entry['started'] <=
+                            entry['first_byte'] <= entry['finished'])
+        gets = [entry for entry in requests if entry['kind'] == 'ClientGet']
+        self.assertEqual(sorted([entry['retries'] for entry in gets]), [0, 1])
+        self.assertEqual([entry['bytes_received'] for entry in gets],
+                         [1000, 1000])
+        put = [entry for entry in requests if entry['kind'] == 'ClientPut'][0]
+        self.assertTrue(put['bytes_sent'] > 5000)
+        self.assertEqual(put['retries'], 0)
+
+        summary = summarize_trace(entries)
+        self.assertEqual(summary['ClientGet total secs'][0], 2)
+        self.assertEqual(summary['ClientPut bytes sent'][0], 1)
+        self.assertEqual(len(format_summary(summary)), len(summary) + 1)
+
+    def test_chk_inserts(self):
+        node = FakeFCPNode(latency_secs=0.01).start()
+        try:
+            runner = make_runner(node, 4)
+            out_file = Unclosed()
+            runner.set_tracer(RequestTracer(out_file, 'test'))
+            queue = ListQueue(runner)
+            queue.requests = [make_put(queue, b'x' * 100),
+                              make_put(queue, b'y' * 100)]
+            run_queue(runner, queue, 2)
+        finally:
+            node.stop()
+
+        entries = read_trace(io.StringIO(out_file.getvalue()))
+        # Independent inserts to 'CHK@' aren't retries of each other.
+        self.assertEqual([entry['retries'] for entry in entries
+                          if entry['type'] == 'request'], [0, 0])
+
+    def test_states(self):
+        node = FakeFCPNode().start()
+        try:
+            node.insert(b'CHK@fake', b'data')
+            runner = make_runner(node, 4)
+            machine = FetchingMachine(runner, node)
+            machine.tracer = RequestTracer(Unclosed())
+            machine.states['FETCHING'].current_candidates = [[b'CHK@fake',
+                                                              0]]
+            machine.transition('FETCHING')
+            run_queue(runner, machine, 1)
+            machine.transition('QUIESCENT')
+        finally:
+            node.stop()
+        entries = read_trace(io.StringIO(machine.tracer.out_file.getvalue()))
+        states = [entry for entry in entries if entry['type'] == 'state']
+        self.assertEqual([entry['state'] for entry in states], ['FETCHING'])
+        self.assertTrue(states[0]['dwell'] > 0)
+
+    def test_redact(self):
+        self.assertEqual(redact_uri('USK@private,key,AQECAAE/name/3'),
+                         'USK@.../name/3')
+        self.assertEqual(redact_uri('CHK@'), 'CHK@')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -33,6 +33,8 @@
     top_key_data_to_bytes() converts from the tuple format to
     a compact binary rep.
     bytes_to_top_key_data() converts the binary rep back to a tuple.
+    pack_top_key_tuple() writes the binary rep into an existing
+    bytearray.
 """
 
 
@@ -44,7 +46,7 @@ from binascii import hexlify, unhexlify
 
 from .fcpconnection import sha1_hexdigest
 
-from .chk import CHK_SIZE, bytes_to_chk, chk_to_bytes
+from .chk import CHK_SIZE, pack_chk, unpack_chk
 
 # Known versions:
 # 1.00 -- Initial release.
@@ -72,37 +74,62 @@ BASE_FMT = "!%isBBB" % HDR_SIZE
 #   [parent data][head data][chk data]
 BASE_UPDATE_FMT = "!qBBBB"
 
-BASE_LEN = struct.calcsize(BASE_FMT)
-BASE_UPDATE_LEN = struct.calcsize(BASE_UPDATE_FMT)
+# Precompiled, so formats aren't parsed on every call.
+BASE_STRUCT = struct.Struct(BASE_FMT)
+UPDATE_STRUCT = struct.Struct(BASE_UPDATE_FMT)
+
+BASE_LEN = BASE_STRUCT.size
+BASE_UPDATE_LEN = UPDATE_STRUCT.size
 
 # More pythonic way?
 # Hmmm... why are you using bit bashing in the 21st century?
 HAS_PARENTS = 0x01
 HAS_HEADS = 0x02
 
-def versions_to_bytes(versions):
-    """ INTERNAL: Return raw byte string from hg 40 digit hex
-    version list. """
-    bytes = b''
+def top_key_update_len(parent_count, head_count, chk_count):
+    """ Returns the length of the binary rep of an update with
+        parent_count parent revs, head_count head revs and chk_count
+        CHKs. """
+    return (BASE_UPDATE_LEN + HGVER_SIZE * (parent_count + head_count)
+            + CHK_SIZE * chk_count)
+
+def top_key_tuple_len(top_key_tuple):
+    """ Returns the length of the binary rep of top_key_tuple. """
+    return (BASE_LEN + CHK_SIZE * len(top_key_tuple[0])
+            + sum([top_key_update_len(len(update[1]), len(update[2]),
+                                      len(update[3]))
+                   for update in top_key_tuple[1]]))
+
+def pack_versions(buf, offset, versions):
+    """ INTERNAL: Write the raw bytes for a list of hg 40 digit hex
+        versions into buf at offset and return the offset after them. """
     for version in versions:
         try:
             raw = unhexlify(version)
-            if len(raw) != HGVER_SIZE:
-                raise TypeError() # Hmmm... git'r done.
-        except TypeError:
+        except (TypeError, ValueError):
+            raw = None
+        if raw is None or len(raw) != HGVER_SIZE:
             # REDFLAG: Test code path.
             raise ValueError("Couldn't parse 40 digit hex version from: "
                              + str(version))
-        bytes += raw
-    return bytes
-
-def top_key_tuple_to_bytes(top_key_tuple, salt_byte=0):
-    """ Returns a binary representation of top_key_tuple. """
-
-    ret = struct.pack(BASE_FMT, HDR_BYTES, salt_byte,
-                      len(top_key_tuple[0]), len(top_key_tuple[1]))
-    for graph_chk in top_key_tuple[0]:
-        ret += chk_to_bytes(graph_chk)
+        buf[offset:offset + HGVER_SIZE] = raw
+        offset += HGVER_SIZE
+    return offset
+
+def pack_chks(buf, offset, chks):
+    """ INTERNAL: Write the binary reps of a list of CHKs into buf at
+        offset and return the offset after them. """
+    for chk in chks:
+        offset = pack_chk(buf, offset, chk)
+    return offset
+
+def pack_top_key_tuple(buf, offset, top_key_tuple, salt_byte=0):
+    """ Write the binary rep of top_key_tuple into buf, a bytearray
+        with at least top_key_tuple_len() bytes after offset, and
+        return the offset after it. """
+    BASE_STRUCT.pack_into(buf, offset, HDR_BYTES, salt_byte,
+                          len(top_key_tuple[0]), len(top_key_tuple[1]))
+    offset = pack_chks(buf, offset + BASE_LEN, top_key_tuple[0])
 
     # Can't find doc. True for all modern Python
     assert int(True) == 1 and int(False) == 0
@@ -110,56 +137,60 @@ def top_key_tuple_to_bytes(top_key_tuple, salt_byte=0):
         flags = (((int(update[4]) * 0xff) & HAS_PARENTS)
                  | ((int(update[5]) * 0xff) & HAS_HEADS))
 
-        ret += struct.pack(BASE_UPDATE_FMT,
-                           update[0], flags,
-                           len(update[1]), len(update[2]),
-                           len(update[3]))
-
-        ret += versions_to_bytes(update[1]) # parents
-        ret += versions_to_bytes(update[2]) # heads
-        for chk in update[3]:
-            chk_bytes = chk_to_bytes(chk)
-            assert len(chk_bytes) == CHK_SIZE
-            ret += chk_bytes
-
-    return ret
-
-def versions_from_bytes(version_bytes):
-    """ INTERNAL: Parse a list of hg 40 digit hex version strings from
-        a raw byte block. """
-    assert (len(version_bytes) % HGVER_SIZE) == 0
-    ret = []
-    for count in range(0, len(version_bytes) // HGVER_SIZE):
-        try:
-            ret.append(hexlify(version_bytes[count * HGVER_SIZE:
-                                             (count + 1) * HGVER_SIZE]))
-        except TypeError:
-            raise ValueError("Error parsing an hg version.")
-    return tuple(ret)
-
-def bytes_to_update_tuple(bytes):
-    """ INTERNAL: Read a single update from raw bytes. """
-    length, flags, parent_count, head_count, chk_count = struct.unpack(
-        BASE_UPDATE_FMT,
-        bytes[:BASE_UPDATE_LEN])
+        UPDATE_STRUCT.pack_into(buf, offset,
+                                update[0], flags,
+                                len(update[1]), len(update[2]),
+                                len(update[3]))
+        offset = pack_versions(buf, offset + BASE_UPDATE_LEN,
+                               update[1]) # parents
+        offset = pack_versions(buf, offset, update[2]) # heads
+        offset = pack_chks(buf, offset, update[3])
+    return offset
 
-    bytes = bytes[BASE_UPDATE_LEN:]
-
-    parents = versions_from_bytes(bytes[:HGVER_SIZE * parent_count])
-    bytes = bytes[HGVER_SIZE * parent_count:]
-
-    heads = versions_from_bytes(bytes[:HGVER_SIZE * head_count])
-    bytes = bytes[HGVER_SIZE * head_count:]
-
-    chks = []
-    for dummy in range(0, chk_count):
-        chks.append(bytes_to_chk(bytes[:CHK_SIZE]))
-        bytes = bytes[CHK_SIZE:]
-
-    return ((length, parents, heads, tuple(chks),
+def top_key_tuple_to_bytes(top_key_tuple, salt_byte=0):
+    """ Returns a binary representation of top_key_tuple. """
+    buf = bytearray(top_key_tuple_len(top_key_tuple))
+    end = pack_top_key_tuple(buf, 0, top_key_tuple, salt_byte)
+    assert end == len(buf)
+    return bytes(buf)
+
+def unpack_versions(view, offset, count):
+    """ INTERNAL: Parse count hg 40 digit hex version strings from
+        the memoryview at offset. """
+    return tuple([hexlify(view[pos:pos + HGVER_SIZE])
+                  for pos in range(offset, offset + count * HGVER_SIZE,
+                                   HGVER_SIZE)])
+
+def unpack_chks(view, offset, count):
+    """ INTERNAL: Parse count binary CHKs from the memoryview at
+        offset. """
+    return tuple([unpack_chk(view, pos)
+                  for pos in range(offset, offset + count * CHK_SIZE,
+                                   CHK_SIZE)])
+
+def unpack_update(view, offset):
+    """ INTERNAL: Read a single update from the memoryview at offset.
+
+        Returns an (update_tuple, offset) tuple, where offset is just
+        past the update. """
+    if offset + BASE_UPDATE_LEN > len(view):
+        raise ValueError("Not enough data to parse an update.")
+    length, flags, parent_count, head_count, chk_count = \
+            UPDATE_STRUCT.unpack_from(view, offset)
+    end = offset + top_key_update_len(parent_count, head_count, chk_count)
+    if end > len(view):
+        raise ValueError("Not enough data to parse an update.")
+
+    offset += BASE_UPDATE_LEN
+    parents = unpack_versions(view, offset, parent_count)
+    offset += HGVER_SIZE * parent_count
+    heads = unpack_versions(view, offset, head_count)
+    offset += HGVER_SIZE * head_count
+    chks = unpack_chks(view, offset, chk_count)
+
+    return ((length, parents, heads, chks,
              bool(flags & HAS_PARENTS), bool(flags & HAS_HEADS)),
-            bytes)
-
+            end)
 
 def bytes_to_top_key_tuple(bytes):
     """ Parses the top key data from a byte block and
@@ -171,11 +202,10 @@ def bytes_to_top_key_tuple(bytes):
     if not bytes.startswith(HDR_PREFIX):
         raise ValueError("Doesn't look like top key binary data.")
 
+    view = memoryview(bytes)
     # Hmmm... return the salt byte?
-    hdr, salt, graph_chk_count, update_count = struct.unpack(BASE_FMT,
-                                                             bytes[:BASE_LEN])
+    hdr, salt, graph_chk_count, update_count = BASE_STRUCT.unpack_from(view)
     #print "bytes_to_top_key_data -- salt: ", dummy
-    bytes = bytes[BASE_LEN:]
     if hdr != HDR_BYTES:
         if hdr == HDR_V1:
             print()
@@ -188,26 +218,25 @@ def bytes_to_top_key_tuple(bytes):
             print()
             raise ValueError("Format version mismatch. "
                              + "That repo is in an obsolete format!")
-        if hdr[5] != MAJOR_VERSION:
+        if hdr[5:6] != MAJOR_VERSION:
             # DOH! should have done this in initial release.
             raise ValueError("Format version mismatch. "
                              + "Maybe you're running old code?")
         print("bytes_to_top_key_data -- minor version mismatch: ", hdr)
-    if len(bytes) == 0:
+    if len(view) == BASE_LEN:
         print("bytes_to_top_key_data -- No updates?")
 
-    graph_chks = []
-    for dummy in range(0, graph_chk_count):
-        graph_chks.append(bytes_to_chk(bytes[:CHK_SIZE]))
-        bytes = bytes[CHK_SIZE:]
+    offset = BASE_LEN + CHK_SIZE * graph_chk_count
+    if offset > len(view):
+        raise ValueError("Not enough data to parse the graph CHKs.")
+    graph_chks = unpack_chks(view, BASE_LEN, graph_chk_count)
 
-    # REDFLAG: Fix range errors for incomplete / bad data.
     updates = []
     for dummy in range(0, update_count):
-        update, bytes = bytes_to_update_tuple(bytes)
+        update, offset = unpack_update(view, offset)
         updates.append(update)
 
-    return ((tuple(graph_chks), tuple(updates)), hdr, salt)
+    return ((graph_chks, tuple(updates)), hdr, salt)
 
 def default_out(text):
     """ Default output function for dump_top_key_tuple(). """
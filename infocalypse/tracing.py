@@ -0,0 +1,253 @@
+""" Request tracing for FCP traffic.
+
+    RequestTracer records when each request was queued, started,
+    got its first reply and finished, how many bytes it moved and how
+    often the same candidate or URI was requested before. It also
+    records how long the state machine stayed in each state.
+    Everything is written to a JSON lines trace file which
+    summarize_trace() turns into percentiles.
+
+    Copyright (C) 2009 Darrell Karbott
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public
+    License as published by the Free Software Foundation; either
+    version 2.0 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    General Public License for more details.
+
+    You should have received a copy of the GNU General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+    Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
+"""
+
+import json
+import time
+
+from .requestqueue import QueueDelayTracer, PRIORITY_NAMES, request_class
+from .statemachine import percentile
+
+PERCENTILES = (.5, .9, .99)
+
+def to_text(value):
+    """ INTERNAL: Make bytes JSON friendly. """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def redact_uri(uri):
+    """ INTERNAL: Remove the key from SSK and USK URIs.
+
+        Insert URIs contain private keys.
+    """
+    if uri is None or not uri[:4] in ('SSK@', 'USK@'):
+        return uri
+    if not '/' in uri:
+        return uri[:4]
+    return uri[:4] + '...' + uri[uri.find('/'):]
+
+def retry_key(client):
+    """ INTERNAL: Return the key which identifies retries of client's
+        request or None if it can't be told apart from other requests.
+
+        Requests made from the same state machine candidate are retries
+        of each other. Otherwise requests for the same URI are, except
+        for CHK inserts which all use the URI 'CHK@'. """
+    candidate = getattr(client, 'candidate', None)
+    if not candidate is None:
+        return ('candidate', id(candidate))
+    params = client.in_params.fcp_params
+    uri = params.get(b'URI', params.get('URI'))
+    if uri is None or uri in (b'CHK@', 'CHK@'):
+        return None
+    return ('uri', uri)
+
+class RequestTrace:
+    """ What a RequestTracer knows about a single request. """
+    def __init__(self, client):
+        self.kind = to_text(client.in_params.definition[0])
+        self.uri = to_text(client.in_params.fcp_params.get(b'URI',
+                           client.in_params.fcp_params.get('URI')))
+        if self.kind.startswith('ClientPut'):
+            self.uri = redact_uri(self.uri)
+        self.tag = to_text(str(getattr(client, 'tag', '')))
+        self.priority = PRIORITY_NAMES.get(request_class(client))
+        self.queued = None
+        self.started = None
+        self.first_byte = None
+        self.finished = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.result = None
+
+    def to_dict(self):
+        """ Return a dictionary for the trace file. """
+        return {'type':'request', 'kind':self.kind, 'uri':self.uri,
+                'tag':self.tag, 'priority':self.priority,
+                'queued':self.queued, 'started':self.started,
+                'first_byte':self.first_byte, 'finished':self.finished,
+                'bytes_sent':self.bytes_sent,
+                'bytes_received':self.bytes_received,
+                'retries':self.retries, 'result':self.result}
+
+class RequestTracer(QueueDelayTracer):
+    """ Records per request timings for a RequestRunner, its
+        FCPConnections and a StateMachine and writes them to out_file
+        as JSON lines.
+
+        Attach it with RequestRunner.set_tracer() and
+        StateMachine.tracer.
+    """
+    def __init__(self, out_file, label=''):
+        QueueDelayTracer.__init__(self)
+        self.out_file = out_file
+        # client -> RequestTrace
+        self.traces = {}
+        # retry key -> [candidate or None, number of times requested]
+        # The candidate is kept so that its id can't be reused.
+        self.requested = {}
+        self.state_name = None
+        self.state_entered = None
+        self.write({'type':'run', 'label':to_text(label),
+                    'time':time.time()})
+
+    def write(self, entry):
+        """ INTERNAL: Write a line to the trace file. """
+        self.out_file.write(json.dumps(entry) + '\n')
+
+    def trace_for(self, client):
+        """ INTERNAL: Return the RequestTrace for client, making
+            it if required. """
+        trace = self.traces.get(client)
+        if trace is None:
+            trace = RequestTrace(client)
+            key = retry_key(client)
+            if not key is None:
+                entry = self.requested.setdefault(
+                    key, [getattr(client, 'candidate', None), 0])
+                trace.retries = entry[1]
+                entry[1] += 1
+            self.traces[client] = trace
+        return trace
+
+    # RequestRunner
+    def request_queued(self, client):
+        """ Called when a request is taken from its queue. """
+        self.trace_for(client).queued = time.time()
+
+    def request_started(self, client, delay_secs):
+        """ Called when a request is started. """
+        QueueDelayTracer.request_started(self, client, delay_secs)
+        self.trace_for(client).started = time.time()
+
+    def request_done(self, client, msg):
+        """ Called when a request finished. """
+        trace = self.traces.pop(client, None)
+        if trace is None:
+            return
+        trace.finished = time.time()
+        trace.result = to_text(msg[0])
+        self.write(trace.to_dict())
+
+    # FCPConnection
+    def request_sent(self, client, byte_count):
+        """ Called when bytes of a request's message or data
+            were written to the socket. """
+        self.trace_for(client).bytes_sent += byte_count
+
+    def message_received(self, client, msg):
+        """ Called for every message the node sends for a request. """
+        trace = self.trace_for(client)
+        if trace.first_byte is None:
+            trace.first_byte = time.time()
+        if msg[0] == b'AllData':
+            trace.bytes_received += int(msg[1].get(b'DataLength', 0))
+
+    # StateMachine
+    def state_changed(self, from_state, to_state):
+        """ Called on every StateMachine transition. """
+        now = time.time()
+        if not self.state_entered is None:
+            self.write({'type':'state', 'state':to_text(from_state.name),
+                        'entered':self.state_entered, 'left':now,
+                        'dwell':now - self.state_entered})
+        self.state_name = to_state.name
+        self.state_entered = now
+
+    def close(self):
+        """ Close the trace file. """
+        self.out_file.close()
+
+def read_trace(in_file, last_run_only=False):
+    """ Read the entries from a trace file. """
+    entries = []
+    for line in in_file:
+        line = line.strip()
+        if not line:
+            continue
+        entry = json.loads(line)
+        if last_run_only and entry['type'] == 'run':
+            entries = []
+        entries.append(entry)
+    return entries
+
+def distribution(values):
+    """ Return (count, p50, p90, p99, max) for values. """
+    if not values:
+        return (0, ) + (None, ) * (len(PERCENTILES) + 1)
+    return ((len(values), ) +
+            tuple([percentile(values, fraction) for fraction in PERCENTILES])
+            + (max(values), ))
+
+def summarize_trace(entries):
+    """ Return a dictionary of name -> distribution() for the
+        entries in a trace. """
+    series = {}
+    def add(name, value):
+        """ INTERNAL: Collect a value. """
+        if not value is None:
+            series.setdefault(name, []).append(value)
+
+    for entry in entries:
+        if entry['type'] == 'state':
+            add('state %s dwell secs' % entry['state'], entry['dwell'])
+            continue
+        if entry['type'] != 'request':
+            continue
+        kind = entry['kind']
+        if not entry['started'] is None and not entry['queued'] is None:
+            add('%s queued secs' % kind, entry['started'] - entry['queued'])
+        if not entry['started'] is None:
+            if not entry['first_byte'] is None:
+                add('%s first byte secs' % kind,
+                    entry['first_byte'] - entry['started'])
+            add('%s total secs' % kind, entry['finished'] - entry['started'])
+        add('%s bytes sent' % kind, entry['bytes_sent'])
+        add('%s bytes received' % kind, entry['bytes_received'])
+        add('%s retries' % kind, entry['retries'])
+
+    return dict([(name, distribution(values))
+                 for name, values in series.items()])
+
+def format_summary(summary):
+    """ Return a list of text lines for a summarize_trace() result. """
+    def fmt(value):
+        """ INTERNAL: Format a number. """
+        if isinstance(value, float):
+            return '%.3f' % value
+        return str(value)
+
+    lines = ['%-40s %6s %10s %10s %10s %10s' % ('', 'count', 'p50', 'p90',
+                                                 'p99', 'max')]
+    for name in sorted(summary):
+        values = summary[name]
+        lines.append('%-40s %6i %10s %10s %10s %10s' %
+                     ((name, values[0]) + tuple([fmt(value)
+                                                 for value in values[1:]])))
+    return lines
@@ -20,7 +20,6 @@
     Author: djk@isFiaD04zgAgnrEC5XJt1i4IE7AkNPqhBG5bONi6Yks
 """
 
-import os
 import random
 import time
 
@@ -31,14 +30,16 @@ from .fcpclient import get_ssk_for_usk_version, get_usk_for_usk_version, \
 from .fcpconnection import SUCCESS_MSGS
 from .fcpmessage import GET_DEF, PUT_FILE_DEF, GET_REQUEST_URI_DEF
 
-from .requestqueue import RequestQueue
+from .requestqueue import RequestQueue, PRIORITY_TOP_KEY, \
+     PRIORITY_UPDATE_PATH, PRIORITY_REDUNDANT
 
 from .chk import clear_control_bytes
-from .bundlecache import make_temp_file, BundleException
+from .bundlecache import BundleException, BundleDataSource
 from .graph import INSERT_NORMAL, INSERT_PADDED, INSERT_SALTED_METADATA, \
      INSERT_HUGE, FREENET_BLOCK_LEN, has_version, \
      pull_bundle, hex_version
-from .graphutil import minimal_graph, graph_to_string, parse_graph
+from .graphutil import minimal_graph, graph_to_string, graph_to_binary, \
+     parse_graph_data
 from .choose import get_top_key_updates
 
 from .statemachine import StatefulRequest, RequestQueueState, StateMachine, \
@@ -72,6 +73,8 @@ class UpdateContextBase(dict):
         self.ui_ = None
         self.repo = None
         self.bundle_cache = None
+        # Builds bundles ahead of inserts. See bundlepool.py.
+        self.bundle_pool = None
 
         # Orphaned request handling hmmm...
         self.orphaned = {}
@@ -98,6 +101,9 @@ class UpdateContextBase(dict):
             request.tag = "orphaned_%s_%s" % (str(request.tag), from_state.name)
             assert not request.tag in self.orphaned
             self.orphaned[request.tag] = request
+            if self.parent.runner.is_deferred(request):
+                # Never started. Don't bother running it.
+                self.parent.runner.cancel_request(request)
         from_state.pending.clear()
 
 
@@ -160,6 +166,9 @@ class UpdateContext(UpdateContextBase):
         """
         request = StatefulRequest(self.parent)
         request.tag = tag
+        if edge[2] == 1:
+            # The redundant copy.
+            request.priority = PRIORITY_REDUNDANT
         request.in_params.definition = PUT_FILE_DEF
         request.in_params.fcp_params = self.parent.params.copy()
         request.in_params.fcp_params[b'URI'] = b'CHK@'
@@ -190,8 +199,8 @@ class UpdateContext(UpdateContextBase):
         pad = (kind == INSERT_PADDED)
         #print "make_edge_insert_request -- from disk: pad"
 
-        tmp_file, mime_type = self._get_bundle(edge, pad)
-        request.in_params.file_name = tmp_file
+        data_source, mime_type = self._get_bundle(edge, pad)
+        request.custom_data_source = data_source
         request.in_params.send_data = True
         if not mime_type is None:
             request.in_params.fcp_params[b'Metadata.ContentType'] = mime_type
@@ -199,39 +208,21 @@ class UpdateContext(UpdateContextBase):
         return request
 
     def _get_bundle(self, edge, pad):
-        """ Returns a (temp_file, mime_type) tuple for the hg bundle
-            file corresponding to edge. """
+        """ Returns a (data_source, mime_type) tuple for the hg bundle
+            file corresponding to edge.
+
+            The data source sends the file in the bundle cache, so
+            it isn't copied. """
         original_len = self.graph.get_length(edge)
-        expected_len = original_len
+        padding = b''
         if pad:
-            expected_len += 1
-        # Hmmmm... misuse of bundle cache dir?
-        tmp_file = make_temp_file(self.parent.ctx.bundle_cache.base_dir)
-        raised = False
-        try:
-            bundle = self.parent.ctx.bundle_cache.make_bundle(self.graph,
-                                                              self.parent.ctx.
-                                                              version_table,
-                                                              edge[:2],
-                                                              tmp_file)
-
-            if bundle[0] != original_len:
-                raise BundleException("Wrong size. Expected: %i. Got: %i"
-                                      % (original_len, bundle[0]))
-            assert bundle[0] == original_len
-            if pad:
-                out_file = open(tmp_file, 'ab')
-                try:
-                    out_file.seek(0, os.SEEK_END)
-                    out_file.write(PAD_BYTE)
-                finally:
-                    out_file.close()
-
-            assert expected_len == os.path.getsize(tmp_file)
-            raised = False
-        finally:
-            if raised and os.path.exists(tmp_file):
-                os.remove(tmp_file)
+            padding = PAD_BYTE
+        length, file_name = self.parent.ctx.bundle_cache.get_bundle_file(
+            self.graph, self.parent.ctx.version_table, edge[:2])
+        if length != original_len:
+            raise BundleException("Wrong size. Expected: %i. Got: %i"
+                                  % (original_len, length))
+        expected_len = original_len + len(padding)
 
         if expected_len <= FREENET_BLOCK_LEN:
             mime_type = None
@@ -239,7 +230,7 @@ class UpdateContext(UpdateContextBase):
             assert edge[2] > -1 and edge[2] < 2
             mime_type = HG_MIME_TYPE_FMT % edge[2]
 
-        return (tmp_file, mime_type)
+        return (BundleDataSource(file_name, padding), mime_type)
 
 
 
@@ -279,6 +270,8 @@ class StaticRequestList(RetryingRequestList):
         self.required_successes = 0
         # If this is True attemps all candidates before success.
         self.try_all = False
+        # Request class for the requests, see requestqueue.PRIORITY_*.
+        self.priority = None
 
     def reset(self):
         """ Implementation of State virtual. """
@@ -351,6 +344,7 @@ class StaticRequestList(RetryingRequestList):
         request = CandidateRequest(self.parent)
         request.tag = self.get_tag(candidate)
         request.candidate = candidate
+        request.priority = self.priority
         request.in_params.fcp_params = self.parent.params.copy()
         request.in_params.fcp_params[b'URI'] = candidate[0]
         if candidate[2]:
@@ -376,6 +370,7 @@ class InsertingGraph(StaticRequestList):
     def __init__(self, parent, name, success_state, failure_state):
         StaticRequestList.__init__(self, parent, name,
                                    success_state, failure_state)
+        self.priority = PRIORITY_UPDATE_PATH
         self.working_graph = None
 
     def enter(self, from_state):
@@ -394,19 +389,24 @@ class InsertingGraph(StaticRequestList):
             self.parent.ctx.ui_.status(graph_to_string(self.parent.ctx.graph)
                                    + b'\n')
 
+        # Older clients can only read the text format.
+        formatter = graph_to_string
+        if self.parent.params.get('BINARY_GRAPH', False):
+            formatter = graph_to_binary
+
         # Create minimal graph that will fit in a 32k block.
         assert not self.parent.ctx.version_table is None
         self.working_graph = minimal_graph(self.parent.ctx.graph,
                                            self.parent.ctx.repo,
                                            self.parent.ctx.version_table,
-                                           31*1024)
+                                           31*1024, formatter)
         if self.parent.params.get('DUMP_GRAPH', False):
             self.parent.ctx.ui_.status(b"--- Minimal Graph ---\n")
             self.parent.ctx.ui_.status(graph_to_string(self.working_graph)
                                        + b'\n---\n')
 
         # Make sure the string rep is small enough!
-        graph_bytes = graph_to_string(self.working_graph)
+        graph_bytes = formatter(self.working_graph)
         assert len(graph_bytes) <= 31 * 1024
 
         # Insert the graph twice for redundancy
@@ -438,8 +438,15 @@ class InsertingGraph(StaticRequestList):
         # REDFLAG: graph redundancy hard coded to 2.
         chks = (self.get_result(0)[1][b'URI'], self.get_result(1)[1][b'URI'])
 
+        max_len = None
+        if self.parent.params.get('PACK_TOP_KEY', False):
+            # What's left for the updates.
+            max_len = (MAX_SSK_LEN - 1 - topkey.BASE_LEN
+                       - len(chks) * topkey.CHK_SIZE)
+
         # Slow.
-        updates = get_top_key_updates(graph, self.parent.ctx.repo)
+        updates = get_top_key_updates(graph, self.parent.ctx.repo, None,
+                                      max_len)
 
         # Head revs are more important because they allow us to
         # check whether the local repo is up to date.
@@ -483,6 +490,7 @@ class InsertingUri(StaticRequestList):
     def __init__(self, parent, name, success_state, failure_state):
         StaticRequestList.__init__(self, parent, name, success_state,
                              failure_state)
+        self.priority = PRIORITY_TOP_KEY
         self.topkey_funcs = topkey
         self.cached_top_key_tuple = None
 
@@ -562,6 +570,7 @@ class RequestingUri(StaticRequestList):
     def __init__(self, parent, name, success_state, failure_state):
         StaticRequestList.__init__(self, parent, name, success_state,
                                    failure_state)
+        self.priority = PRIORITY_TOP_KEY
         self.try_all = True # Hmmmm...
 
         # hmmmm... Does C module as namespace idiom really belong in Python?
@@ -681,6 +690,9 @@ class RequiresGraph(DecisionState):
             # the repository in Freenet, so we need to request the
             # graph.
             return self.yes_state
+        if self.parent.ctx.get(b'REQUIRE_GRAPH', False):
+            # The caller wants the graph too.
+            return self.yes_state
         return self.no_state
 
     def get_top_key_tuple(self):
@@ -753,6 +765,7 @@ class InvertingUri(RequestQueueState):
         request.in_params.fcp_params[b'DataLength'] = (
             len(request.in_params.send_data))
         request.tag = b'only_invert' # Hmmmm...
+        request.priority = PRIORITY_TOP_KEY
         self.parent.ctx.set_cancel_time(request)
         return request
 
@@ -769,6 +782,7 @@ class RequestingGraph(StaticRequestList):
     def __init__(self, parent, name, success_state, failure_state):
         StaticRequestList.__init__(self, parent, name, success_state,
                                    failure_state)
+        self.priority = PRIORITY_UPDATE_PATH
 
     def enter(self, from_state):
         """ Implementation of State virtual. """
@@ -792,7 +806,7 @@ class RequestingGraph(StaticRequestList):
             for candidate in self.ordered:
                 result = candidate[5]
                 if not result is None and result[0] == b'AllData':
-                    graph = parse_graph(result[2])
+                    graph = parse_graph_data(result[2])
 
             assert not graph is None
 
@@ -950,6 +964,7 @@ class UpdateStateMachine(RequestQueue, StateMachine):
         ctx.repo = self.ctx.repo
         ctx.ui_ = self.ctx.ui_
         ctx.bundle_cache = self.ctx.bundle_cache
+        ctx.bundle_pool = self.ctx.bundle_pool
         if len(self.ctx.orphaned) > 0:
             print("BUG?: Abandoning orphaned requests.")
             self.ctx.orphaned.clear()
@@ -999,14 +1014,17 @@ class UpdateStateMachine(RequestQueue, StateMachine):
         self.ctx[b'REQUEST_URI'] = request_uri
         self.transition(REQUESTING_URI)
 
-    def start_requesting_heads(self, request_uri):
+    def start_requesting_heads(self, request_uri, require_graph=False):
         """ Start fetching the top key and graph if necessary to retrieve
             the list of the latest heads in Freenet.
+
+            If require_graph is True, the graph is always fetched.
         """
         self.require_state(QUIESCENT)
         self.reset()
         self.ctx.graph = None
         self.ctx[b'REQUEST_URI'] = request_uri
+        self.ctx[b'REQUIRE_GRAPH'] = require_graph
         self.transition(REQUESTING_URI_4_HEADS)
 
     def start_single_request(self, stateful_request):